@@ -4,7 +4,17 @@ set -e
 python manage.py migrate --noinput
 python manage.py collectstatic --noinput
 
-gunicorn kallan.wsgi:application \
+# WEB_SERVER=asgi serves the same app through uvicorn workers, so slow
+# requests and the async read endpoints don't tie up a whole worker each.
+if [ "${WEB_SERVER:-wsgi}" = "asgi" ]; then
+  exec uvicorn kallan.asgi:application \
+    --host 0.0.0.0 --port 8000 \
+    --workers ${WEB_CONCURRENCY:-3} \
+    --timeout-keep-alive 60 \
+    --proxy-headers --forwarded-allow-ips="*"
+fi
+
+exec gunicorn kallan.wsgi:application \
   --bind 0.0.0.0:8000 \
   --workers ${WEB_CONCURRENCY:-3} \
   --timeout 60
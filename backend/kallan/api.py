@@ -5,6 +5,8 @@ from punishments.api import router as punishments_router
 from push.api import router as push_router
 from users.api import router as users_router
 
+from .renderers import ORJSONRenderer
+
 
 class SessionAuthNoForcedReset(SessionAuth):
     def authenticate(self, request, token=None):
@@ -16,7 +18,7 @@ class SessionAuthNoForcedReset(SessionAuth):
         return user
 
 
-api = NinjaAPI(auth=SessionAuthNoForcedReset())
+api = NinjaAPI(auth=SessionAuthNoForcedReset(), renderer=ORJSONRenderer())
 api.add_router("/users/", users_router)
 api.add_router("/punishments/", punishments_router)
 api.add_router("/push/", push_router)
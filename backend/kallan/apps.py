@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class KallanConfig(AppConfig):
+    name = 'kallan'
+
+    def ready(self):
+        from . import db_pool  # noqa: F401  (publishes connection pool stats)
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kallan.settings')
+# serve the async variants of the read views (see kallan.async_db)
+os.environ.setdefault('WEB_SERVER', 'asgi')
 
 application = get_asgi_application()
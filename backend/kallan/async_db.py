@@ -0,0 +1,124 @@
+"""Async variants of the hot read views, served under ASGI.
+
+``async_when_asgi`` registers a view's async twin instead of the view itself
+when the app runs under ASGI (``kallan.asgi``); under WSGI the sync view stays,
+since there an async view costs an event loop per request and a thread hop
+per query.
+
+Django's async ORM runs every query of a request on the same thread, one
+after another. ``gather_db`` instead runs each call on a worker thread of
+its own, with its own pooled connection, so independent aggregates overlap:
+
+    week, balance = await gather_db(
+        (services.window_totals, target_id, start, end),
+        (services.get_balance, target_id),
+    )
+
+Inside a transaction (tests, or a caller that opened one) the calls run in
+order on the request's own connection instead, so they see its
+uncommitted rows.
+
+Under ASGI a ``StreamingHttpResponse`` given a sync iterator reads all of
+it into a list before sending anything. Views that stream pass their
+iterator through ``streaming_content``, which under ASGI hands out an async
+iterator that reads ``STREAM_BATCH`` items per thread hop instead.
+"""
+
+import asyncio
+import functools
+import itertools
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def async_when_asgi(async_view):
+    """Serve ``async_view`` in place of the decorated view if ``settings.ASYNC_VIEWS``.
+
+    Both take the same parameters. The async one takes over the sync one's
+    name, so the operation id in the schema is the same either way.
+    """
+
+    def decorator(sync_view):
+        if not settings.ASYNC_VIEWS:
+            return sync_view
+        async_view.__name__ = sync_view.__name__
+        async_view.__qualname__ = sync_view.__qualname__
+        return async_view
+
+    return decorator
+
+
+STREAM_BATCH = 100
+
+
+async def aiter_in_batches(iterator, size: int = STREAM_BATCH):
+    """Async iterator over a sync one, reading ``size`` items per thread hop.
+
+    Every batch is read on the request's sync thread, so a server-side
+    cursor behind ``iterator`` keeps its connection between batches.
+    """
+    iterator = iter(iterator)
+    take = sync_to_async(lambda: list(itertools.islice(iterator, size)))
+    try:
+        while batch := await take():
+            for item in batch:
+                yield item
+    finally:
+        # a client that went away leaves the cursor open otherwise
+        if hasattr(iterator, "close"):
+            await sync_to_async(iterator.close)()
+
+
+def streaming_content(iterator):
+    """``iterator`` in the form a ``StreamingHttpResponse`` streams on this server."""
+    return aiter_in_batches(iterator) if settings.ASYNC_VIEWS else iterator
+
+
+def _release_connection() -> bool:
+    """Hand the request's connection back before fanning out.
+
+    Waiting on pooled connections while holding one would deadlock once
+    enough requests do it at the same time. Returns False inside a
+    transaction, where the connection has to stay.
+    """
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return False
+    connections.close_all()
+    return True
+
+
+def _on_own_connection(fn):
+    @functools.wraps(fn)
+    def run(*args):
+        try:
+            return fn(*args)
+        finally:
+            # hand the worker thread's connections back to the pool
+            connections.close_all()
+
+    return run
+
+
+async def gather_db(*calls):
+    """Await ``(fn, *args)`` calls concurrently; return their results in order."""
+    if not await sync_to_async(_release_connection)():
+        return [await sync_to_async(fn)(*args) for fn, *args in calls]
+    return await asyncio.gather(
+        *(
+            sync_to_async(_on_own_connection(fn), thread_sensitive=False)(*args)
+            for fn, *args in calls
+        )
+    )
+
+
+async def resolve_user(request):
+    """Load ``request.user`` off the event loop, for code that reads it later.
+
+    View decorators run before ninja's authentication, so in an async view
+    the user is still the lazy object from ``AuthenticationMiddleware``.
+    """
+    if hasattr(request, "auser"):
+        request.user = await request.auser()
+    return getattr(request, "user", None)
@@ -0,0 +1,156 @@
+"""Tag-based response cache for ninja operations.
+
+Each cached response is stored under a key that embeds the current version
+of every tag it depends on. Invalidating a tag just bumps its version, so all
+entries built from the old data stop matching at once and age out on their
+own; nothing has to be scanned or deleted.
+
+    @router.get("/stats", response=PunishmentStatsOut)
+    @cached_response(TAG_PUNISHMENTS)
+    def punishment_stats(request, ...):
+        ...
+
+Writers invalidate through model signals (see ``punishments.signals`` and
+``users.signals``), so cached reads are never served after a committed write.
+"""
+
+import functools
+import hashlib
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from ninja.decorators import decorate_view
+
+from .async_db import resolve_user
+from .db_router import replica_may_lag
+
+logger = logging.getLogger(__name__)
+
+TAG_USERS = "users"
+TAG_PUNISHMENTS = "punishments"
+TAG_FIKAPINNAR = "fikapinnar"
+
+DEFAULT_TIMEOUT = 5 * 60
+
+
+def _tag_key(tag: str) -> str:
+    return f"tag:{tag}"
+
+
+def _tag_versions(tags) -> list[int]:
+    keys = [_tag_key(t) for t in tags]
+    versions = cache.get_many(keys)
+    missing = [k for k in keys if k not in versions]
+    if missing:
+        # seeded from the clock so a flushed cache never reuses a version
+        seed = time.time_ns() // 1000
+        for k in missing:
+            cache.add(k, seed, timeout=None)
+        stored = cache.get_many(missing)
+        # a cache that dropped the key again still gets a fresh version
+        versions.update({k: stored.get(k, seed) for k in missing})
+    return [versions[k] for k in keys]
+
+
+def invalidate_tags(*tags: str) -> None:
+    for tag in tags:
+        try:
+            cache.incr(_tag_key(tag))
+        except ValueError:
+            # no version yet: nothing cached under this tag can exist
+            pass
+        except Exception:
+            logger.warning("Could not invalidate cache tag %s", tag, exc_info=True)
+
+
+def invalidate_tags_on_commit(*tags: str) -> None:
+    transaction.on_commit(lambda: invalidate_tags(*tags))
+
+
+def _response_key(request, tags, versions, vary=None) -> str:
+    variant = "|".join(
+        [
+            request.get_host(),
+            request.get_full_path(),
+            str(request.user.pk),
+            # stats windows roll over at midnight without any write
+            timezone.localdate().isoformat(),
+            *(f"{t}={v}" for t, v in zip(tags, versions)),
+            vary(request) if vary is not None else "",
+        ]
+    )
+    return "resp:" + hashlib.sha1(variant.encode()).hexdigest()
+
+
+def _lookup(request, tags, vary=None):
+    """(key, cached response or None), or None if the cache is unavailable."""
+    try:
+        key = _response_key(request, tags, _tag_versions(tags), vary)
+        return key, cache.get(key)
+    except Exception:
+        logger.warning("Response cache unavailable", exc_info=True)
+        return None
+
+
+def _store(key, response, timeout) -> None:
+    # a replica read that raced a write must not be kept under the new versions
+    if response.status_code == 200 and not response.streaming and not replica_may_lag():
+        try:
+            cache.set(key, response, timeout)
+        except Exception:
+            logger.warning("Could not store cached response", exc_info=True)
+
+
+def _cacheable(request) -> bool:
+    user = getattr(request, "user", None)
+    return request.method == "GET" and bool(user) and user.is_authenticated
+
+
+def cached_response(*tags: str, timeout: int = DEFAULT_TIMEOUT, vary=None):
+    """Cache a GET operation's rendered 200 response per user, path and query.
+
+    ``vary(request)``, if given, returns a string for whatever else the
+    response depends on that no tag tracks.
+    """
+
+    def view_decorator(run):
+        if iscoroutinefunction(run):
+
+            @functools.wraps(run)
+            async def async_wrapper(request, *args, **kwargs):
+                await resolve_user(request)
+                if not _cacheable(request):
+                    return await run(request, *args, **kwargs)
+                found = await sync_to_async(_lookup)(request, tags, vary)
+                if found is None:
+                    return await run(request, *args, **kwargs)
+                key, response = found
+                if response is not None:
+                    return response
+                response = await run(request, *args, **kwargs)
+                await sync_to_async(_store)(key, response, timeout)
+                return response
+
+            return async_wrapper
+
+        @functools.wraps(run)
+        def wrapper(request, *args, **kwargs):
+            if not _cacheable(request):
+                return run(request, *args, **kwargs)
+            found = _lookup(request, tags, vary)
+            if found is None:
+                return run(request, *args, **kwargs)
+            key, response = found
+            if response is not None:
+                return response
+            response = run(request, *args, **kwargs)
+            _store(key, response, timeout)
+            return response
+
+        return wrapper
+
+    return decorate_view(view_decorator)
@@ -1,9 +1,25 @@
 import os
 
 from celery import Celery
+from celery.signals import task_postrun, worker_process_init
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "kallan.settings")
 
 app = Celery("kallan")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def _fresh_db_pools(**kwargs):
+    # prefork children must not share the parent's pooled sockets
+    from kallan.db_pool import close_pools
+
+    close_pools()
+
+
+@task_postrun.connect
+def _publish_db_pool_stats(**kwargs):
+    from kallan.db_pool import publish_stats
+
+    publish_stats()
@@ -0,0 +1,107 @@
+"""Instrumentation of the per-process Postgres connection pools.
+
+Every process that talks to the database (gunicorn workers, the events
+server, Celery children) has its own psycopg pool per database alias. The
+pool's counters are published to Redis every ``PUBLISH_INTERVAL`` seconds,
+after a request or task, under one short-lived key per process, and
+``manage.py db_pool_stats`` aggregates them:
+
+- checkouts (``requests_num``) and how many had to wait (``requests_queued``)
+- total and average wait for a connection
+- connections in use vs ``max_size`` (saturation) and failed checkouts
+
+A pool that often queues, or sits at full saturation, needs a bigger
+``DB_POOL_MAX_SIZE`` (or fewer processes); one that never goes past a
+single connection can be made smaller.
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+import redis
+from django.core.signals import request_finished
+from django.db import connections
+from django.dispatch import receiver
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY_PREFIX = "kallan:dbpool:"
+PUBLISH_INTERVAL = 10
+_STATS_TTL = 3 * PUBLISH_INTERVAL
+
+_last_published = 0.0
+
+
+def _pools():
+    for alias in connections:
+        conn = connections[alias]
+        if conn.vendor == "postgresql" and conn.settings_dict["OPTIONS"].get("pool"):
+            yield alias, conn.pool
+
+
+def close_pools() -> None:
+    """Drop pools inherited across a fork; the child opens its own."""
+    for alias in connections:
+        conn = connections[alias]
+        if conn.vendor == "postgresql":
+            conn.close_pool()
+
+
+def pool_stats() -> dict[str, dict]:
+    """Counters of this process's pools, by alias, with derived figures."""
+    stats = {}
+    for alias, pool in _pools():
+        s = pool.get_stats()
+        in_use = s.get("pool_size", 0) - s.get("pool_available", 0)
+        checkouts = s.get("requests_num", 0)
+        s["in_use"] = in_use
+        s["saturation"] = round(in_use / s["pool_max"], 3) if s.get("pool_max") else 0.0
+        s["avg_wait_ms"] = (
+            round(s.get("requests_wait_ms", 0) / checkouts, 2) if checkouts else 0.0
+        )
+        stats[alias] = s
+    return stats
+
+
+def _process_key() -> str:
+    return f"{STATS_KEY_PREFIX}{socket.gethostname()}:{os.getpid()}"
+
+
+def publish_stats(force: bool = False) -> None:
+    global _last_published
+    now = time.monotonic()
+    if not force and now - _last_published < PUBLISH_INTERVAL:
+        return
+    stats = pool_stats()
+    if not stats:
+        return
+    _last_published = now
+    payload = {
+        "process": os.path.basename(sys.argv[0]) if sys.argv else "",
+        "pid": os.getpid(),
+        "pools": stats,
+    }
+    try:
+        get_redis().set(_process_key(), json.dumps(payload), ex=_STATS_TTL)
+    except redis.RedisError:
+        logger.warning("Could not publish pool stats", exc_info=True)
+
+
+def collect_stats() -> list[dict]:
+    """The stats each live process published last."""
+    client = get_redis()
+    keys = list(client.scan_iter(match=f"{STATS_KEY_PREFIX}*", count=100))
+    if not keys:
+        return []
+    return [json.loads(v) for v in client.mget(keys) if v is not None]
+
+
+@receiver(request_finished)
+def _publish_after_request(sender, **kwargs):
+    publish_stats()
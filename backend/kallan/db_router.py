@@ -0,0 +1,144 @@
+"""Read-replica routing for API reads, with read-your-writes stickiness.
+
+If a ``replica`` database alias is configured, ``ReplicaReadMiddleware``
+marks safe (GET/HEAD) requests to the API so that ``PrimaryReplicaRouter``
+sends their reads to the replica. Everything else, writes, reads inside a
+transaction, background tasks and requests outside ``/api/``, stays on
+``default``.
+
+A successful unsafe request sets a short-lived cookie; while it is present
+that client's reads stay on the primary, so it never reads a replica that
+has not caught up with its own write yet.
+
+Other clients' reads are cached and ETagged under the ledger version (see
+``kallan.versioning`` and ``kallan.cache``), so a replica read that misses a
+write must not be stored under the version that write bumped. Every bump
+therefore marks a recent write (``mark_recent_write``), and for the same
+sticky period all API reads go to the primary. A replica read during which
+a write landed anyway is neither cached nor ETagged (``replica_may_lag``).
+
+Without a ``replica`` alias all of this is a no-op.
+"""
+
+import logging
+from contextvars import ContextVar
+
+import redis
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+REPLICA = "replica"
+STICKY_COOKIE = "kallan_primary"
+RECENT_WRITE_KEY = "kallan:recent-write"
+
+_read_from_replica: ContextVar[bool] = ContextVar("read_from_replica", default=False)
+
+
+def replica_configured() -> bool:
+    return REPLICA in settings.DATABASES
+
+
+def mark_recent_write(pipe) -> None:
+    """Queue on ``pipe`` the marker that keeps reads off the replica for a while."""
+    if replica_configured():
+        pipe.set(RECENT_WRITE_KEY, 1, ex=settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+def _recent_write() -> bool:
+    try:
+        return bool(get_redis().exists(RECENT_WRITE_KEY))
+    except redis.RedisError:
+        # without Redis there is no ledger version to cache stale reads under
+        logger.warning("Could not check for recent writes", exc_info=True)
+        return False
+
+
+def replica_may_lag() -> bool:
+    """Whether this request reads the replica and a write has landed since it
+    started, so what it read may predate the current ledger version."""
+    return _read_from_replica.get() and replica_configured() and _recent_write()
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _read_from_replica.get() or not replica_configured():
+            return None
+        # a transaction on the primary must see its own uncommitted rows
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaReadMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _read_from_replica.set(self._use_replica(request))
+        try:
+            response = self.get_response(request)
+            self._drop_lagging_etag(response)
+        finally:
+            _read_from_replica.reset(token)
+        return self._pin_after_write(request, response)
+
+    async def __acall__(self, request):
+        # both check Redis, so they run on a thread
+        token = _read_from_replica.set(await sync_to_async(self._use_replica)(request))
+        try:
+            response = await self.get_response(request)
+            await sync_to_async(self._drop_lagging_etag)(response)
+        finally:
+            _read_from_replica.reset(token)
+        return self._pin_after_write(request, response)
+
+    def _use_replica(self, request) -> bool:
+        return (
+            replica_configured()
+            and request.method in ("GET", "HEAD")
+            and request.path.startswith("/api/")
+            and STICKY_COOKIE not in request.COOKIES
+            and not _recent_write()
+        )
+
+    def _drop_lagging_etag(self, response) -> None:
+        # the ETag may name a version newer than what the replica returned
+        if response.has_header("ETag") and replica_may_lag():
+            del response["ETag"]
+
+    def _pin_after_write(self, request, response):
+        if (
+            replica_configured()
+            and request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 400
+        ):
+            response.set_cookie(
+                STICKY_COOKIE,
+                "1",
+                max_age=settings.DATABASE_REPLICA_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
@@ -0,0 +1,113 @@
+"""``Idempotency-Key`` support for mutating ninja operations.
+
+A client that may retry a request sends the same ``Idempotency-Key`` header
+on every attempt. The first attempt runs normally and its response is kept
+in the cache for ``IDEMPOTENCY_TTL``; later attempts get that response back
+(with ``Idempotent-Replayed: true``) without the view running, so nothing is
+written, pushed or published twice.
+
+    @router.post("/take", response={201: TakePunishmentOut})
+    @idempotent
+    def take_punishment(request, payload: TakePunishmentIn):
+        ...
+
+Keys are scoped per user and per operation. Reusing a key for a different
+request body is rejected with 422; a duplicate that arrives while the first
+attempt is still running gets 409 and should retry later. Requests without
+the header are not affected.
+"""
+
+import functools
+import hashlib
+import logging
+
+from django.core.cache import cache
+from django.http import JsonResponse
+from ninja.decorators import decorate_view
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# How long an attempt may hold the key before another one may take over.
+_LOCK_TTL = 60
+_IN_FLIGHT = "in-flight"
+_MAX_KEY_LENGTH = 255
+
+
+def _cache_key(request, key: str) -> str:
+    variant = "|".join(
+        [str(request.user.pk), request.method, request.path, key]
+    )
+    return "idem:" + hashlib.sha1(variant.encode()).hexdigest()
+
+
+def _fingerprint(request) -> str:
+    if request.content_type != "multipart/form-data":
+        return hashlib.sha1(request.body).hexdigest()
+
+    # request.body refuses uploads over DATA_UPLOAD_MAX_MEMORY_SIZE, so hash
+    # the parsed form instead, streaming each file from wherever the upload
+    # handler put it
+    digest = hashlib.sha1()
+    for name, values in sorted(request.POST.lists()):
+        digest.update(repr((name, values)).encode())
+    for name, files in sorted(request.FILES.lists()):
+        for f in files:
+            digest.update(repr((name, f.name, f.size)).encode())
+            for chunk in f.chunks():
+                digest.update(chunk)
+            f.seek(0)
+    return digest.hexdigest()
+
+
+def _run_idempotent(run):
+    @functools.wraps(run)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        user = getattr(request, "user", None)
+        if not key or not user or not user.is_authenticated:
+            return run(request, *args, **kwargs)
+        if len(key) > _MAX_KEY_LENGTH:
+            return JsonResponse({"detail": "INVALID_IDEMPOTENCY_KEY"}, status=400)
+
+        cache_key = _cache_key(request, key)
+        fingerprint = _fingerprint(request)
+        try:
+            acquired = cache.add(cache_key, _IN_FLIGHT, _LOCK_TTL)
+            stored = None if acquired else cache.get(cache_key)
+        except Exception:
+            logger.warning("Idempotency store unavailable", exc_info=True)
+            return run(request, *args, **kwargs)
+
+        if not acquired:
+            if stored == _IN_FLIGHT:
+                return JsonResponse({"detail": "IDEMPOTENCY_KEY_IN_PROGRESS"}, status=409)
+            if stored is not None:
+                stored_fingerprint, response = stored
+                if stored_fingerprint != fingerprint:
+                    return JsonResponse({"detail": "IDEMPOTENCY_KEY_REUSED"}, status=422)
+                response["Idempotent-Replayed"] = "true"
+                return response
+            # expired between add() and get(): run without replay protection
+            # rather than fail the request
+
+        response = None
+        try:
+            response = run(request, *args, **kwargs)
+        finally:
+            try:
+                if response is None or response.status_code >= 500 or response.streaming:
+                    # let the client retry a server error for real
+                    cache.delete(cache_key)
+                else:
+                    cache.set(cache_key, (fingerprint, response), IDEMPOTENCY_TTL)
+            except Exception:
+                logger.warning("Could not store idempotent response", exc_info=True)
+        return response
+
+    return wrapper
+
+
+idempotent = decorate_view(_run_idempotent)
@@ -0,0 +1,110 @@
+import io
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from kallan.db_pool import pool_stats
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure requests/s of an API endpoint through the full WSGI stack "
+        "(middleware, session, request_finished) with a fresh connection per "
+        "request and with the connection pool. Signs in as an existing user "
+        "through a throwaway session that is deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--username", required=True)
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--threads", type=int, default=1)
+        parser.add_argument("--path", default="/api/users/me")
+
+    def handle(self, *args, username, requests, threads, path, **options):
+        conn = connections["default"]
+        pool_options = conn.settings_dict["OPTIONS"].get("pool")
+        if conn.vendor != "postgresql" or not pool_options:
+            raise CommandError("The default database has no connection pool configured.")
+
+        # the timed requests run on their own connections, so the user has to be
+        # committed; use one that exists rather than create (and maybe leak) one
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {username!r}.")
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        try:
+            handler = WSGIHandler()
+            connections.close_all()
+            conn.close_pool()
+            del conn.settings_dict["OPTIONS"]["pool"]
+            without = self._run(handler, path, session.session_key, requests, threads)
+
+            conn.settings_dict["OPTIONS"]["pool"] = pool_options
+            with_pool = self._run(handler, path, session.session_key, requests, threads)
+            stats = pool_stats().get("default", {})
+        finally:
+            conn.settings_dict["OPTIONS"]["pool"] = pool_options
+            session.delete()
+
+        self.stdout.write(f"GET {path}, {requests} requests, {threads} thread(s)")
+        self.stdout.write(f"  connect per request: {without:8.1f} req/s")
+        self.stdout.write(
+            f"  pooled:              {with_pool:8.1f} req/s  (x{with_pool / without:.2f})"
+        )
+        self.stdout.write(
+            f"  pool: {stats.get('connections_num', 0)} connects, "
+            f"{stats.get('requests_num', 0)} checkouts, "
+            f"{stats.get('requests_queued', 0)} queued, "
+            f"avg wait {stats.get('avg_wait_ms', 0)} ms"
+        )
+
+    def _run(self, handler, path, session_key, requests, threads) -> float:
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": path,
+            "QUERY_STRING": "",
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "80",
+            "HTTP_HOST": "localhost",
+            "HTTP_COOKIE": f"{settings.SESSION_COOKIE_NAME}={session_key}",
+            "wsgi.url_scheme": "http",
+        }
+        errors = []
+
+        def request():
+            response = handler({**environ, "wsgi.input": io.BytesIO()}, lambda *a: None)
+            b"".join(response)
+            response.close()  # request_finished: the connection is closed or returned
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+        def worker(n):
+            for _ in range(n):
+                request()
+            connections.close_all()
+
+        worker(10)  # warm up
+        per_thread = requests // threads
+        workers = [threading.Thread(target=worker, args=(per_thread,)) for _ in range(threads)]
+        start = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise CommandError(f"{path} answered {errors[0]}")
+        return per_thread * threads / elapsed
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from kallan.db_pool import collect_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the database connection pool counters published by every "
+        "running web and worker process."
+    )
+
+    def handle(self, *args, **options):
+        processes = sorted(collect_stats(), key=lambda p: (p["process"], p["pid"]))
+        if not processes:
+            self.stdout.write("No pool stats published (is anything running?).")
+            return
+
+        header = (
+            f"{'process':<24} {'alias':<8} {'size':>9} {'in use':>6} {'sat':>5} "
+            f"{'checkouts':>9} {'queued':>7} {'avg wait':>9} {'errors':>6}"
+        )
+        self.stdout.write(header)
+        totals = {}
+        for proc in processes:
+            for alias, s in proc["pools"].items():
+                self.stdout.write(
+                    f"{proc['process'] + ':' + str(proc['pid']):<24} {alias:<8} "
+                    f"{s.get('pool_size', 0):>4}/{s.get('pool_max', 0):<4} "
+                    f"{s['in_use']:>6} {s['saturation']:>5.0%} "
+                    f"{s.get('requests_num', 0):>9} {s.get('requests_queued', 0):>7} "
+                    f"{s['avg_wait_ms']:>7.1f}ms {s.get('requests_errors', 0):>6}"
+                )
+                t = totals.setdefault(alias, dict.fromkeys(
+                    ("pool_size", "pool_max", "in_use", "requests_num",
+                     "requests_queued", "requests_wait_ms", "requests_errors"), 0
+                ))
+                for k in t:
+                    t[k] += s.get(k, 0)
+
+        self.stdout.write("")
+        for alias, t in totals.items():
+            checkouts = t["requests_num"]
+            self.stdout.write(
+                f"{alias}: {t['pool_size']}/{t['pool_max']} connections open, "
+                f"{t['in_use']} in use; {checkouts} checkouts, "
+                f"{t['requests_queued']} waited "
+                f"({t['requests_queued'] / checkouts if checkouts else 0:.1%}), "
+                f"avg wait {t['requests_wait_ms'] / checkouts if checkouts else 0:.1f} ms, "
+                f"{t['requests_errors']} failed"
+            )
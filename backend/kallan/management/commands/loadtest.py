@@ -0,0 +1,119 @@
+import http.client
+import itertools
+import json
+import statistics
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_PATHS = [
+    "/api/punishments/events?confirmed=1&limit=50",
+    "/api/punishments/stats",
+    "/api/punishments/fikapinnar/stats",
+    "/api/users/",
+    "/api/users/me",
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure concurrent-request throughput of a running server (gunicorn "
+        "or uvicorn) on the hot read endpoints. Logs in as the given user and "
+        "cycles through the paths from N client threads for a fixed time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument("--username", required=True)
+        parser.add_argument("--password", required=True)
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+        parser.add_argument("--duration", type=float, default=10.0)
+        parser.add_argument("--paths", nargs="+", default=DEFAULT_PATHS)
+        parser.add_argument(
+            "--bust-cache",
+            action="store_true",
+            help="Make every URL unique so the response cache never answers.",
+        )
+
+    def handle(self, *args, url, username, password, concurrency, duration, paths, bust_cache, **options):
+        target = urlsplit(url)
+        cookie = self._login(target, username, password)
+        self.stdout.write(
+            f"{url}, {len(paths)} paths, {duration:.0f}s per level"
+            + (", cache busted" if bust_cache else "")
+        )
+        self.stdout.write(f"{'clients':>7} {'requests':>9} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>6}")
+        for clients in concurrency:
+            latencies, errors = self._run(target, cookie, paths, clients, duration, bust_cache)
+            n = len(latencies)
+            q = statistics.quantiles(latencies, n=100) if n > 1 else [0.0] * 99
+            self.stdout.write(
+                f"{clients:>7} {n:>9} {n / duration:>8.1f} "
+                f"{q[49] * 1000:>6.1f}ms {q[94] * 1000:>6.1f}ms {q[98] * 1000:>6.1f}ms {errors:>6}"
+            )
+
+    def _connect(self, target):
+        return http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+
+    def _login(self, target, username, password) -> str:
+        conn = self._connect(target)
+        conn.request(
+            "POST",
+            "/api/users/login",
+            body=json.dumps({"username": username, "password": password}),
+            headers={"Content-Type": "application/json"},
+        )
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise CommandError(f"Login failed with {response.status}")
+        cookies = SimpleCookie()
+        for header in response.headers.get_all("Set-Cookie") or []:
+            cookies.load(header)
+        return "; ".join(f"{k}={m.value}" for k, m in cookies.items())
+
+    def _run(self, target, cookie, paths, clients, duration, bust_cache):
+        latencies: list[float] = []
+        errors = 0
+        lock = threading.Lock()
+        counter = itertools.count()
+        deadline = time.monotonic() + duration
+
+        def client(offset):
+            nonlocal errors
+            conn = self._connect(target)
+            mine, failed = [], 0
+            for i in itertools.count(offset):
+                if time.monotonic() >= deadline:
+                    break
+                path = paths[i % len(paths)]
+                if bust_cache:
+                    path += ("&" if "?" in path else "?") + f"_={next(counter)}"
+                start = time.perf_counter()
+                try:
+                    conn.request("GET", path, headers={"Cookie": cookie})
+                    response = conn.getresponse()
+                    response.read()
+                    ok = response.status == 200
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    ok = False
+                elapsed = time.perf_counter() - start
+                if ok:
+                    mine.append(elapsed)
+                else:
+                    failed += 1
+            conn.close()
+            with lock:
+                latencies.extend(mine)
+                errors += failed
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return latencies, errors
@@ -0,0 +1,12 @@
+import redis
+from django.conf import settings
+
+_client: redis.Redis | None = None
+
+
+def get_redis() -> redis.Redis:
+    """Process-wide Redis client for app data (not the Celery broker connection)."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
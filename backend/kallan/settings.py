@@ -30,6 +30,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "ninja",
+    "kallan",
     "users",
     "punishments",
     "push",
@@ -41,6 +42,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "kallan.db_router.ReplicaReadMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -64,6 +66,23 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "kallan.wsgi.application"
 
+# Under ASGI (entrypoint.sh with WEB_SERVER=asgi, or anything serving
+# kallan.asgi) the hot read endpoints are async views; see kallan.async_db.
+ASYNC_VIEWS = os.environ.get("WEB_SERVER", "wsgi") == "asgi"
+
+
+# Each gunicorn worker and each Celery child process keeps its own pool of
+# connections (see kallan.db_pool), so the server's connection budget is
+# split between them; the extra two are the events server and celery beat.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 3))
+CELERY_WORKER_CONCURRENCY = int(os.environ.get("CELERY_CONCURRENCY", os.cpu_count() or 1))
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", 90))
+DB_POOL_MAX_SIZE = int(
+    os.environ.get(
+        "DB_POOL_MAX_SIZE",
+        max(1, min(4, DB_MAX_CONNECTIONS // (WEB_CONCURRENCY + CELERY_WORKER_CONCURRENCY + 2))),
+    )
+)
 
 DATABASES = {
     "default": {
@@ -73,9 +92,36 @@ DATABASES = {
         "PASSWORD": os.environ.get("DB_PASSWORD", "kallan"),
         "HOST": os.environ.get("DB_HOST", "localhost"),
         "PORT": os.environ.get("DB_PORT", "5432"),
+        # checked with a round trip when taken from the pool
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            "pool": {
+                "min_size": 1,
+                "max_size": DB_POOL_MAX_SIZE,
+                # seconds to wait for a free connection before failing
+                "timeout": float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+                # recycle connections now and then, e.g. after a failover
+                "max_lifetime": 30 * 60,
+            },
+        },
     }
 }
 
+# Optional streaming replica for API reads (see kallan.db_router). Pointing
+# DB_REPLICA_HOST at the primary itself works for local testing.
+if os.environ.get("DB_REPLICA_HOST"):
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "OPTIONS": {"pool": {**DATABASES["default"]["OPTIONS"]["pool"]}},
+        "HOST": os.environ["DB_REPLICA_HOST"],
+        "PORT": os.environ.get("DB_REPLICA_PORT", DATABASES["default"]["PORT"]),
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["kallan.db_router.PrimaryReplicaRouter"]
+# How long a client's reads stay on the primary after it wrote something.
+DATABASE_REPLICA_STICKY_SECONDS = int(os.environ.get("DB_REPLICA_STICKY_SECONDS", 10))
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -110,8 +156,60 @@ VAPID_PUBLIC_KEY = os.environ.get("VAPID_PUBLIC_KEY", "")
 VAPID_PRIVATE_KEY = os.environ.get("VAPID_PRIVATE_KEY", "")
 VAPID_SUBJECT = os.environ.get("VAPID_SUBJECT", "mailto:admin@localhost")
 
-CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0")
-CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "kallan",
+    }
+}
+
+# tests run against an in-process fake Redis (requirements-dev.txt)
+TEST_RUNNER = "kallan.test_runner.FakeRedisTestRunner"
+
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", REDIS_URL)
+CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", REDIS_URL)
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
+# Seconds during which further pushes of a type to the same user are merged
+# into one summary (see push.coalesce); 0 sends every push on its own.
+PUSH_COALESCE_WINDOWS = {
+    "punishment_proposed": 60,
+    "punishment_confirmed": 60,
+    "punishment_cancelled": 60,
+    "punishment_taken": 60,
+    "fikapinne_given": 60,
+    "fikapinne_taken": 60,
+}
+# How long notifications are collected for users with digest delivery on.
+PUSH_DIGEST_WINDOW = int(os.environ.get("PUSH_DIGEST_WINDOW", 30 * 60))
+# Pushes in flight at once per fan-out, and seconds to wait for a push
+# service to answer one (see push.services).
+PUSH_CONCURRENCY = int(os.environ.get("PUSH_CONCURRENCY", 16))
+PUSH_TIMEOUT = float(os.environ.get("PUSH_TIMEOUT", 10))
+# Broadcasts to more users than this are split into chunks of this size,
+# delivered in parallel by the Celery workers.
+PUSH_FANOUT_CHUNK_SIZE = int(os.environ.get("PUSH_FANOUT_CHUNK_SIZE", 100))
+# A subscription is deactivated after the push service rejected this many
+# pushes to it in a row (4xx; outages and 5xx don't count), and skipped once
+# its browser hasn't checked in for this many days.
+PUSH_MAX_CONSECUTIVE_FAILURES = int(os.environ.get("PUSH_MAX_CONSECUTIVE_FAILURES", 5))
+PUSH_SUBSCRIPTION_STALE_DAYS = int(os.environ.get("PUSH_SUBSCRIPTION_STALE_DAYS", 90))
+
+CELERY_BEAT_SCHEDULE = {
+    "purge-expired-punishment-events": {
+        "task": "punishments.tasks.purge_expired_punishment_events",
+        "schedule": 60.0,
+    },
+    "ensure-event-partitions": {
+        "task": "punishments.tasks.ensure_event_partitions",
+        "schedule": 24 * 60 * 60.0,
+    },
+    "prune-push-subscriptions": {
+        "task": "push.tasks.prune_push_subscriptions",
+        "schedule": 24 * 60 * 60.0,
+    },
+}
@@ -0,0 +1,45 @@
+"""Test runner that keeps the suite off a live Redis.
+
+App data (``get_redis``), the cache and the Celery broker all point at one
+in-process fakeredis server for the run, so the tests neither need a Redis
+nor see state left behind by an earlier run. Install the test requirements
+first:
+
+    pip install -r requirements-dev.txt
+    python manage.py test
+"""
+
+import fakeredis
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from . import redis_client
+from .celery import app as celery_app
+
+
+class FakeRedisTestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        server = fakeredis.FakeServer()
+        redis_client._client = fakeredis.FakeRedis(server=server)
+        self._fake_cache = override_settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.redis.RedisCache",
+                    "LOCATION": "redis://fakeredis",
+                    "KEY_PREFIX": "kallan",
+                    "OPTIONS": {
+                        "connection_class": fakeredis.FakeConnection,
+                        "server": server,
+                    },
+                }
+            }
+        )
+        self._fake_cache.enable()
+        celery_app.conf.broker_url = "memory://"
+        celery_app.conf.result_backend = "cache+memory://"
+
+    def teardown_test_environment(self, **kwargs):
+        self._fake_cache.disable()
+        redis_client._client = None
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,693 @@
+"""Per-endpoint SQL query and latency budgets.
+
+Seeds a realistically sized ledger and calls every API endpoint once. It
+fails if one runs more queries than its budget, so an N+1 shows up as a red
+test rather than in production. A report is printed at the end:
+
+    python manage.py test kallan
+
+Wall time depends on the machine, so an endpoint over its latency budget is
+only marked with ``!`` in the report; the test fails once it takes more than
+``LATENCY_SLACK`` times its budget, which no machine explains.
+"""
+
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipIf
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from kallan import versioning
+from kallan.async_db import aiter_in_batches, async_when_asgi, gather_db
+from kallan.db_router import (
+    RECENT_WRITE_KEY,
+    REPLICA,
+    STICKY_COOKIE,
+    PrimaryReplicaRouter,
+    ReplicaReadMiddleware,
+)
+from kallan.redis_client import get_redis
+
+from punishments.models import (
+    PENDING_PUNISHMENT_TTL,
+    FikapinneEvent,
+    PunishmentEvent,
+    TakeFikapinneEvent,
+    TakePunishmentEvent,
+)
+from punishments import api as punishments_api
+from punishments.services import rebuild_balances, rebuild_daily_balances
+from push.models import NotificationPreferences, WebPushSubscription
+from users import api as users_api
+
+User = get_user_model()
+
+N_USERS = 50
+N_EVENTS = 2000
+
+# Wall time over this many times an endpoint's latency budget fails the test.
+LATENCY_SLACK = 10
+
+# Not covered: /punishments/stream never ends by design.
+SKIPPED = ("GET /punishments/stream",)
+
+
+def _png() -> io.BytesIO:
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(buf, "PNG")
+    buf.seek(0)
+    buf.name = "a.png"
+    return buf
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}},
+    MEDIA_ROOT=os.path.join(os.environ.get("TMPDIR", "/tmp"), "kallan-test-media"),
+)
+class EndpointBudgetTests(TestCase):
+    """Every endpoint, once, against its query budget; wall time is reported.
+
+    The response cache is disabled so budgets measure the uncached path.
+    """
+
+    report: list[tuple[str, int, int, float, float]] = []
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(42)
+        now = timezone.now()
+
+        staff = Group.objects.create(name="bongskoterskor")
+        staff.permissions.add(
+            Permission.objects.get(codename="direct_punish"),
+            Permission.objects.get(codename="manage_fikapinnar"),
+        )
+
+        tiers = ["vest", "vest", "hat", "bandana"]
+        users = User.objects.bulk_create(
+            [
+                User(
+                    username=f"user{i:02d}",
+                    tier=tiers[i % len(tiers)],
+                    force_password_reset=False,
+                    avatar=f"users/{i}/avatar/a.png" if i % 3 == 0 else None,
+                )
+                for i in range(N_USERS)
+            ]
+        )
+        cls.vest, cls.other_vest, cls.hat = users[0], users[4], users[2]
+        cls.nurse = User.objects.create_user(
+            "nurse", "pw", tier="vest", force_password_reset=False
+        )
+        cls.nurse.groups.add(staff)
+        everyone = users + [cls.nurse]
+
+        events = []
+        for i in range(N_EVENTS):
+            target, initiator, confirmer = rng.sample(users, 3)
+            created = now - timedelta(hours=i)
+            events.append(
+                PunishmentEvent(
+                    target=target,
+                    initiator=initiator,
+                    confirmer=confirmer,
+                    amount=rng.randint(1, 10),
+                    reason="seed",
+                    confirmed_at=created + timedelta(minutes=1),
+                )
+            )
+        PunishmentEvent.objects.bulk_create(events)
+        PunishmentEvent.objects.update(created_at=now - timedelta(days=30))
+
+        takes, fika, fika_takes = [], [], []
+        for _ in range(N_EVENTS // 10):
+            target, judge = rng.sample(users, 2)
+            takes.append(TakePunishmentEvent(target=target, judge=judge, amount=1))
+            fika.append(FikapinneEvent(target=target, judge=cls.nurse))
+            fika.append(FikapinneEvent(target=target, judge=cls.nurse))
+        for target in users[:10]:
+            fika_takes.append(TakeFikapinneEvent(target=target, judge=cls.nurse, amount=3))
+        TakePunishmentEvent.objects.bulk_create(takes)
+        FikapinneEvent.objects.bulk_create(fika)
+        FikapinneEvent.objects.bulk_create(
+            [FikapinneEvent(target=cls.hat, judge=cls.nurse) for _ in range(5)]
+        )
+        TakeFikapinneEvent.objects.bulk_create(fika_takes)
+
+        pending = [
+            PunishmentEvent(
+                target=cls.hat,
+                initiator=cls.other_vest,
+                amount=2,
+                expires_at=now + PENDING_PUNISHMENT_TTL,
+            )
+            for _ in range(10)
+        ]
+        pending.append(
+            PunishmentEvent(
+                target=cls.hat,
+                initiator=cls.vest,
+                amount=1,
+                expires_at=now + PENDING_PUNISHMENT_TTL,
+            )
+        )
+        PunishmentEvent.objects.bulk_create(pending)
+        cls.confirmable_id = pending[0].id
+        cls.deletable_id = pending[-1].id
+
+        WebPushSubscription.objects.bulk_create(
+            [
+                WebPushSubscription(
+                    user=u,
+                    endpoint=f"https://push.example/{u.id}",
+                    p256dh="k",
+                    auth="a",
+                )
+                for u in everyone
+            ]
+        )
+        for u in everyone[:10]:
+            NotificationPreferences.for_user(u)
+
+        rebuild_balances()
+        rebuild_daily_balances()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if not cls.report:
+            return
+        width = max(len(r[0]) for r in cls.report)
+        lines = ["", f"{'endpoint':<{width}}  queries       ms"]
+        for name, queries, max_queries, ms, max_ms in cls.report:
+            over = "!" if ms > max_ms else ""
+            lines.append(
+                f"{name:<{width}}  {queries:>3}/{max_queries:<3}  {ms:>6.1f}/{max_ms:<6.0f}{over}"
+            )
+        lines.append(f"skipped: {', '.join(SKIPPED)}")
+        sys.stderr.write("\n".join(lines) + "\n")
+
+    def assertWithinBudget(self, name, call, max_queries, max_ms=150):
+        """Assert the query budget, and wall time within ``LATENCY_SLACK`` x ``max_ms``."""
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            response = call()
+            if response.streaming:
+                body = b"".join(response.streaming_content)
+            else:
+                body = response.content
+            elapsed = (time.perf_counter() - start) * 1000
+
+        self.report.append((name, len(ctx), max_queries, elapsed, max_ms))
+        self.assertLess(response.status_code, 400, f"{name}: {body[:200]}")
+        sql = "\n".join(q["sql"] for q in ctx.captured_queries)
+        self.assertLessEqual(len(ctx), max_queries, f"{name} ran:\n{sql}")
+        self.assertLess(
+            elapsed, max_ms * LATENCY_SLACK, f"{name} took {elapsed:.0f} ms (budget {max_ms})"
+        )
+
+    def login(self, user):
+        self.client.force_login(user)
+        # warm up URL resolution and schema building outside the budget
+        self.client.get("/api/users/me")
+
+    def test_punishment_endpoints(self):
+        self.login(self.vest)
+        hat, vest = self.hat.id, self.vest.id
+        get, post = self.client.get, self.client.post
+
+        def post_json(path, data):
+            return lambda: post(path, data, content_type="application/json")
+
+        for name, call, max_queries, *max_ms in [
+            ("GET /punishments/events",
+             lambda: get("/api/punishments/events?confirmed=1&limit=200"), 4),
+            ("GET /punishments/events (all)",
+             lambda: get("/api/punishments/events?pending=1&confirmed=1"), 5, 400),
+            ("GET /punishments/events/page",
+             lambda: get(f"/api/punishments/events/page?pending=1&confirmed=1&target_id={hat}"), 5),
+            ("GET /punishments/export",
+             lambda: get("/api/punishments/export?format=ndjson"), 6, 1000),
+            ("GET /punishments/stats", lambda: get("/api/punishments/stats"), 4),
+            ("GET /punishments/stats/history",
+             lambda: get(f"/api/punishments/stats/history?target_id={hat}"), 4),
+            ("GET /punishments/fikapinnar/stats",
+             lambda: get(f"/api/punishments/fikapinnar/stats?target_id={hat}"), 4),
+            ("GET /punishments/leaderboard",
+             lambda: get("/api/punishments/leaderboard?limit=50"), 3),
+            ("POST /punishments/events",
+             post_json("/api/punishments/events", {"target_id": hat, "amount": 1}), 10),
+            ("POST /punishments/events/bulk",
+             post_json(
+                 "/api/punishments/events/bulk",
+                 {"target_ids": [u.id for u in User.objects.exclude(id=vest)[:20]], "amount": 1},
+             ), 9),
+            ("POST /punishments/events/{id}/confirm",
+             lambda: post(f"/api/punishments/events/{self.confirmable_id}/confirm"), 11),
+            ("DELETE /punishments/events/{id}",
+             lambda: self.client.delete(f"/api/punishments/events/{self.deletable_id}"), 6),
+            ("POST /punishments/take",
+             post_json("/api/punishments/take", {"target_id": hat, "amount": 1}), 10),
+        ]:
+            with self.subTest(name):
+                self.assertWithinBudget(name, call, max_queries, *max_ms)
+
+    def test_fikapinne_endpoints(self):
+        self.login(self.nurse)
+        hat = self.hat.id
+
+        for name, path, data, max_queries in [
+            ("POST /punishments/fikapinnar/give",
+             "/api/punishments/fikapinnar/give", {"target_id": hat}, 12),
+            ("POST /punishments/fikapinnar/take",
+             "/api/punishments/fikapinnar/take", {"target_id": hat, "amount": 3}, 11),
+        ]:
+            with self.subTest(name):
+                self.assertWithinBudget(
+                    name,
+                    lambda: self.client.post(path, data, content_type="application/json"),
+                    max_queries,
+                )
+
+    def test_user_endpoints(self):
+        self.login(self.vest)
+        hat = self.hat.id
+        get, post = self.client.get, self.client.post
+
+        for name, call, max_queries in [
+            ("GET /users/me", lambda: get("/api/users/me"), 4),
+            ("GET /users", lambda: get("/api/users/?limit=50"), 5),
+            ("GET /users/{id}", lambda: get(f"/api/users/{hat}"), 3),
+            ("GET /users/{id}/timeline",
+             lambda: get(f"/api/users/{hat}/timeline?limit=200"), 4),
+            ("POST /users/me/avatar",
+             lambda: post("/api/users/me/avatar", {"avatar": _png()}), 5),
+            ("POST /users/csrf", lambda: post("/api/users/csrf"), 0),
+            ("POST /users/set-password",
+             lambda: post("/api/users/set-password", {"new_password": "pw2"},
+                          content_type="application/json"), 12),
+            ("POST /users/logout", lambda: post("/api/users/logout"), 4),
+            ("POST /users/login",
+             lambda: post("/api/users/login", {"username": "nurse", "password": "pw"},
+                          content_type="application/json"), 9),
+        ]:
+            with self.subTest(name):
+                # password hashing is deliberately slow
+                max_ms = 1500 if "password" in name or "login" in name else 150
+                self.assertWithinBudget(name, call, max_queries, max_ms)
+
+    def test_push_endpoints(self):
+        self.login(self.vest)
+        get, post, put = self.client.get, self.client.post, self.client.put
+        sub = {"endpoint": "https://push.example/new", "keys": {"p256dh": "k", "auth": "a"}}
+        prefs = {
+            "punishment_proposed": True,
+            "punishment_confirmed": False,
+            "punishment_cancelled": True,
+            "punishment_taken": True,
+            "fikapinne_given": True,
+            "fikapinne_taken": False,
+        }
+
+        for name, call, max_queries in [
+            ("GET /push/vapid-public-key", lambda: get("/api/push/vapid-public-key"), 2),
+            ("POST /push/subscribe",
+             lambda: post("/api/push/subscribe", sub, content_type="application/json"), 6),
+            ("POST /push/unsubscribe",
+             lambda: post("/api/push/unsubscribe", {"endpoint": sub["endpoint"]},
+                          content_type="application/json"), 3),
+            ("GET /push/notification-prefs", lambda: get("/api/push/notification-prefs"), 3),
+            ("PUT /push/notification-prefs",
+             lambda: put("/api/push/notification-prefs", prefs,
+                         content_type="application/json"), 4),
+        ]:
+            with self.subTest(name):
+                self.assertWithinBudget(name, call, max_queries)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class UserTagInvalidationTests(TestCase):
+    def test_permission_holders_changes_invalidate_users(self):
+        user = User.objects.create_user("perm-user", "pw")
+        group = Group.objects.create(name="perm-group")
+        perm = Permission.objects.get(codename="direct_punish")
+        with (
+            mock.patch("users.signals.invalidate_tags_on_commit") as invalidate,
+            mock.patch("users.signals.bump_ledger_version_on_commit") as bump,
+        ):
+            group.permissions.add(perm)
+            user.groups.add(group)
+            group.user_set.remove(user)
+            user.user_permissions.add(perm)
+            group.delete()
+        # once per change: post_* only, not pre_*
+        self.assertEqual(invalidate.call_count, 5)
+        self.assertEqual(bump.call_count, 5)
+
+
+class IdempotencyKeyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.judge = User.objects.create_user(
+            "judge", "pw", tier="vest", force_password_reset=False
+        )
+        cls.target = User.objects.create_user(
+            "target", "pw", tier="hat", force_password_reset=False
+        )
+
+    def setUp(self):
+        self.client.force_login(self.judge)
+
+    def post(self, key, amount=2):
+        return self.client.post(
+            "/api/punishments/events",
+            {"target_id": self.target.id, "amount": amount},
+            content_type="application/json",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retry_replays_first_response(self):
+        first = self.post("k1")
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.post("k1")
+
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(PunishmentEvent.objects.count(), 1)
+        # only the session and user lookups
+        self.assertLessEqual(len(ctx), 2)
+
+    def test_key_reused_for_other_body(self):
+        self.post("k2")
+        self.assertEqual(self.post("k2", amount=3).status_code, 422)
+        self.assertEqual(PunishmentEvent.objects.count(), 1)
+
+    def test_distinct_keys_and_no_key_are_independent(self):
+        self.post("k3")
+        self.post("k4")
+        self.client.post(
+            "/api/punishments/events",
+            {"target_id": self.target.id, "amount": 2},
+            content_type="application/json",
+        )
+        self.assertEqual(PunishmentEvent.objects.count(), 3)
+
+
+@override_settings(
+    MEDIA_ROOT=os.path.join(os.environ.get("TMPDIR", "/tmp"), "kallan-test-media"),
+)
+class IdempotentUploadTests(TestCase):
+    def test_upload_over_data_upload_limit(self):
+        user = User.objects.create_user("uploader", "pw", force_password_reset=False)
+        self.client.force_login(user)
+        size = settings.DATA_UPLOAD_MAX_MEMORY_SIZE + 1024
+
+        def upload(content):
+            return self.client.post(
+                "/api/users/me/avatar",
+                {"avatar": SimpleUploadedFile("a.png", content, "image/png")},
+                HTTP_IDEMPOTENCY_KEY="avatar-1",
+            )
+
+        first = upload(b"\0" * size)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(upload(b"\0" * size)["Idempotent-Replayed"], "true")
+        self.assertEqual(upload(b"\1" * size).status_code, 422)
+
+
+@mock.patch("kallan.db_router.replica_configured", return_value=True)
+class ReplicaRoutingTests(SimpleTestCase):
+    databases = {"default"}
+
+    def setUp(self):
+        get_redis().delete(RECENT_WRITE_KEY)
+
+    def route(self, method, path, cookies=None, status=200, atomic=False, during=None):
+        """Run a request through the middleware; return (read alias, response)."""
+        seen = []
+
+        def view(request):
+            if atomic:
+                with transaction.atomic():
+                    seen.append(PrimaryReplicaRouter().db_for_read(User))
+            else:
+                seen.append(PrimaryReplicaRouter().db_for_read(User))
+            if during:
+                during()
+            response = HttpResponse(status=status)
+            response["ETag"] = 'W/"1-abc"'
+            return response
+
+        request = RequestFactory().generic(method, path)
+        request.COOKIES.update(cookies or {})
+        response = ReplicaReadMiddleware(view)(request)
+        return seen[0], response
+
+    def test_api_get_reads_from_replica(self, _):
+        alias, response = self.route("GET", "/api/punishments/events")
+        self.assertEqual(alias, REPLICA)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        # outside the request everything is back on the primary
+        self.assertIsNone(PrimaryReplicaRouter().db_for_read(User))
+
+    def test_write_pins_client_to_primary(self, _):
+        alias, response = self.route("POST", "/api/punishments/events", status=201)
+        self.assertIsNone(alias)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+        alias, _ = self.route(
+            "GET", "/api/punishments/events", cookies={STICKY_COOKIE: "1"}
+        )
+        self.assertIsNone(alias)
+
+    def test_failed_write_does_not_pin(self, _):
+        _, response = self.route("POST", "/api/punishments/events", status=400)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    def test_non_api_and_transactions_stay_on_primary(self, _):
+        self.assertIsNone(self.route("GET", "/admin/")[0])
+        self.assertIsNone(self.route("GET", "/api/users/me", atomic=True)[0])
+
+    @override_settings(DATABASE_REPLICA_STICKY_SECONDS=10)
+    def test_reads_stay_on_primary_after_a_version_bump(self, _):
+        versioning.bump_ledger_version()
+        self.assertLessEqual(get_redis().ttl(RECENT_WRITE_KEY), 10)
+        alias, response = self.route("GET", "/api/punishments/events")
+        self.assertIsNone(alias)
+        self.assertIn("ETag", response)
+
+    def test_replica_read_racing_a_write_gets_no_etag(self, _):
+        alias, response = self.route(
+            "GET", "/api/punishments/events", during=versioning.bump_ledger_version
+        )
+        self.assertEqual(alias, REPLICA)
+        self.assertNotIn("ETag", response)
+        _, response = self.route("GET", "/admin/", during=versioning.bump_ledger_version)
+        self.assertIn("ETag", response)
+
+
+class ReplicaEndToEndTests(TransactionTestCase):
+    # not TestCase: its wrapping transaction keeps every read on the primary
+    databases = {"default", REPLICA} if REPLICA in connections.settings else {"default"}
+
+    def setUp(self):
+        if REPLICA not in connections.settings:
+            self.skipTest("no replica alias configured (set DB_REPLICA_HOST)")
+        self.user = User.objects.create_user(
+            "reader", "pw", tier="vest", force_password_reset=False
+        )
+        self.client.force_login(self.user)
+        # creating the user is a write that keeps reads on the primary a while
+        get_redis().delete(RECENT_WRITE_KEY)
+
+    def tearDown(self):
+        # the mirror's pool would keep the test database from being dropped
+        connections[REPLICA].close_pool()
+
+    def test_get_runs_on_replica(self):
+        with CaptureQueriesContext(connections[REPLICA]) as replica_queries:
+            response = self.client.get("/api/users/me")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["username"], "reader")
+        self.assertGreater(len(replica_queries), 0)
+
+    def test_reads_after_write_stay_on_primary(self):
+        prefs = dict.fromkeys(
+            [
+                "punishment_proposed",
+                "punishment_confirmed",
+                "punishment_cancelled",
+                "punishment_taken",
+                "fikapinne_given",
+                "fikapinne_taken",
+            ],
+            True,
+        )
+        response = self.client.put(
+            "/api/push/notification-prefs",
+            {**prefs, "digest": True},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        with CaptureQueriesContext(connections[REPLICA]) as replica_queries:
+            response = self.client.get("/api/push/notification-prefs")
+        self.assertTrue(response.json()["digest"])
+        self.assertEqual(len(replica_queries), 0)
+
+
+class AsyncReadViewTests(TestCase):
+    """The async views served under ASGI answer exactly like the sync ones."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.me, target, nurse = (
+            User.objects.create_user(name, "pw", tier=tier, force_password_reset=False)
+            for name, tier in [("me", "vest"), ("target", "hat"), ("nurse", "vest")]
+        )
+        nurse.user_permissions.add(Permission.objects.get(codename="direct_punish"))
+        PunishmentEvent.objects.create(
+            target=target, initiator=cls.me, confirmer=nurse, amount=3,
+            confirmed_at=timezone.now(),
+        )
+        PunishmentEvent.objects.create(target=cls.me, initiator=target, amount=1)
+        FikapinneEvent.objects.create(target=cls.me, judge=nurse)
+        rebuild_balances()
+
+    def request(self):
+        request = RequestFactory().get("/api/")
+        request.user = request.auth = self.me
+        return request
+
+    def body(self, result):
+        if isinstance(result, HttpResponse):
+            return json.loads(result.content)
+        return result
+
+    @skipIf(settings.ASYNC_VIEWS, "only the async views are registered")
+    def test_async_variants_match(self):
+        for sync_view, async_view, params in [
+            (punishments_api.list_events, punishments_api._async_list_events,
+             {"pending": 1, "confirmed": 1}),
+            (punishments_api.punishment_stats, punishments_api._async_punishment_stats, {}),
+            (punishments_api.fikapinne_stats, punishments_api._async_fikapinne_stats, {}),
+            (users_api.list_users, users_api._async_list_users, {}),
+            (users_api.me, users_api._async_me, {}),
+        ]:
+            with self.subTest(sync_view.__name__):
+                expected = self.body(sync_view(self.request(), **params))
+                actual = self.body(async_to_sync(async_view)(self.request(), **params))
+                self.assertTrue(expected)
+                self.assertEqual(actual, expected)
+
+    def test_async_view_only_under_asgi(self):
+        async def async_view(request):
+            pass
+
+        def view(request):
+            pass
+
+        with override_settings(ASYNC_VIEWS=False):
+            self.assertIs(async_when_asgi(async_view)(view), view)
+        with override_settings(ASYNC_VIEWS=True):
+            chosen = async_when_asgi(async_view)(view)
+        self.assertIs(chosen, async_view)
+        self.assertEqual(chosen.__name__, "view")
+
+    def test_etag_computed_off_the_event_loop(self):
+        def version():
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return 7
+
+        async def view(request):
+            return HttpResponse()
+
+        # what decorate_view does to a ninja operation
+        operation = SimpleNamespace(run=view)
+        versioning.etag_by_ledger_version(SimpleNamespace(_ninja_operation=operation))
+        with mock.patch.object(versioning, "ledger_version", side_effect=version) as read:
+            response = async_to_sync(operation.run)(self.request())
+        read.assert_called_once()
+        self.assertTrue(response["ETag"].startswith('W/"7-'))
+
+    def test_streams_without_buffering_under_asgi(self):
+        async def read(response):
+            return b"".join([chunk async for chunk in response])
+
+        for view, params in [
+            (users_api.user_timeline, {"user_id": self.me.id}),
+            (punishments_api.export_history, {"format": "ndjson"}),
+        ]:
+            with self.subTest(view.__name__):
+                expected = b"".join(view(self.request(), **params))
+                with override_settings(ASYNC_VIEWS=True):
+                    response = view(self.request(), **params)
+                self.assertTrue(response.is_async)
+                self.assertEqual(async_to_sync(read)(response), expected)
+
+    def test_stream_read_in_batches(self):
+        produced = []
+
+        def rows():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        async def first_two():
+            stream = aiter_in_batches(rows(), size=3)
+            items = [await anext(stream), await anext(stream)]
+            await stream.aclose()
+            return items
+
+        self.assertEqual(async_to_sync(first_two)(), [0, 1])
+        self.assertEqual(produced, [0, 1, 2])
+
+
+class GatherDbTests(TransactionTestCase):
+    """gather_db outside a transaction, as in production: one connection each."""
+
+    def test_calls_overlap_on_connections_of_their_own(self):
+        User.objects.create_user("someone", "pw", force_password_reset=False)
+        # both calls must be in flight at once to get past the barrier
+        barrier = threading.Barrier(2, timeout=10)
+
+        def call():
+            barrier.wait()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_backend_pid()")
+                pid = cursor.fetchone()[0]
+            return pid, User.objects.count()
+
+        self.assertIsNotNone(connection.connection)
+        first, second = async_to_sync(gather_db)((call,), (call,))
+        self.assertEqual((first[1], second[1]), (1, 1))
+        self.assertNotEqual(first[0], second[0])
+        # the request's own connection was handed back before the fan-out
+        self.assertIsNone(connection.connection)
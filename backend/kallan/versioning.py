@@ -0,0 +1,116 @@
+"""Ledger version counter and ETag support for read endpoints.
+
+A single Redis integer is bumped after every committed write to the ledger
+models or to users. Read endpoints decorated with ``etag_by_ledger_version``
+derive a weak ETag from it, so a revalidation that finds nothing changed is
+answered with ``304 Not Modified`` before the view runs.
+"""
+
+import functools
+import hashlib
+import logging
+import time
+
+import redis
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.db import transaction
+from django.utils import timezone
+from django.views.decorators.http import condition
+from ninja.decorators import decorate_view
+
+from .async_db import resolve_user
+from .db_router import mark_recent_write
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+LEDGER_VERSION_KEY = "kallan:ledger-version"
+
+
+def _seed_version(client) -> None:
+    # Start from the clock rather than 0, so a Redis flush can never reissue a
+    # version (and an ETag) that a client already holds for older data.
+    client.set(LEDGER_VERSION_KEY, time.time_ns() // 1000, nx=True)
+
+
+def ledger_version() -> int | None:
+    try:
+        client = get_redis()
+        value = client.get(LEDGER_VERSION_KEY)
+        if value is None:
+            _seed_version(client)
+            value = client.get(LEDGER_VERSION_KEY)
+    except redis.RedisError:
+        logger.warning("Could not read ledger version", exc_info=True)
+        return None
+    return int(value)
+
+
+def bump_ledger_version() -> None:
+    try:
+        pipe = get_redis().pipeline()
+        # before the new version is visible, so no read under it hits a
+        # replica that may not have the write yet
+        mark_recent_write(pipe)
+        _seed_version(pipe)
+        pipe.incr(LEDGER_VERSION_KEY)
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not bump ledger version", exc_info=True)
+
+
+def bump_ledger_version_on_commit() -> None:
+    transaction.on_commit(bump_ledger_version)
+
+
+def ledger_etag(request, vary=None) -> str | None:
+    user = getattr(request, "user", None)
+    if not user or not user.is_authenticated:
+        return None
+
+    version = ledger_version()
+    if version is None:
+        return None
+
+    # same version can still render differently per user, query and host
+    parts = [
+        request.get_host(),
+        request.get_full_path(),
+        str(user.pk),
+        # week and month windows roll over at midnight without any write
+        timezone.localdate().isoformat(),
+    ]
+    if vary is not None:
+        parts.append(vary(request))
+    digest = hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+    return f'W/"{version}-{digest}"'
+
+
+def etag_by_ledger_version_and(vary):
+    """``etag_by_ledger_version`` for a view whose output also changes without
+    a write; ``vary(request)`` returns a string that changes along with it."""
+
+    def etag_func(request, *args, **kwargs):
+        if hasattr(request, "_ledger_etag"):
+            return request._ledger_etag
+        return ledger_etag(request, vary=vary)
+
+    def etag_off_loop(run):
+        # condition() calls its etag_func inline, and ledger_etag() reads
+        # request.user and does a blocking Redis round trip; an async view gets
+        # it computed on a thread beforehand, like cached_response's lookup
+        if not iscoroutinefunction(run):
+            return run
+
+        @functools.wraps(run)
+        async def wrapper(request, *args, **kwargs):
+            await resolve_user(request)
+            request._ledger_etag = await sync_to_async(ledger_etag)(request, vary=vary)
+            return await run(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorate_view(condition(etag_func=etag_func), etag_off_loop)
+
+
+etag_by_ledger_version = etag_by_ledger_version_and(None)
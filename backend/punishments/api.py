@@ -1,23 +1,41 @@
-from datetime import datetime, timedelta
-from typing import Optional
+import base64
+from datetime import date, datetime, timedelta
+from typing import Literal, Optional
 
 from django.contrib.auth import get_user_model
 from django.db import IntegrityError, transaction
-from django.db.models import Q, Sum
-from django.http import HttpResponse
+from django.db.models import Min, Q
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from ninja import Router, Schema
 from ninja.errors import HttpError
+from kallan.async_db import async_when_asgi, gather_db, streaming_content
+from kallan.cache import (
+    TAG_FIKAPINNAR,
+    TAG_PUNISHMENTS,
+    TAG_USERS,
+    cached_response,
+    invalidate_tags_on_commit,
+)
+from kallan.idempotency import idempotent
+from kallan.renderers import json_response
+from kallan.versioning import (
+    bump_ledger_version_on_commit,
+    etag_by_ledger_version,
+    etag_by_ledger_version_and,
+)
 from push.tasks import send_push_to_user_task, send_push_to_users_task
-from .tasks import expire_punishment_event
 from pydantic import Field
 
+from . import export, leaderboards, live, services
 from .models import (
+    PENDING_PUNISHMENT_TTL,
     FikapinneEvent,
     PunishmentEvent,
     TakeFikapinneEvent,
     TakePunishmentEvent,
+    event_stage,
 )
 
 User = get_user_model()
@@ -42,7 +60,7 @@ class PunishmentEventOut(Schema):
 
     created_at: datetime
     confirmed_at: Optional[datetime]
-    stage: str  # "pending"
+    stage: str  # "pending" | "confirmed" | "expired"
 
 
 class CreatePunishmentEventIn(Schema):
@@ -104,6 +122,99 @@ def _event_out(e: PunishmentEvent) -> dict:
     }
 
 
+_EVENT_FIELDS = (
+    "id",
+    "target_id",
+    "initiator_id",
+    "confirmer_id",
+    "reason",
+    "amount",
+    "created_at",
+    "confirmed_at",
+    "is_direct",
+    "expires_at",
+)
+
+
+_USER_MINI_FIELDS = ("id", "username", "avatar", "tier")
+
+
+def _mini_from_row(row: dict, storage) -> dict:
+    avatar_url = None
+    try:
+        if row["avatar"]:
+            avatar_url = storage.url(row["avatar"])
+    except Exception:
+        avatar_url = None
+    return {
+        "id": row["id"],
+        "username": row["username"],
+        "avatar_url": avatar_url,
+        "tier": row["tier"] or "bandana",
+    }
+
+
+def _user_minis(user_ids) -> dict[int, dict]:
+    """``_user_mini`` for many users at once, from a single column-only query."""
+    storage = User._meta.get_field("avatar").storage
+    return {
+        row["id"]: _mini_from_row(row, storage)
+        for row in User.objects.filter(id__in=set(user_ids)).values(*_USER_MINI_FIELDS)
+    }
+
+
+async def _auser_minis(user_ids) -> dict[int, dict]:
+    storage = User._meta.get_field("avatar").storage
+    return {
+        row["id"]: _mini_from_row(row, storage)
+        async for row in User.objects.filter(id__in=set(user_ids)).values(
+            *_USER_MINI_FIELDS
+        )
+    }
+
+
+def _event_user_ids(rows) -> set[int]:
+    return {
+        uid
+        for r in rows
+        for uid in (r["target_id"], r["initiator_id"], r["confirmer_id"])
+        if uid is not None
+    }
+
+
+def _serialize_events(rows, users: dict[int, dict]) -> list[dict]:
+    return [
+        {
+            "id": r["id"],
+            "target": users[r["target_id"]],
+            "initiator": users[r["initiator_id"]],
+            "confirmer": users.get(r["confirmer_id"]),
+            "reason": r["reason"] or "",
+            "amount": r["amount"],
+            "created_at": r["created_at"],
+            "confirmed_at": r["confirmed_at"],
+            "stage": event_stage(r["confirmer_id"], r["is_direct"], r["expires_at"]),
+        }
+        for r in rows
+    ]
+
+
+def _event_rows(qs) -> list[dict]:
+    """Serialize a PunishmentEvent queryset without building model instances.
+
+    Only the event columns are selected; each distinct user is resolved once
+    for the whole response instead of once per foreign key per row.
+    """
+    rows = list(qs.values(*_EVENT_FIELDS))
+    return _serialize_events(rows, _user_minis(_event_user_ids(rows)))
+
+
+async def _aevent_rows(qs) -> list[dict]:
+    """``_event_rows`` with the async ORM."""
+    rows = [r async for r in qs.values(*_EVENT_FIELDS)]
+    return _serialize_events(rows, await _auser_minis(_event_user_ids(rows)))
+
+
 def _take_out(t: TakePunishmentEvent) -> dict:
     return {
         "id": t.id,
@@ -115,6 +226,7 @@ def _take_out(t: TakePunishmentEvent) -> dict:
 
 
 @router.post("/events", response={201: PunishmentEventOut})
+@idempotent
 def create_event(request, payload: CreatePunishmentEventIn):
     initiator = request.user
 
@@ -130,14 +242,18 @@ def create_event(request, payload: CreatePunishmentEventIn):
     is_direct = initiator.has_perm("punishments.direct_punish")
 
     try:
-        e = PunishmentEvent.objects.create(
-            target=target,
-            initiator=initiator,
-            reason=payload.reason or "",
-            amount=payload.amount,
-            is_direct=is_direct,
-            confirmed_at=timezone.now() if is_direct else None,
-        )
+        with transaction.atomic():
+            e = PunishmentEvent.objects.create(
+                target=target,
+                initiator=initiator,
+                reason=payload.reason or "",
+                amount=payload.amount,
+                is_direct=is_direct,
+                confirmed_at=timezone.now() if is_direct else None,
+                expires_at=None if is_direct else timezone.now() + PENDING_PUNISHMENT_TTL,
+            )
+            if is_direct:
+                services.record_punishment_delivered(target.id, e.amount)
     except IntegrityError:
         raise HttpError(400, "Invalid punishment (constraint violation).")
 
@@ -152,7 +268,6 @@ def create_event(request, payload: CreatePunishmentEventIn):
         .values_list("id", flat=True)
     )
     _target_id = target.id
-    _event_id = e.id
 
     # pre-compute everything needed for notifications before on_commit
     if is_direct:
@@ -183,9 +298,9 @@ def create_event(request, payload: CreatePunishmentEventIn):
         def _schedule():
             send_push_to_user_task.delay(_target_id, payload_target, "punishment_proposed")
             send_push_to_users_task.delay(others_ids, payload_others, "punishment_proposed")
-            expire_punishment_event.apply_async(args=[_event_id], countdown=300)
 
     transaction.on_commit(_schedule)
+    live.publish_on_commit("punishment_created", ids=[e.id], target_ids=[_target_id])
 
     e = PunishmentEvent.objects.select_related("target", "initiator", "confirmer").get(
         pk=e.pk
@@ -194,7 +309,175 @@ def create_event(request, payload: CreatePunishmentEventIn):
     return 201, _event_out(e)
 
 
+class BulkCreatePunishmentEventsIn(Schema):
+    target_ids: list[int] = Field(min_length=1, max_length=50)
+    amount: int = Field(ge=1, le=10)
+    reason: str = Field("", max_length=50)
+
+
+def _join_names(names: list[str]) -> str:
+    if len(names) <= 1:
+        return "".join(names)
+    return ", ".join(names[:-1]) + " och " + names[-1]
+
+
+@router.post("/events/bulk", response={201: list[PunishmentEventOut]})
+@idempotent
+def create_events_bulk(request, payload: BulkCreatePunishmentEventsIn):
+    """Punish several targets with the same amount and reason in one go.
+
+    Targets get one push between them and everyone else a single summary,
+    instead of two fan-outs per target.
+    """
+    initiator = request.user
+
+    target_ids = list(dict.fromkeys(payload.target_ids))
+    if initiator.id in target_ids:
+        raise HttpError(400, "You cannot punish yourself.")
+
+    initiator_tier = getattr(initiator, "tier", None) or "bandana"
+    if initiator_tier == "bandana":
+        raise HttpError(403, "Bandanas cannot give punishments.")
+
+    targets = User.objects.in_bulk(target_ids)
+    if len(targets) != len(target_ids):
+        raise HttpError(404, "Not Found")
+
+    is_direct = initiator.has_perm("punishments.direct_punish")
+    reason = payload.reason or ""
+    now = timezone.now()
+
+    try:
+        with transaction.atomic():
+            events = PunishmentEvent.objects.bulk_create(
+                [
+                    PunishmentEvent(
+                        target=targets[tid],
+                        initiator=initiator,
+                        reason=reason,
+                        amount=payload.amount,
+                        is_direct=is_direct,
+                        confirmed_at=now if is_direct else None,
+                        expires_at=None if is_direct else now + PENDING_PUNISHMENT_TTL,
+                    )
+                    for tid in target_ids
+                ]
+            )
+            if is_direct:
+                services.record_punishments_delivered(target_ids, payload.amount)
+            # bulk_create sends no post_save signals
+            bump_ledger_version_on_commit()
+            invalidate_tags_on_commit(TAG_PUNISHMENTS)
+    except IntegrityError:
+        raise HttpError(400, "Invalid punishment (constraint violation).")
+
+    amount = payload.amount
+    reason = reason.strip()
+    names = _join_names([targets[tid].username for tid in target_ids])
+
+    others_ids = list(
+        User.objects.filter(is_active=True)
+        .exclude(id=initiator.id)
+        .exclude(id__in=target_ids)
+        .values_list("id", flat=True)
+    )
+
+    body_t = f"Antal: {amount}"
+    if reason:
+        body_t += f" Anledning: {reason}"
+
+    if is_direct:
+        notification_type = "punishment_confirmed"
+        payload_target = {"title": "Bongsköterskan gav dig straff!", "body": body_t, "url": "/punishments"}
+        body_o = f"Bongsköterskan gav {names} +{amount} straff."
+        title_o = "Bongsköterskan gav straff"
+    else:
+        notification_type = "punishment_proposed"
+        payload_target = {"title": f"{initiator.username} vill ge dig straff!", "body": body_t, "url": "/punishments"}
+        body_o = f"{initiator.username} vill ge {names} +{amount} straff."
+        title_o = "Nytt straff-förslag"
+    if reason:
+        body_o += f" Anledning: {reason}"
+    payload_others = {"title": title_o, "body": body_o, "url": "/punishments"}
+
+    def _schedule():
+        send_push_to_users_task.delay(target_ids, payload_target, notification_type)
+        send_push_to_users_task.delay(others_ids, payload_others, notification_type)
+
+    transaction.on_commit(_schedule)
+    live.publish_on_commit(
+        "punishment_created", ids=[e.id for e in events], target_ids=target_ids
+    )
+
+    return 201, [_event_out(e) for e in events]
+
+
+def _filtered_events(pending: int, confirmed: int, target_id: int | None):
+    qs = PunishmentEvent.objects.order_by("-created_at", "-id")
+
+    if target_id is not None:
+        qs = qs.filter(target_id=target_id)
+
+    if pending == 1 and confirmed == 1:
+        return qs.unexpired()
+    if pending == 1:
+        return qs.pending()
+    if confirmed == 1:
+        return qs.delivered()
+
+    raise HttpError(400, "Set pending=1 or confirmed=1 (or both).")
+
+
+def _next_expiry(request) -> str:
+    """When the next pending proposal lapses, for lists that show proposals.
+
+    A lapsed proposal drops out of them right away, but nothing is written
+    until the sweep deletes it, so no version moves; keying ETags and cached
+    responses on this makes them change at that moment instead.
+    """
+    if request.GET.get("pending") != "1":
+        return ""
+    if not hasattr(request, "_next_expiry"):
+        nxt = PunishmentEvent.objects.pending().aggregate(nxt=Min("expires_at"))["nxt"]
+        request._next_expiry = nxt.isoformat() if nxt else ""
+    return request._next_expiry
+
+
+def _encode_cursor(row: dict) -> str:
+    raw = f"{row['created_at'].isoformat()}|{row['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, event_id = raw.split("|")
+        created_at, event_id = datetime.fromisoformat(created_at), int(event_id)
+        # ids are positive bigints
+        if not 0 < event_id < 2**63:
+            raise ValueError(event_id)
+        return created_at, event_id
+    except (ValueError, UnicodeDecodeError):
+        raise HttpError(400, "INVALID_CURSOR")
+
+
+async def _async_list_events(
+    request,
+    pending: int = 0,
+    confirmed: int = 0,
+    limit: int | None = None,
+    target_id: int | None = None,
+):
+    qs = _filtered_events(pending, confirmed, target_id)
+    if limit is not None:
+        qs = qs[:limit]
+    return json_response(await _aevent_rows(qs))
+
+
 @router.get("/events", response=list[PunishmentEventOut])
+@etag_by_ledger_version_and(_next_expiry)
+@cached_response(TAG_PUNISHMENTS, TAG_USERS, timeout=60, vary=_next_expiry)
+@async_when_asgi(_async_list_events)
 def list_events(
     request,
     pending: int = 0,
@@ -202,35 +485,79 @@ def list_events(
     limit: int | None = None,
     target_id: int | None = None,
 ):
-    qs = PunishmentEvent.objects.select_related(
-        "target", "initiator", "confirmer"
-    ).order_by("-created_at")
+    qs = _filtered_events(pending, confirmed, target_id)
+    if limit is not None:
+        qs = qs[:limit]
+    return json_response(_event_rows(qs))
 
-    if target_id is not None:
-        qs = qs.filter(target_id=target_id)
 
-    if pending == 1 and confirmed == 1:
-        if limit is not None:
-            qs = qs[:limit]
-        return [_event_out(e) for e in qs]
+class PunishmentEventPageOut(Schema):
+    items: list[PunishmentEventOut]
+    next_cursor: Optional[str]
 
-    if pending == 1:
-        qs = qs.pending()
-        if limit is not None:
-            qs = qs[:limit]
-        return [_event_out(e) for e in qs]
 
-    if confirmed == 1:
-        qs = qs.delivered()
-        if limit is not None:
-            qs = qs[:limit]
+@router.get("/events/page", response=PunishmentEventPageOut)
+@etag_by_ledger_version_and(_next_expiry)
+@cached_response(TAG_PUNISHMENTS, TAG_USERS, timeout=60, vary=_next_expiry)
+def list_events_page(
+    request,
+    pending: int = 0,
+    confirmed: int = 0,
+    limit: int = 50,
+    target_id: int | None = None,
+    cursor: str | None = None,
+):
+    """Keyset-paginated events, newest first.
 
-        return [_event_out(e) for e in qs]
+    Pass the returned ``next_cursor`` back as ``cursor`` to get the following
+    page; it is ``null`` on the last page.
+    """
+    if limit < 1 or limit > 100:
+        raise HttpError(400, "INVALID_LIMIT")
 
-    raise HttpError(400, "Set pending=1 or confirmed=1 (or both).")
+    qs = _filtered_events(pending, confirmed, target_id)
+
+    if cursor:
+        created_at, event_id = _decode_cursor(cursor)
+        qs = qs.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=event_id)
+        )
+
+    events = _event_rows(qs[: limit + 1])
+    next_cursor = _encode_cursor(events[limit - 1]) if len(events) > limit else None
+
+    return json_response({"items": events[:limit], "next_cursor": next_cursor})
+
+
+@router.get("/stream")
+async def ledger_stream(request):
+    """Server-Sent Events feed of ledger changes (create, confirm, delete,
+    expire, take, fikapinne). Only meaningful when served over ASGI.
+    """
+    response = StreamingHttpResponse(
+        live.sse_stream(), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@router.get("/export")
+def export_history(request, format: Literal["csv", "ndjson"] = "csv"):
+    """Full punishment and fikapinne history, streamed row by row."""
+    response = StreamingHttpResponse(
+        streaming_content(export.iter_export(format)), content_type=export.FORMATS[format]
+    )
+    stamp = timezone.localdate().isoformat()
+    response["Content-Disposition"] = (
+        f'attachment; filename="kallan-history-{stamp}.{format}"'
+    )
+    response["X-Accel-Buffering"] = "no"
+    return response
 
 
 @router.post("/events/{event_id}/confirm", response={200: PunishmentEventOut})
+@idempotent
 def confirm_event(request, event_id: int):
     confirmer = request.user
 
@@ -253,9 +580,12 @@ def confirm_event(request, event_id: int):
         if not e:
             raise HttpError(404, "Punishment event not found.")
 
-        if e.confirmer_id is not None:
+        if e.confirmer_id is not None or e.is_direct:
             raise HttpError(400, "This punishment is already confirmed.")
 
+        if e.is_expired:
+            raise HttpError(404, "Punishment event not found.")
+
         if e.target_id == confirmer.id:
             raise HttpError(403, "Target cannot confirm their own punishment.")
         if e.initiator_id == confirmer.id:
@@ -277,6 +607,7 @@ def confirm_event(request, event_id: int):
         e.confirmer = confirmer
         e.confirmed_at = timezone.now()
         e.save(update_fields=["confirmer", "confirmed_at"])
+        services.record_punishment_delivered(e.target_id, e.amount)
 
         # capture values for the closure (safe after commit)
         target = e.target
@@ -304,6 +635,7 @@ def confirm_event(request, event_id: int):
             send_push_to_user_task.delay(_initiator_id, _payload_initiator, "punishment_confirmed")
 
         transaction.on_commit(_schedule)
+        live.publish_on_commit("punishment_confirmed", ids=[e.id], target_ids=[_target_id])
 
     # fetch full output (including confirmer) AFTER the transaction
     e = PunishmentEvent.objects.select_related("target", "initiator", "confirmer").get(
@@ -313,6 +645,7 @@ def confirm_event(request, event_id: int):
 
 
 @router.delete("/events/{event_id}", response={204: None})
+@idempotent
 def delete_event(request, event_id: int):
     me = request.user
 
@@ -327,9 +660,12 @@ def delete_event(request, event_id: int):
             raise HttpError(404, "Punishment event not found.")
 
         # Only pending can be deleted
-        if e.confirmer_id is not None:
+        if e.confirmer_id is not None or e.is_direct:
             raise HttpError(400, "Cannot delete a confirmed punishment.")
 
+        if e.is_expired:
+            raise HttpError(404, "Punishment event not found.")
+
         # Only initiator can delete
         if e.initiator_id != me.id:
             raise HttpError(403, "Only the initiator can delete this punishment.")
@@ -351,56 +687,89 @@ def delete_event(request, event_id: int):
         transaction.on_commit(
             lambda: send_push_to_user_task.delay(_target_id, _payload, "punishment_cancelled")
         )
+        live.publish_on_commit("punishment_deleted", ids=[event_id], target_ids=[_target_id])
 
     return 204, None
 
 
+async def _async_punishment_stats(request, target_id: int | None = None):
+    if target_id is None:
+        target_id = request.auth.id
+
+    # the two aggregates don't depend on each other
+    week_start, next_week_start = services.window_bounds("week", timezone.localdate())
+    week, balance = await gather_db(
+        (services.window_totals, target_id, week_start, next_week_start),
+        (services.get_balance, target_id),
+    )
+
+    return {
+        "target_id": target_id,
+        "total_amount": balance.punishment_count,
+        "week_amount": week["punishments_delivered"],
+    }
+
+
 @router.get("/stats", response=PunishmentStatsOut)
+@etag_by_ledger_version
+@cached_response(TAG_PUNISHMENTS)
+@async_when_asgi(_async_punishment_stats)
 def punishment_stats(request, target_id: int | None = None):
     if target_id is None:
         if not request.user or not request.user.is_authenticated:
             raise HttpError(401, "Not authenticated.")
         target_id = request.user.id
 
-    tz = timezone.get_current_timezone()
-    today = timezone.localdate()
-    week_start = today - timedelta(days=today.weekday())  # Monday
-    next_week_start = week_start + timedelta(days=7)
+    week_start, next_week_start = services.window_bounds("week", timezone.localdate())
+    week = services.window_totals(target_id, week_start, next_week_start)
+    balance = services.get_balance(target_id)
 
-    week_start_dt = timezone.make_aware(
-        datetime.combine(week_start, datetime.min.time()), tz
-    )
-    next_week_start_dt = timezone.make_aware(
-        datetime.combine(next_week_start, datetime.min.time()), tz
-    )
+    return {
+        "target_id": target_id,
+        "total_amount": balance.punishment_count,
+        "week_amount": week["punishments_delivered"],
+    }
 
-    delivered = PunishmentEvent.objects.delivered().filter(
-        target_id=target_id,
-    )
 
-    delivered_total = delivered.aggregate(s=Sum("amount"))["s"] or 0
-    delivered_week = (
-        delivered.filter(
-            confirmed_at__gte=week_start_dt,
-            confirmed_at__lt=next_week_start_dt,
-        ).aggregate(s=Sum("amount"))["s"]
-        or 0
-    )
+HISTORY_MAX_DAYS = 366
 
-    taken = TakePunishmentEvent.objects.filter(target_id=target_id)
 
-    taken_total = taken.aggregate(s=Sum("amount"))["s"] or 0
+class DailyHistoryOut(Schema):
+    day: date
+    punishments_delivered: int
+    punishments_taken: int
+    fikapinnar_given: int
+    fikapinnar_taken: int
+    punishment_balance: int
+    fikapinne_balance: int
 
-    total_amount = max(0, int(delivered_total) - int(taken_total))
 
-    return {
-        "target_id": target_id,
-        "total_amount": total_amount,
-        "week_amount": int(delivered_week),
-    }
+@router.get("/stats/history", response=list[DailyHistoryOut])
+@etag_by_ledger_version
+@cached_response(TAG_PUNISHMENTS, TAG_FIKAPINNAR)
+def stats_history(
+    request,
+    target_id: int | None = None,
+    start: date | None = None,
+    end: date | None = None,
+):
+    """One row per day: that day's deltas and the balances at the end of it.
+
+    Defaults to the last 30 days for the current user.
+    """
+    if target_id is None:
+        target_id = request.user.id
+
+    end = end or timezone.localdate()
+    start = start or end - timedelta(days=29)
+    if start > end or (end - start).days >= HISTORY_MAX_DAYS:
+        raise HttpError(400, "INVALID_RANGE")
+
+    return services.daily_history(target_id, start, end)
 
 
 @router.post("/take", response={201: TakePunishmentOut})
+@idempotent
 def take_punishment(request, payload: TakePunishmentIn):
     judge = request.user
 
@@ -411,27 +780,12 @@ def take_punishment(request, payload: TakePunishmentIn):
     if payload.target_id == judge.id:
         raise HttpError(400, "Judge cannot take punishments from themselves.")
 
-    with transaction.atomic():
-        target = get_object_or_404(
-            User.objects.select_for_update(), pk=payload.target_id
-        )
-
-        delivered_total = (
-            PunishmentEvent.objects.delivered().filter(
-                target=target
-            ).aggregate(s=Sum("amount"))["s"]
-            or 0
-        )
-
-        taken_total = (
-            TakePunishmentEvent.objects.filter(target=target).aggregate(
-                s=Sum("amount")
-            )["s"]
-            or 0
-        )
+    target = get_object_or_404(User, pk=payload.target_id)
 
-        available = int(delivered_total) - int(taken_total)
-        if payload.amount > available:
+    with transaction.atomic():
+        # conditional decrement on the balance row; no need to lock the user
+        if not services.try_take_punishments(target.id, payload.amount):
+            available = services.get_balance(target.id).punishment_count
             raise HttpError(
                 400, f"Inte tillräckligt många straff kvar, antal kvar: {available}"
             )
@@ -455,6 +809,7 @@ def take_punishment(request, payload: TakePunishmentIn):
         transaction.on_commit(
             lambda: send_push_to_user_task.delay(_target_id, _payload, "punishment_taken")
         )
+        live.publish_on_commit("punishment_taken", ids=[t.id], target_ids=[_target_id])
 
     t = TakePunishmentEvent.objects.select_related("target", "judge").get(pk=t.pk)
     return 201, _take_out(t)
@@ -479,6 +834,7 @@ def _require_manage_fikapinnar(request) -> User:
 
 
 @router.post("/fikapinnar/give")
+@idempotent
 def give_fikapinne(request, payload: GiveFikapinneIn):
     judge = _require_manage_fikapinnar(request)
 
@@ -487,10 +843,12 @@ def give_fikapinne(request, payload: GiveFikapinneIn):
 
     target = get_object_or_404(User, pk=payload.target_id)
 
-    FikapinneEvent.objects.create(
-        target=target,
-        judge=judge,
-    )
+    with transaction.atomic():
+        FikapinneEvent.objects.create(
+            target=target,
+            judge=judge,
+        )
+        services.record_fikapinne_given(target.id)
 
     judge_username = judge.username
 
@@ -504,11 +862,13 @@ def give_fikapinne(request, payload: GiveFikapinneIn):
     transaction.on_commit(
         lambda: send_push_to_user_task.delay(_target_id, _payload, "fikapinne_given")
     )
+    live.publish_on_commit("fikapinne_given", target_ids=[_target_id])
 
     return HttpResponse(status=201)
 
 
 @router.post("/fikapinnar/take")
+@idempotent
 def take_fikapinnar(request, payload: TakeFikapinneIn):
     judge = _require_manage_fikapinnar(request)
 
@@ -520,21 +880,16 @@ def take_fikapinnar(request, payload: TakeFikapinneIn):
 
     target = get_object_or_404(User, pk=payload.target_id)
 
-    given_total = FikapinneEvent.objects.filter(target=target).count()
-    taken_total = (
-        TakeFikapinneEvent.objects.filter(target=target).aggregate(s=Sum("amount"))["s"]
-        or 0
-    )
-    current_total = max(0, int(given_total) - int(taken_total))
-
-    if payload.amount > current_total:
-        raise HttpError(400, f"Inte tillräckligt många fikapinnar ({current_total})")
+    with transaction.atomic():
+        if not services.try_take_fikapinnar(target.id, payload.amount):
+            current_total = services.get_balance(target.id).fikapinne_count
+            raise HttpError(400, f"Inte tillräckligt många fikapinnar ({current_total})")
 
-    TakeFikapinneEvent.objects.create(
-        target=target,
-        judge=judge,
-        amount=payload.amount,
-    )
+        TakeFikapinneEvent.objects.create(
+            target=target,
+            judge=judge,
+            amount=payload.amount,
+        )
 
     judge_username = judge.username
 
@@ -549,6 +904,7 @@ def take_fikapinnar(request, payload: TakeFikapinneIn):
     transaction.on_commit(
         lambda: send_push_to_user_task.delay(_target_id, _payload, "fikapinne_taken")
     )
+    live.publish_on_commit("fikapinne_taken", target_ids=[_target_id])
 
     return HttpResponse(status=201)
 
@@ -559,46 +915,91 @@ class FikapinneStatsOut(Schema):
     month_amount: int
 
 
+async def _async_fikapinne_stats(request, target_id: int | None = None):
+    if target_id is None:
+        target_id = request.auth.id
+
+    month_start, next_month_start = services.window_bounds("month", timezone.localdate())
+    month, balance = await gather_db(
+        (services.window_totals, target_id, month_start, next_month_start),
+        (services.get_balance, target_id),
+    )
+
+    return {
+        "target_id": target_id,
+        "total_amount": balance.fikapinne_count,
+        "month_amount": month["fikapinnar_given"],
+    }
+
+
 @router.get("/fikapinnar/stats", response=FikapinneStatsOut)
+@etag_by_ledger_version
+@cached_response(TAG_FIKAPINNAR)
+@async_when_asgi(_async_fikapinne_stats)
 def fikapinne_stats(request, target_id: int | None = None):
     if target_id is None:
         if not request.user or not request.user.is_authenticated:
             raise HttpError(401, "Not authenticated.")
         target_id = request.user.id
 
-    tz = timezone.get_current_timezone()
-    today = timezone.localdate()
+    # month_amount = given this month only (no subtract)
+    month_start, next_month_start = services.window_bounds("month", timezone.localdate())
+    month = services.window_totals(target_id, month_start, next_month_start)
+    balance = services.get_balance(target_id)
 
-    # month boundaries: first day of this month -> first day of next month
-    month_start = today.replace(day=1)
-    if month_start.month == 12:
-        next_month_start = month_start.replace(year=month_start.year + 1, month=1)
-    else:
-        next_month_start = month_start.replace(month=month_start.month + 1)
+    return {
+        "target_id": target_id,
+        "total_amount": balance.fikapinne_count,
+        "month_amount": month["fikapinnar_given"],
+    }
 
-    month_start_dt = timezone.make_aware(
-        datetime.combine(month_start, datetime.min.time()), tz
-    )
-    next_month_start_dt = timezone.make_aware(
-        datetime.combine(next_month_start, datetime.min.time()), tz
-    )
 
-    given = FikapinneEvent.objects.filter(target_id=target_id)
-    taken = TakeFikapinneEvent.objects.filter(target_id=target_id)
+class LeaderboardEntryOut(Schema):
+    rank: int
+    user: UserMiniOut
+    score: int
 
-    given_total = given.count()
-    taken_total = taken.aggregate(s=Sum("amount"))["s"] or 0
 
-    # month_amount = given this month only (no subtract)
-    month_amount = given.filter(
-        created_at__gte=month_start_dt,
-        created_at__lt=next_month_start_dt,
-    ).count()
+class LeaderboardRankOut(Schema):
+    rank: int
+    score: int
+
+
+class LeaderboardOut(Schema):
+    board: str
+    period: str
+    entries: list[LeaderboardEntryOut]
+    me: Optional[LeaderboardRankOut]
+
 
-    total_amount = max(0, int(given_total) - int(taken_total))
+@router.get("/leaderboard", response=LeaderboardOut)
+def leaderboard(
+    request,
+    board: Literal["punishments", "fikapinnar"] = "punishments",
+    period: Literal["all", "week", "month"] = "all",
+    limit: int = 10,
+):
+    """Top users by balance (all) or by amount received this week/month.
+
+    Rankings come straight from the Redis sorted sets; only the listed users'
+    names are read from the database.
+    """
+    if limit < 1 or limit > 50:
+        raise HttpError(400, "INVALID_LIMIT")
+
+    top = leaderboards.top(board, period, limit)
+    users = User.objects.in_bulk([uid for uid, _ in top])
+
+    entries = [
+        {"rank": i, "user": _user_mini(users[uid]), "score": score}
+        for i, (uid, score) in enumerate(top, start=1)
+        if uid in users
+    ]
+    mine = leaderboards.rank_of(board, period, request.user.id)
 
     return {
-        "target_id": target_id,
-        "total_amount": total_amount,
-        "month_amount": int(month_amount),
+        "board": board,
+        "period": period,
+        "entries": entries,
+        "me": {"rank": mine[0], "score": mine[1]} if mine else None,
     }
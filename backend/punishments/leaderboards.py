@@ -0,0 +1,146 @@
+"""Redis sorted-set leaderboards for punishments and fikapinnar.
+
+There is one sorted set per board and period: all-time (current balance),
+the current ISO week and the current month (amount delivered or given in
+that window, takes not subtracted). Sets are bumped from
+``punishments.services`` after each commit and can be rebuilt from the
+database with ``manage.py rebuild_leaderboards``.
+"""
+
+import logging
+from datetime import date, timedelta
+
+import redis
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from kallan.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+BOARDS = ("punishments", "fikapinnar")
+PERIODS = ("all", "week", "month")
+
+# Period sets are only read while current; keep them a little past that.
+_PERIOD_TTL = {"week": timedelta(days=8), "month": timedelta(days=32)}
+
+# balance field -> (board, periods it counts towards, sign)
+_FIELD_EFFECTS = {
+    "punishments_delivered": ("punishments", PERIODS, 1),
+    "punishments_taken": ("punishments", ("all",), -1),
+    "fikapinnar_given": ("fikapinnar", PERIODS, 1),
+    "fikapinnar_taken": ("fikapinnar", ("all",), -1),
+}
+
+
+def board_key(board: str, period: str, day: date | None = None) -> str:
+    day = day or timezone.localdate()
+    if period == "week":
+        iso = day.isocalendar()
+        return f"lb:{board}:week:{iso.year}-W{iso.week:02d}"
+    if period == "month":
+        return f"lb:{board}:month:{day:%Y-%m}"
+    return f"lb:{board}:all"
+
+
+def record(user_ids, field: str, delta: int) -> None:
+    board, periods, sign = _FIELD_EFFECTS[field]
+    day = timezone.localdate()
+    try:
+        pipe = get_redis().pipeline()
+        for period in periods:
+            key = board_key(board, period, day)
+            for uid in user_ids:
+                pipe.zincrby(key, sign * delta, uid)
+            if period in _PERIOD_TTL:
+                pipe.expire(key, _PERIOD_TTL[period])
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not update leaderboards for %s", field, exc_info=True)
+
+
+def record_on_commit(user_ids, field: str, delta: int) -> None:
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: record(user_ids, field, delta))
+
+
+# board -> (UserBalance fields giving the all-time score, DailyBalance field
+# giving the week and month scores)
+_DB_FIELDS = {
+    "punishments": (("punishments_delivered", "punishments_taken"), "punishments_delivered"),
+    "fikapinnar": (("fikapinnar_given", "fikapinnar_taken"), "fikapinnar_given"),
+}
+
+
+def _db_scores(board: str, period: str, day: date) -> dict[int, int]:
+    """The board's positive scores computed from the balance tables."""
+    from .models import DailyBalance, UserBalance
+    from .services import window_bounds
+
+    (plus, minus), windowed = _DB_FIELDS[board]
+    if period == "all":
+        rows = UserBalance.objects.annotate(score=F(plus) - F(minus))
+    else:
+        start, end = window_bounds(period, day)
+        rows = (
+            DailyBalance.objects.filter(day__gte=start, day__lt=end)
+            .values("user_id")
+            .annotate(score=Sum(windowed))
+        )
+    return dict(rows.filter(score__gt=0).values_list("user_id", "score"))
+
+
+def _ranked(scores: dict[int, int]) -> list[tuple[int, int]]:
+    # ZREVRANGE's order: ties broken by the member string, descending
+    return sorted(scores.items(), key=lambda item: (item[1], str(item[0])), reverse=True)
+
+
+def top(board: str, period: str, limit: int) -> list[tuple[int, int]]:
+    """Highest (user_id, score) pairs, skipping users at zero."""
+    try:
+        rows = get_redis().zrevrangebyscore(
+            board_key(board, period), "+inf", "(0", start=0, num=limit, withscores=True
+        )
+    except redis.RedisError:
+        logger.warning("Leaderboard unavailable, ranking from the database", exc_info=True)
+        return _ranked(_db_scores(board, period, timezone.localdate()))[:limit]
+    return [(int(uid), int(score)) for uid, score in rows]
+
+
+def rank_of(board: str, period: str, user_id: int) -> tuple[int, int] | None:
+    """1-based (rank, score) for a user, or None if they aren't on the board."""
+    key = board_key(board, period)
+    try:
+        pipe = get_redis().pipeline()
+        pipe.zrevrank(key, user_id)
+        pipe.zscore(key, user_id)
+        rank, score = pipe.execute()
+    except redis.RedisError:
+        logger.warning("Leaderboard unavailable, ranking from the database", exc_info=True)
+        ranked = _ranked(_db_scores(board, period, timezone.localdate()))
+        for rank, (uid, score) in enumerate(ranked, start=1):
+            if uid == user_id:
+                return rank, score
+        return None
+    if rank is None or not score or score <= 0:
+        return None
+    return rank + 1, int(score)
+
+
+def rebuild() -> int:
+    """Rebuild the current sets from the balance tables. Returns members written."""
+    today = timezone.localdate()
+    pipe = get_redis().pipeline()
+    written = 0
+    for board in BOARDS:
+        for period in PERIODS:
+            key = board_key(board, period, today)
+            members = _db_scores(board, period, today)
+            pipe.delete(key)
+            if members:
+                pipe.zadd(key, members)
+                written += len(members)
+            if period in _PERIOD_TTL:
+                pipe.expire(key, _PERIOD_TTL[period])
+    pipe.execute()
+    return written
@@ -0,0 +1,63 @@
+"""Live ledger updates over Redis pub/sub.
+
+Write paths call ``publish_on_commit`` next to their push notifications; the
+SSE view in ``punishments.api`` relays everything published on
+``LEDGER_CHANNEL`` to connected browsers. Delivery is best-effort: a Redis
+hiccup must never fail a write.
+"""
+
+import json
+import logging
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.db import transaction
+from kallan.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+LEDGER_CHANNEL = "kallan:ledger"
+
+# Comment line sent when the channel has been quiet, so proxies keep the
+# connection open and dead clients are noticed.
+HEARTBEAT_SECONDS = 15
+
+
+def publish(kind: str, **data) -> None:
+    message = json.dumps({"type": kind, **data})
+    try:
+        get_redis().publish(LEDGER_CHANNEL, message)
+    except redis.RedisError:
+        logger.warning("Could not publish ledger event %s", kind, exc_info=True)
+
+
+def publish_on_commit(kind: str, **data) -> None:
+    transaction.on_commit(lambda: publish(kind, **data))
+
+
+def _sse(kind: str, data: str) -> str:
+    return f"event: {kind}\ndata: {data}\n\n"
+
+
+async def sse_stream():
+    """Yield Server-Sent Events for every ledger message until the client leaves."""
+    client = aioredis.Redis.from_url(settings.REDIS_URL)
+    pubsub = client.pubsub()
+    await pubsub.subscribe(LEDGER_CHANNEL)
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            message = await pubsub.get_message(timeout=HEARTBEAT_SECONDS)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+            if message["type"] != "message":
+                continue  # the subscribe confirmation, not a quiet channel
+            data = message["data"].decode()
+            kind = json.loads(data).get("type", "message")
+            yield _sse(kind, data)
+    finally:
+        await pubsub.unsubscribe(LEDGER_CHANNEL)
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from punishments.partitions import KEEP_MONTHS, archive_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold event table partitions older than a cutoff into per-user "
+        "archived balances and detach them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep-months",
+            type=int,
+            default=KEEP_MONTHS,
+            help=f"Months of events to keep in the live tables (default {KEEP_MONTHS}).",
+        )
+        parser.add_argument(
+            "--drop",
+            action="store_true",
+            help="Drop archived partitions instead of leaving them as plain tables.",
+        )
+
+    def handle(self, *args, **options):
+        archived = archive_partitions(options["keep_months"], drop=options["drop"])
+        for name in archived:
+            self.stdout.write(f"  {name}")
+        self.stdout.write(self.style.SUCCESS(f"Archived {len(archived)} partitions."))
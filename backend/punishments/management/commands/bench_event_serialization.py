@@ -0,0 +1,96 @@
+import json
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kallan.renderers import json_response
+from ninja.responses import NinjaJSONEncoder
+from pydantic import TypeAdapter
+
+from punishments.api import PunishmentEventOut, _event_out, _event_rows
+from punishments.models import PunishmentEvent
+
+User = get_user_model()
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the old (select_related + _event_out + json) and new "
+        "(values + user map + orjson, no re-validation) list_events "
+        "serialization paths. "
+        "Seeds its own data and rolls it back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+        parser.add_argument("--users", type=int, default=30)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, sizes, users, repeat, **options):
+        try:
+            with transaction.atomic():
+                self._run(sizes, users, repeat)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _run(self, sizes, n_users, repeat):
+        rng = random.Random(0)
+        people = User.objects.bulk_create(
+            [
+                User(
+                    username=f"bench{i}",
+                    tier=rng.choice(["vest", "hat", "bandana"]),
+                    avatar=f"users/{i}/avatar/a.png" if i % 2 else None,
+                )
+                for i in range(n_users)
+            ]
+        )
+        PunishmentEvent.objects.bulk_create(
+            [
+                PunishmentEvent(
+                    target=t,
+                    initiator=i,
+                    confirmer=c if rng.random() < 0.8 else None,
+                    amount=rng.randint(1, 10),
+                    reason="bench",
+                )
+                for t, i, c in (rng.sample(people, 3) for _ in range(max(sizes)))
+            ],
+            batch_size=2000,
+        )
+
+        adapter = TypeAdapter(list[PunishmentEventOut])
+        qs = PunishmentEvent.objects.filter(target__in=people).order_by(
+            "-created_at", "-id"
+        )
+
+        def old(n):
+            events = qs.select_related("target", "initiator", "confirmer")[:n]
+            data = adapter.dump_python(adapter.validate_python([_event_out(e) for e in events]))
+            return json.dumps(data, cls=NinjaJSONEncoder)
+
+        def new(n):
+            return json_response(_event_rows(qs[:n])).content
+
+        for n in sizes:
+            results = {}
+            for name, fn in (("old", old), ("new", new)):
+                best = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    body = fn(n)
+                    best = min(best, time.perf_counter() - start)
+                results[name] = (best, len(body))
+            (t_old, b_old), (t_new, b_new) = results["old"], results["new"]
+            self.stdout.write(
+                f"{n:>6} events: old {t_old * 1000:8.1f} ms ({b_old} B)  "
+                f"new {t_new * 1000:8.1f} ms ({b_new} B)  "
+                f"x{t_old / t_new:.1f}"
+            )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from punishments.partitions import MONTHS_AHEAD, ensure_partitions
+
+
+class Command(BaseCommand):
+    help = "Create the monthly event table partitions for the coming months."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=MONTHS_AHEAD,
+            help=f"How many months past the current one to cover (default {MONTHS_AHEAD}).",
+        )
+
+    def handle(self, *args, **options):
+        created = ensure_partitions(options["months_ahead"])
+        for name in created:
+            self.stdout.write(f"  {name}")
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions."))
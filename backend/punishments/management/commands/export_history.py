@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from punishments.export import FORMATS, iter_export
+
+
+class Command(BaseCommand):
+    help = "Stream the full punishment and fikapinne history as CSV or NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+        parser.add_argument("--output", "-o", help="File to write to (default: stdout).")
+
+    def handle(self, *args, **options):
+        chunks = iter_export(options["format"])
+        if not options["output"]:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+            return
+
+        with open(options["output"], "w", encoding="utf-8", newline="") as out:
+            for chunk in chunks:
+                out.write(chunk)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}."))
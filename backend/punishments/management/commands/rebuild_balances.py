@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from punishments.services import rebuild_balances, rebuild_daily_balances
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute every user's punishment and fikapinne balance and daily "
+        "buckets from the event tables."
+    )
+
+    def handle(self, *args, **options):
+        n = rebuild_balances()
+        days = rebuild_daily_balances()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {n} balances and {days} daily buckets."))
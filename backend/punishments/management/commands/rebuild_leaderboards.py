@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from punishments.leaderboards import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Redis punishment and fikapinne leaderboards from the database."
+
+    def handle(self, *args, **options):
+        n = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Wrote {n} leaderboard entries."))
@@ -0,0 +1,62 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_balances(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    PunishmentEvent = apps.get_model("punishments", "PunishmentEvent")
+    TakePunishmentEvent = apps.get_model("punishments", "TakePunishmentEvent")
+    FikapinneEvent = apps.get_model("punishments", "FikapinneEvent")
+    TakeFikapinneEvent = apps.get_model("punishments", "TakeFikapinneEvent")
+    UserBalance = apps.get_model("punishments", "UserBalance")
+
+    def totals(qs, agg):
+        return dict(
+            qs.values("target_id").annotate(t=agg).values_list("target_id", "t")
+        )
+
+    delivered = totals(
+        PunishmentEvent.objects.filter(Q(confirmer__isnull=False) | Q(is_direct=True)),
+        Sum("amount"),
+    )
+    taken = totals(TakePunishmentEvent.objects.all(), Sum("amount"))
+    given_fika = totals(FikapinneEvent.objects.all(), Count("id"))
+    taken_fika = totals(TakeFikapinneEvent.objects.all(), Sum("amount"))
+
+    UserBalance.objects.bulk_create(
+        [
+            UserBalance(
+                user_id=uid,
+                punishments_delivered=delivered.get(uid) or 0,
+                punishments_taken=taken.get(uid) or 0,
+                fikapinnar_given=given_fika.get(uid) or 0,
+                fikapinnar_taken=taken_fika.get(uid) or 0,
+            )
+            for uid in User.objects.values_list("id", flat=True)
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('punishments', '0008_punishmentevent_is_direct_direct_punish_permission'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBalance',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('punishments_delivered', models.PositiveIntegerField(default=0)),
+                ('punishments_taken', models.PositiveIntegerField(default=0)),
+                ('fikapinnar_given', models.PositiveIntegerField(default=0)),
+                ('fikapinnar_taken', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
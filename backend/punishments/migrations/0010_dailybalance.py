@@ -0,0 +1,78 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+def backfill_daily_balances(apps, schema_editor):
+    PunishmentEvent = apps.get_model("punishments", "PunishmentEvent")
+    TakePunishmentEvent = apps.get_model("punishments", "TakePunishmentEvent")
+    FikapinneEvent = apps.get_model("punishments", "FikapinneEvent")
+    TakeFikapinneEvent = apps.get_model("punishments", "TakeFikapinneEvent")
+    DailyBalance = apps.get_model("punishments", "DailyBalance")
+
+    tz = timezone.get_current_timezone()
+
+    def totals(qs, date_field, agg):
+        return (
+            qs.annotate(day=TruncDate(date_field, tzinfo=tz))
+            .values("target_id", "day")
+            .annotate(t=agg)
+            .values_list("target_id", "day", "t")
+        )
+
+    sources = {
+        "punishments_delivered": totals(
+            PunishmentEvent.objects.filter(
+                Q(confirmer__isnull=False) | Q(is_direct=True)
+            ),
+            "confirmed_at",
+            Sum("amount"),
+        ),
+        "punishments_taken": totals(
+            TakePunishmentEvent.objects.all(), "created_at", Sum("amount")
+        ),
+        "fikapinnar_given": totals(FikapinneEvent.objects.all(), "created_at", Count("id")),
+        "fikapinnar_taken": totals(
+            TakeFikapinneEvent.objects.all(), "created_at", Sum("amount")
+        ),
+    }
+
+    rows = {}
+    for field, values in sources.items():
+        for user_id, day, total in values:
+            if day is None:
+                continue
+            row = rows.setdefault((user_id, day), DailyBalance(user_id=user_id, day=day))
+            setattr(row, field, total or 0)
+
+    DailyBalance.objects.bulk_create(rows.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('punishments', '0009_userbalance'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('punishments_delivered', models.PositiveIntegerField(default=0)),
+                ('punishments_taken', models.PositiveIntegerField(default=0)),
+                ('fikapinnar_given', models.PositiveIntegerField(default=0)),
+                ('fikapinnar_taken', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_balances', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day'), name='db_user_day_unique')],
+            },
+        ),
+        migrations.RunPython(backfill_daily_balances, migrations.RunPython.noop),
+    ]
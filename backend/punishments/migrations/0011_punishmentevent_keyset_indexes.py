@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('punishments', '0010_dailybalance'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='punishmentevent',
+            index=models.Index(fields=['-created_at', '-id'], name='pe_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='punishmentevent',
+            index=models.Index(fields=['target', '-created_at', '-id'], name='pe_target_created_id_idx'),
+        ),
+    ]
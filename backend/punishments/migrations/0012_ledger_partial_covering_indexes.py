@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('punishments', '0011_punishmentevent_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='punishmentevent',
+            index=models.Index(condition=models.Q(('confirmer__isnull', True), ('is_direct', False)), fields=['-created_at'], name='pe_pending_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='punishmentevent',
+            index=models.Index(condition=models.Q(('confirmer__isnull', False), ('is_direct', True), _connector='OR'), fields=['target'], include=('amount', 'confirmed_at'), name='pe_delivered_target_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='takefikapinneevent',
+            index=models.Index(fields=['target'], include=('amount',), name='tfe_target_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='takepunishmentevent',
+            index=models.Index(fields=['target'], include=('amount',), name='pte_target_amount_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_expires_at(apps, schema_editor):
+    PunishmentEvent = apps.get_model("punishments", "PunishmentEvent")
+    PunishmentEvent.objects.filter(confirmer__isnull=True, is_direct=False).update(
+        expires_at=F("created_at") + timedelta(minutes=5)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('punishments', '0012_ledger_partial_covering_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='punishmentevent',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_expires_at, migrations.RunPython.noop),
+    ]
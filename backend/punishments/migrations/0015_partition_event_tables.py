@@ -0,0 +1,114 @@
+"""Turn the four event tables into tables range-partitioned by created_at month.
+
+Postgres only; other databases keep plain tables. Each table is rebuilt:
+a partitioned copy is created with the same columns, defaults and checks,
+monthly partitions are added from the oldest row up to three months ahead
+(plus a DEFAULT partition as a safety net), rows are copied over, and the
+foreign keys and indexes are recreated under their original names.
+
+The primary key becomes (id, created_at), as Postgres requires the partition
+key in every unique constraint; ids still come from one sequence per table
+and stay unique. Nothing references these tables, so no foreign key needs
+the old single-column key.
+"""
+
+from datetime import date
+
+from django.db import migrations
+
+TABLES = (
+    "punishments_punishmentevent",
+    "punishments_takepunishmentevent",
+    "punishments_fikapinneevent",
+    "punishments_takefikapinneevent",
+)
+
+MONTHS_AHEAD = 3
+
+
+def _next_month(d: date) -> date:
+    return date(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+def _partition(cursor, table: str) -> None:
+    new = f"{table}__part"
+    seq = f"{table}__part_id_seq"
+
+    cursor.execute(
+        """
+        SELECT indexname, indexdef FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = %s
+          AND indexname <> %s
+        """,
+        [table, f"{table}_pkey"],
+    )
+    indexes = cursor.fetchall()
+    cursor.execute(
+        """
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+        """,
+        [table],
+    )
+    foreign_keys = cursor.fetchall()
+
+    cursor.execute(
+        f"""
+        CREATE TABLE {new} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE (created_at)
+        """
+    )
+    cursor.execute(f"CREATE SEQUENCE {seq} OWNED BY {new}.id")
+    cursor.execute(f"ALTER TABLE {new} ALTER COLUMN id SET DEFAULT nextval('{seq}')")
+    cursor.execute(f"ALTER TABLE {new} ADD PRIMARY KEY (id, created_at)")
+
+    cursor.execute(f"SELECT min(created_at)::date FROM {table}")
+    oldest = cursor.fetchone()[0] or date.today()
+    month = oldest.replace(day=1)
+    last = date.today().replace(day=1)
+    for _ in range(MONTHS_AHEAD):
+        last = _next_month(last)
+    while month <= last:
+        nxt = _next_month(month)
+        cursor.execute(
+            f"""
+            CREATE TABLE {table}_p{month:%Y_%m} PARTITION OF {new}
+            FOR VALUES FROM ('{month.isoformat()} 00:00+00') TO ('{nxt.isoformat()} 00:00+00')
+            """
+        )
+        month = nxt
+    cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {new} DEFAULT")
+
+    cursor.execute(f"INSERT INTO {new} SELECT * FROM {table}")
+    cursor.execute(f"SELECT setval('{seq}', COALESCE((SELECT max(id) FROM {new}), 0) + 1, false)")
+
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {new} RENAME TO {table}")
+    cursor.execute(f"ALTER SEQUENCE {seq} RENAME TO {table}_id_seq")
+    cursor.execute(f"ALTER INDEX {new}_pkey RENAME TO {table}_pkey")
+
+    for name, definition in foreign_keys:
+        cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+    for _, definition in indexes:
+        cursor.execute(definition)
+
+
+def partition_event_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in TABLES:
+            _partition(cursor, table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("punishments", "0014_archivedbalance"),
+    ]
+
+    operations = [
+        # Partitioned tables work the same for the ORM; there is no way back
+        # short of a dump and reload, so unapplying leaves them as they are.
+        migrations.RunPython(partition_event_tables, migrations.RunPython.noop),
+    ]
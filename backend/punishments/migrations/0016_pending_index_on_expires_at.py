@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('punishments', '0015_partition_event_tables'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='punishmentevent',
+            name='pe_pending_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='punishmentevent',
+            index=models.Index(condition=models.Q(('confirmer__isnull', True), ('is_direct', False)), fields=['expires_at'], name='pe_pending_expires_idx'),
+        ),
+    ]
@@ -1,17 +1,39 @@
+from datetime import timedelta
+
 from django.contrib.auth import get_user_model
 from django.db import models, transaction
 from django.db.models import F, Q, Sum
+from django.db.models.functions import Now
 from django.utils import timezone
 
 User = get_user_model()
 
+# How long a proposed punishment waits for a confirmer before it lapses.
+PENDING_PUNISHMENT_TTL = timedelta(minutes=5)
+
+
+def event_stage(confirmer_id, is_direct: bool, expires_at) -> str:
+    if confirmer_id is not None or is_direct:
+        return "confirmed"
+    if expires_at is not None and expires_at <= timezone.now():
+        return "expired"
+    return "pending"
+
 
 class PunishmentEventQuerySet(models.QuerySet):
     def delivered(self):
         return self.filter(Q(confirmer__isnull=False) | Q(is_direct=True))
 
     def pending(self):
-        return self.filter(confirmer__isnull=True, is_direct=False)
+        return self.filter(confirmer__isnull=True, is_direct=False, expires_at__gt=Now())
+
+    def expired(self):
+        return self.filter(confirmer__isnull=True, is_direct=False, expires_at__lte=Now())
+
+    def unexpired(self):
+        """Delivered and pending events; lapsed proposals drop out right away,
+        before the sweep gets to delete them."""
+        return self.exclude(confirmer__isnull=True, is_direct=False, expires_at__lte=Now())
 
     def for_target(self, user):
         return self.filter(target=user)
@@ -44,6 +66,8 @@ class PunishmentEvent(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
     confirmed_at = models.DateTimeField(null=True, blank=True)
+    # only set for proposals; past this point they no longer count as pending
+    expires_at = models.DateTimeField(null=True, blank=True)
 
     objects = PunishmentEventQuerySet.as_manager()
 
@@ -51,6 +75,28 @@ class PunishmentEvent(models.Model):
         permissions = [
             ("direct_punish", "Can give punishments without a confirmer"),
         ]
+        indexes = [
+            # keyset pagination over (created_at, id), see api.list_events_page
+            models.Index(fields=["-created_at", "-id"], name="pe_created_id_idx"),
+            models.Index(
+                fields=["target", "-created_at", "-id"], name="pe_target_created_id_idx"
+            ),
+            # partial index for pending() and expired(): proposals are few and
+            # lapse within minutes, so keying on expires_at makes both a short
+            # range scan
+            models.Index(
+                fields=["expires_at"],
+                condition=Q(confirmer__isnull=True, is_direct=False),
+                name="pe_pending_expires_idx",
+            ),
+            # covering index for per-target Sum("amount") over delivered()
+            models.Index(
+                fields=["target"],
+                include=["amount", "confirmed_at"],
+                condition=Q(confirmer__isnull=False) | Q(is_direct=True),
+                name="pe_delivered_target_idx",
+            ),
+        ]
         constraints = [
             models.CheckConstraint(
                 condition=~Q(initiator=F("target")), name="pe_initiator_not_target"
@@ -65,9 +111,18 @@ class PunishmentEvent(models.Model):
             ),
         ]
 
+    @property
+    def is_expired(self) -> bool:
+        return (
+            self.confirmer_id is None
+            and not self.is_direct
+            and self.expires_at is not None
+            and self.expires_at <= timezone.now()
+        )
+
     @property
     def stage(self) -> str:
-        return "pending" if (self.confirmer_id is None and not self.is_direct) else "confirmed"
+        return event_stage(self.confirmer_id, self.is_direct, self.expires_at)
 
     def confirm(self, user):
         if user.pk in {self.initiator_id, self.target_id}:
@@ -75,11 +130,18 @@ class PunishmentEvent(models.Model):
 
         # race-safe confirm (optional but nice)
         with transaction.atomic():
-            updated = PunishmentEvent.objects.filter(
-                pk=self.pk, confirmer__isnull=True
+            updated = PunishmentEvent.objects.pending().filter(
+                pk=self.pk
             ).update(confirmer=user, confirmed_at=timezone.now())
             if updated == 0:
                 raise ValueError("Already confirmed.")
+            # both import this module
+            from .services import record_punishment_delivered
+            from .signals import ledger_changed
+
+            record_punishment_delivered(self.target_id, self.amount)
+            # update() sends no post_save
+            ledger_changed(PunishmentEvent)
             self.confirmer_id = user.pk
             self.confirmed_at = timezone.now()
 
@@ -96,6 +158,11 @@ class TakePunishmentEvent(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
+        indexes = [
+            models.Index(
+                fields=["target"], include=["amount"], name="pte_target_amount_idx"
+            ),
+        ]
         constraints = [
             models.CheckConstraint(
                 condition=~Q(judge=F("target")),
@@ -138,6 +205,11 @@ class TakeFikapinneEvent(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
+        indexes = [
+            models.Index(
+                fields=["target"], include=["amount"], name="tfe_target_amount_idx"
+            ),
+        ]
         constraints = [
             models.CheckConstraint(
                 condition=~Q(judge=F("target")),
@@ -147,3 +219,88 @@ class TakeFikapinneEvent(models.Model):
 
     def __str__(self) -> str:
         return f"TakeFikapinne({self.target_id}, -{self.amount})"
+
+
+class UserBalance(models.Model):
+    """Running ledger totals per user, kept in step with the event tables.
+
+    Rows are updated in the same transaction as the event they reflect (see
+    ``punishments.services``) and can be recomputed with
+    ``manage.py rebuild_balances``.
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="balance"
+    )
+
+    punishments_delivered = models.PositiveIntegerField(default=0)
+    punishments_taken = models.PositiveIntegerField(default=0)
+    fikapinnar_given = models.PositiveIntegerField(default=0)
+    fikapinnar_taken = models.PositiveIntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def punishment_count(self) -> int:
+        return max(0, self.punishments_delivered - self.punishments_taken)
+
+    @property
+    def fikapinne_count(self) -> int:
+        return max(0, self.fikapinnar_given - self.fikapinnar_taken)
+
+    def __str__(self) -> str:
+        return f"UserBalance({self.user_id})"
+
+
+class DailyBalance(models.Model):
+    """Per-user ledger movements for one local day.
+
+    Week and month figures are summed from at most 31 of these rows instead of
+    scanning the event tables. Delivered punishments are bucketed by
+    ``confirmed_at``, everything else by ``created_at``.
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="daily_balances"
+    )
+    day = models.DateField()
+
+    punishments_delivered = models.PositiveIntegerField(default=0)
+    punishments_taken = models.PositiveIntegerField(default=0)
+    fikapinnar_given = models.PositiveIntegerField(default=0)
+    fikapinnar_taken = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "day"], name="db_user_day_unique"),
+        ]
+
+    def __str__(self) -> str:
+        return f"DailyBalance({self.user_id}, {self.day})"
+
+
+class ArchivedBalance(models.Model):
+    """Per-user totals of one monthly event partition that has been archived.
+
+    ``manage.py archive_event_partitions`` writes these before detaching a
+    partition, so balances rebuilt from the event tables (and running totals
+    in the timeline and history) still include the archived months.
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="archived_balances"
+    )
+    month = models.DateField()  # first day of the partition's month
+
+    punishments_delivered = models.PositiveIntegerField(default=0)
+    punishments_taken = models.PositiveIntegerField(default=0)
+    fikapinnar_given = models.PositiveIntegerField(default=0)
+    fikapinnar_taken = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "month"], name="ab_user_month_unique"),
+        ]
+
+    def __str__(self) -> str:
+        return f"ArchivedBalance({self.user_id}, {self.month:%Y-%m})"
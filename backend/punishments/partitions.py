@@ -0,0 +1,183 @@
+"""Maintenance of the monthly partitions of the event tables.
+
+Migration 0015 turns the four event tables into tables range-partitioned by
+``created_at`` month (on Postgres). Partitions are named ``<table>_pYYYY_MM``
+and cover one UTC calendar month; anything outside them lands in
+``<table>_default``.
+
+``ensure_partitions`` creates the partitions for the coming months, and
+``archive_partitions`` folds partitions older than a cutoff into
+``ArchivedBalance`` rows and detaches them. Both are no-ops on other
+databases.
+"""
+
+import logging
+import re
+from datetime import date
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import (
+    ArchivedBalance,
+    FikapinneEvent,
+    PunishmentEvent,
+    TakeFikapinneEvent,
+    TakePunishmentEvent,
+)
+
+logger = logging.getLogger(__name__)
+
+MONTHS_AHEAD = 3
+KEEP_MONTHS = 24
+
+# (model, ArchivedBalance field, per-user aggregate over one partition)
+_ARCHIVE = (
+    (
+        PunishmentEvent,
+        "punishments_delivered",
+        "SUM(amount) FILTER (WHERE confirmer_id IS NOT NULL OR is_direct)",
+    ),
+    (TakePunishmentEvent, "punishments_taken", "SUM(amount)"),
+    (FikapinneEvent, "fikapinnar_given", "COUNT(*)"),
+    (TakeFikapinneEvent, "fikapinnar_taken", "SUM(amount)"),
+)
+
+TABLES = tuple(model._meta.db_table for model, _, _ in _ARCHIVE)
+
+
+def _supported() -> bool:
+    return connection.vendor == "postgresql"
+
+
+def _add_months(d: date, n: int) -> date:
+    months = d.year * 12 + d.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def _this_month() -> date:
+    return timezone.now().date().replace(day=1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def list_partitions(table: str) -> dict[date, str]:
+    """Monthly partitions currently attached to ``table``, by first day of month."""
+    pattern = re.compile(rf"^{re.escape(table)}_p(\d{{4}})_(\d{{2}})$")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+            """,
+            [table],
+        )
+        names = [name for (name,) in cursor.fetchall()]
+    months = {}
+    for name in names:
+        if m := pattern.match(name):
+            months[date(int(m[1]), int(m[2]), 1)] = name
+    return dict(sorted(months.items()))
+
+
+@transaction.atomic
+def _create_partition(cursor, table: str, month: date) -> None:
+    # CREATE TABLE ... PARTITION OF fails if the default partition already
+    # holds rows for the range, so build the table standalone, move those
+    # rows into it and attach it afterwards.
+    name = partition_name(table, month)
+    lower = f"{month.isoformat()} 00:00+00"
+    upper = f"{_add_months(month, 1).isoformat()} 00:00+00"
+    cursor.execute(
+        f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+    )
+    cursor.execute(
+        f"""
+        WITH moved AS (
+            DELETE FROM {table}_default
+            WHERE created_at >= %s AND created_at < %s
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+        """,
+        [lower, upper],
+    )
+    cursor.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{lower}') TO ('{upper}')"
+    )
+
+
+def ensure_partitions(months_ahead: int = MONTHS_AHEAD) -> list[str]:
+    """Create missing partitions up to ``months_ahead`` months from now.
+
+    Gaps since the newest existing partition are filled too, so a missed
+    run only means rows waited in the default partition for a while.
+    Returns the names of the partitions created.
+    """
+    if not _supported():
+        return []
+    this_month = _this_month()
+    last = _add_months(this_month, months_ahead)
+    created = []
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            existing = list_partitions(table)
+            month = this_month
+            if existing:
+                month = min(month, _add_months(max(existing), 1))
+            while month <= last:
+                if month not in existing:
+                    _create_partition(cursor, table, month)
+                    created.append(partition_name(table, month))
+                month = _add_months(month, 1)
+    return created
+
+
+@transaction.atomic
+def _archive_partition(cursor, table: str, field: str, aggregate: str, month: date, drop: bool) -> None:
+    name = partition_name(table, month)
+    others = [f for _, f, _ in _ARCHIVE if f != field]
+    cursor.execute(
+        f"""
+        INSERT INTO {ArchivedBalance._meta.db_table}
+            (user_id, month, {field}, {", ".join(others)})
+        SELECT target_id, %s, COALESCE({aggregate}, 0), {", ".join("0" for _ in others)}
+        FROM {name}
+        GROUP BY target_id
+        ON CONFLICT (user_id, month) DO UPDATE
+        SET {field} = {ArchivedBalance._meta.db_table}.{field} + EXCLUDED.{field}
+        """,
+        [month],
+    )
+    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+    if drop:
+        cursor.execute(f"DROP TABLE {name}")
+
+
+def archive_partitions(keep_months: int = KEEP_MONTHS, drop: bool = False) -> list[str]:
+    """Archive every partition that ends more than ``keep_months`` months ago.
+
+    Each partition's per-user totals are added to ``ArchivedBalance`` and the
+    partition is detached in the same transaction, so balances never count a
+    month twice or lose it. Detached partitions stay as plain tables (for a
+    dump or inspection) unless ``drop`` is set. Returns the names archived.
+    """
+    if not _supported():
+        return []
+    cutoff = _add_months(_this_month(), -keep_months)
+    archived = []
+    with connection.cursor() as cursor:
+        for model, field, aggregate in _ARCHIVE:
+            table = model._meta.db_table
+            for month in list_partitions(table):
+                if month >= cutoff:
+                    break
+                _archive_partition(cursor, table, field, aggregate, month, drop)
+                archived.append(partition_name(table, month))
+    if archived:
+        logger.info("Archived %d event partitions before %s", len(archived), cutoff)
+    return archived
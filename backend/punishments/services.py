@@ -0,0 +1,505 @@
+import logging
+from datetime import date, datetime, time, timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import leaderboards
+from .models import (
+    PENDING_PUNISHMENT_TTL,
+    ArchivedBalance,
+    DailyBalance,
+    FikapinneEvent,
+    PunishmentEvent,
+    TakeFikapinneEvent,
+    TakePunishmentEvent,
+    UserBalance,
+)
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+BALANCE_FIELDS = (
+    "punishments_delivered",
+    "punishments_taken",
+    "fikapinnar_given",
+    "fikapinnar_taken",
+)
+
+
+def _ensure_balances(user_ids) -> None:
+    UserBalance.objects.bulk_create(
+        [UserBalance(user_id=uid) for uid in user_ids], ignore_conflicts=True
+    )
+
+
+def _bump_daily(user_ids, field: str, delta: int) -> None:
+    day = timezone.localdate()
+    DailyBalance.objects.bulk_create(
+        [DailyBalance(user_id=uid, day=day) for uid in user_ids],
+        ignore_conflicts=True,
+    )
+    DailyBalance.objects.filter(user_id__in=user_ids, day=day).update(
+        **{field: F(field) + delta}
+    )
+
+
+def _bump(user_ids, field: str, delta: int) -> None:
+    """Add ``delta`` to ``field`` for every user in ``user_ids``, in constant queries."""
+    _ensure_balances(user_ids)
+    UserBalance.objects.filter(user_id__in=user_ids).update(
+        **{field: F(field) + delta}, updated_at=timezone.now()
+    )
+    _bump_daily(user_ids, field, delta)
+    leaderboards.record_on_commit(user_ids, field, delta)
+
+
+def get_balance(user_id: int) -> UserBalance:
+    """Return the balance for a user, or an unsaved all-zero row if none exists."""
+    return UserBalance.objects.filter(user_id=user_id).first() or UserBalance(
+        user_id=user_id
+    )
+
+
+def get_balances(user_ids) -> dict[int, UserBalance]:
+    """Balances for many users in one query, keyed by user id."""
+    found = {b.user_id: b for b in UserBalance.objects.filter(user_id__in=user_ids)}
+    return {uid: found.get(uid) or UserBalance(user_id=uid) for uid in user_ids}
+
+
+def window_bounds(period: str, day: date) -> tuple[date, date]:
+    """``[start, end)`` of the week (Monday first) or month containing ``day``."""
+    if period == "week":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    if period == "month":
+        start = day.replace(day=1)
+        if start.month == 12:
+            return start, start.replace(year=start.year + 1, month=1)
+        return start, start.replace(month=start.month + 1)
+    raise ValueError(f"Unknown period: {period}")
+
+
+def window_totals(user_id: int, start: date, end: date) -> dict[str, int]:
+    """Sum a user's daily buckets for ``start <= day < end``."""
+    totals = DailyBalance.objects.filter(
+        user_id=user_id, day__gte=start, day__lt=end
+    ).aggregate(**{f: Sum(f) for f in BALANCE_FIELDS})
+    return {f: int(totals[f] or 0) for f in BALANCE_FIELDS}
+
+
+def record_punishment_delivered(target_id: int, amount: int) -> None:
+    _bump([target_id], "punishments_delivered", amount)
+
+
+def record_punishments_delivered(target_ids, amount: int) -> None:
+    """Same as record_punishment_delivered for several targets at once."""
+    _bump(list(target_ids), "punishments_delivered", amount)
+
+
+def record_fikapinne_given(target_id: int) -> None:
+    _bump([target_id], "fikapinnar_given", 1)
+
+
+def try_take_punishments(target_id: int, amount: int) -> bool:
+    """Atomically move ``amount`` punishments from available to taken.
+
+    Returns False (and changes nothing) if the target doesn't have enough.
+    """
+    updated = UserBalance.objects.filter(
+        user_id=target_id,
+        punishments_delivered__gte=F("punishments_taken") + amount,
+    ).update(
+        punishments_taken=F("punishments_taken") + amount,
+        updated_at=timezone.now(),
+    )
+    if updated:
+        _bump_daily([target_id], "punishments_taken", amount)
+        leaderboards.record_on_commit([target_id], "punishments_taken", amount)
+    return updated == 1
+
+
+def try_take_fikapinnar(target_id: int, amount: int) -> bool:
+    """Atomically move ``amount`` fikapinnar from available to taken."""
+    updated = UserBalance.objects.filter(
+        user_id=target_id,
+        fikapinnar_given__gte=F("fikapinnar_taken") + amount,
+    ).update(
+        fikapinnar_taken=F("fikapinnar_taken") + amount,
+        updated_at=timezone.now(),
+    )
+    if updated:
+        _bump_daily([target_id], "fikapinnar_taken", amount)
+        leaderboards.record_on_commit([target_id], "fikapinnar_taken", amount)
+    return updated == 1
+
+
+def _totals_by_target(qs, agg) -> dict[int, int]:
+    return dict(
+        qs.values("target_id").annotate(total=agg).values_list("target_id", "total")
+    )
+
+
+def _archived_totals() -> dict[int, dict[str, int]]:
+    return {
+        row.pop("user_id"): row
+        for row in ArchivedBalance.objects.values("user_id").annotate(
+            **{field: Sum(field) for field in BALANCE_FIELDS}
+        )
+    }
+
+
+@transaction.atomic
+def rebuild_balances() -> int:
+    """Recompute every user's balance from the event tables. Returns rows written.
+
+    Months whose partitions were archived are taken from ``ArchivedBalance``.
+    """
+    by_field = {
+        "punishments_delivered": _totals_by_target(
+            PunishmentEvent.objects.delivered(), Sum("amount")
+        ),
+        "punishments_taken": _totals_by_target(
+            TakePunishmentEvent.objects.all(), Sum("amount")
+        ),
+        "fikapinnar_given": _totals_by_target(FikapinneEvent.objects.all(), Count("id")),
+        "fikapinnar_taken": _totals_by_target(
+            TakeFikapinneEvent.objects.all(), Sum("amount")
+        ),
+    }
+    archived = _archived_totals()
+
+    now = timezone.now()
+    rows = [
+        UserBalance(
+            user_id=uid,
+            **{
+                field: (totals.get(uid) or 0) + archived.get(uid, {}).get(field, 0)
+                for field, totals in by_field.items()
+            },
+            updated_at=now,
+        )
+        for uid in User.objects.values_list("id", flat=True)
+    ]
+    UserBalance.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=[*BALANCE_FIELDS, "updated_at"],
+    )
+    return len(rows)
+
+
+def _totals_by_target_day(qs, date_field: str, agg) -> dict[tuple[int, date], int]:
+    tz = timezone.get_current_timezone()
+    return {
+        (target_id, day): total
+        for target_id, day, total in qs.annotate(day=TruncDate(date_field, tzinfo=tz))
+        .values("target_id", "day")
+        .annotate(total=agg)
+        .values_list("target_id", "day", "total")
+    }
+
+
+@transaction.atomic
+def rebuild_daily_balances() -> int:
+    """Recompute every daily bucket from the event tables. Returns rows written.
+
+    Buckets before the end of the newest archived month are left alone, as
+    their events are no longer in the live partitions.
+    """
+    by_field = {
+        "punishments_delivered": _totals_by_target_day(
+            PunishmentEvent.objects.delivered(), "confirmed_at", Sum("amount")
+        ),
+        "punishments_taken": _totals_by_target_day(
+            TakePunishmentEvent.objects.all(), "created_at", Sum("amount")
+        ),
+        "fikapinnar_given": _totals_by_target_day(
+            FikapinneEvent.objects.all(), "created_at", Count("id")
+        ),
+        "fikapinnar_taken": _totals_by_target_day(
+            TakeFikapinneEvent.objects.all(), "created_at", Sum("amount")
+        ),
+    }
+
+    rows: dict[tuple[int, date], DailyBalance] = {}
+    for field, totals in by_field.items():
+        for (user_id, day), total in totals.items():
+            if day is None:
+                continue
+            row = rows.setdefault(
+                (user_id, day), DailyBalance(user_id=user_id, day=day)
+            )
+            setattr(row, field, total or 0)
+
+    horizon = ArchivedBalance.objects.order_by("-month").values_list("month", flat=True).first()
+    if horizon is not None:
+        horizon = date(horizon.year + horizon.month // 12, horizon.month % 12 + 1, 1)
+        rows = {key: row for key, row in rows.items() if key[1] >= horizon}
+        DailyBalance.objects.filter(day__gte=horizon).delete()
+    else:
+        DailyBalance.objects.all().delete()
+    DailyBalance.objects.bulk_create(rows.values(), batch_size=1000)
+    return len(rows)
+
+
+TIMELINE_KINDS = ("fikapinne", "fikapinne_take", "punishment", "punishment_take")
+
+_TIMELINE_SQL = """
+WITH ledger AS (
+    SELECT 'punishment' AS kind, id, confirmed_at AS at,
+           amount AS punishment_delta, 0 AS fikapinne_delta,
+           initiator_id AS actor_id, reason
+    FROM {punishment}
+    WHERE target_id = %(user_id)s AND (confirmer_id IS NOT NULL OR is_direct)
+    UNION ALL
+    SELECT 'punishment_take', id, created_at, -amount, 0, judge_id, ''
+    FROM {punishment_take}
+    WHERE target_id = %(user_id)s
+    UNION ALL
+    SELECT 'fikapinne', id, created_at, 0, 1, judge_id, ''
+    FROM {fikapinne}
+    WHERE target_id = %(user_id)s
+    UNION ALL
+    SELECT 'fikapinne_take', id, created_at, 0, -amount, judge_id, ''
+    FROM {fikapinne_take}
+    WHERE target_id = %(user_id)s
+),
+archived AS (
+    SELECT COALESCE(SUM(punishments_delivered - punishments_taken), 0) AS punishments,
+           COALESCE(SUM(fikapinnar_given - fikapinnar_taken), 0) AS fikapinnar
+    FROM {archived}
+    WHERE user_id = %(user_id)s
+),
+balanced AS (
+    SELECT ledger.*,
+           archived.punishments + SUM(punishment_delta) OVER w AS punishment_balance,
+           archived.fikapinnar + SUM(fikapinne_delta) OVER w AS fikapinne_balance
+    FROM ledger CROSS JOIN archived
+    WINDOW w AS (ORDER BY at, kind, id ROWS UNBOUNDED PRECEDING)
+)
+SELECT b.kind, b.id, b.at, b.punishment_delta, b.fikapinne_delta,
+       b.punishment_balance, b.fikapinne_balance, b.reason,
+       b.actor_id, u.username
+FROM balanced b
+LEFT JOIN {user} u ON u.id = b.actor_id
+WHERE %(before_at)s::timestamptz IS NULL
+   OR (b.at, b.kind, b.id) < (%(before_at)s::timestamptz, %(before_kind)s, %(before_id)s)
+ORDER BY b.at DESC, b.kind DESC, b.id DESC
+LIMIT %(limit)s
+"""
+
+_TIMELINE_COLUMNS = (
+    "kind",
+    "id",
+    "at",
+    "punishment_delta",
+    "fikapinne_delta",
+    "punishment_balance",
+    "fikapinne_balance",
+    "reason",
+    "actor_id",
+    "actor_username",
+)
+
+
+def iter_timeline(user_id: int, before=None, limit: int = 50):
+    """Yield a user's delivered ledger entries newest first, with running balances.
+
+    All four event tables are merged in one ``UNION ALL`` query and the
+    balances are computed by window functions in Postgres. ``before`` is an
+    ``(at, kind, id)`` tuple from a previous row; rows are fetched from the
+    cursor in small batches rather than materialized up front.
+    """
+    sql = _TIMELINE_SQL.format(
+        punishment=PunishmentEvent._meta.db_table,
+        punishment_take=TakePunishmentEvent._meta.db_table,
+        fikapinne=FikapinneEvent._meta.db_table,
+        fikapinne_take=TakeFikapinneEvent._meta.db_table,
+        archived=ArchivedBalance._meta.db_table,
+        user=User._meta.db_table,
+    )
+    before_at, before_kind, before_id = before or (None, "", 0)
+    params = {
+        "user_id": user_id,
+        "before_at": before_at,
+        "before_kind": before_kind,
+        "before_id": before_id,
+        "limit": limit,
+    }
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        while rows := cursor.fetchmany(100):
+            for row in rows:
+                yield dict(zip(_TIMELINE_COLUMNS, row))
+
+
+_HISTORY_SQL = """
+WITH ledger AS (
+    SELECT confirmed_at AS at, amount AS delivered, 0 AS taken,
+           0 AS given, 0 AS fika_taken
+    FROM {punishment}
+    WHERE target_id = %(user_id)s AND (confirmer_id IS NOT NULL OR is_direct)
+      AND confirmed_at >= %(start_at)s
+      -- implied by the one above (a proposal is confirmed within its TTL),
+      -- but on the partition key and the (target, created_at) index
+      AND created_at >= %(start_created)s
+    UNION ALL
+    SELECT created_at, 0, amount, 0, 0 FROM {punishment_take}
+    WHERE target_id = %(user_id)s AND created_at >= %(start_at)s
+    UNION ALL
+    SELECT created_at, 0, 0, 1, 0 FROM {fikapinne}
+    WHERE target_id = %(user_id)s AND created_at >= %(start_at)s
+    UNION ALL
+    SELECT created_at, 0, 0, 0, amount FROM {fikapinne_take}
+    WHERE target_id = %(user_id)s AND created_at >= %(start_at)s
+),
+per_day AS (
+    SELECT date_trunc('day', at AT TIME ZONE %(tz)s)::date AS day,
+           SUM(delivered) AS delivered, SUM(taken) AS taken,
+           SUM(given) AS given, SUM(fika_taken) AS fika_taken
+    FROM ledger
+    GROUP BY 1
+),
+since_start AS (
+    SELECT COALESCE(SUM(delivered - taken), 0) AS punishments,
+           COALESCE(SUM(given - fika_taken), 0) AS fikapinnar
+    FROM per_day
+),
+-- current totals (archived months included), read in the same snapshot
+balance AS (
+    SELECT COALESCE(SUM(punishments_delivered - punishments_taken), 0) AS punishments,
+           COALESCE(SUM(fikapinnar_given - fikapinnar_taken), 0) AS fikapinnar
+    FROM {balance}
+    WHERE user_id = %(user_id)s
+),
+days AS (
+    SELECT generate_series(%(start)s::date, %(end)s::date, interval '1 day')::date AS day
+)
+SELECT d.day,
+       COALESCE(p.delivered, 0), COALESCE(p.taken, 0),
+       COALESCE(p.given, 0), COALESCE(p.fika_taken, 0),
+       balance.punishments - since_start.punishments
+           + SUM(COALESCE(p.delivered - p.taken, 0)) OVER w,
+       balance.fikapinnar - since_start.fikapinnar
+           + SUM(COALESCE(p.given - p.fika_taken, 0)) OVER w
+FROM days d
+LEFT JOIN per_day p ON p.day = d.day
+CROSS JOIN since_start
+CROSS JOIN balance
+WINDOW w AS (ORDER BY d.day ROWS UNBOUNDED PRECEDING)
+ORDER BY d.day
+"""
+
+_HISTORY_COLUMNS = (
+    "day",
+    *BALANCE_FIELDS,
+    "punishment_balance",
+    "fikapinne_balance",
+)
+
+
+def _history_key(user_id: int, day: date) -> str:
+    return f"hist:{user_id}:{day.isoformat()}"
+
+
+def _query_history(user_id: int, start: date, end: date) -> list[dict]:
+    """Rows for ``start <= day <= end``, reading only events from ``start`` on.
+
+    The balance before ``start`` is the user's current ``UserBalance`` minus
+    everything since, so a warm history (only today missing) reads today's
+    events rather than the user's whole ledger.
+    """
+    sql = _HISTORY_SQL.format(
+        punishment=PunishmentEvent._meta.db_table,
+        punishment_take=TakePunishmentEvent._meta.db_table,
+        fikapinne=FikapinneEvent._meta.db_table,
+        fikapinne_take=TakeFikapinneEvent._meta.db_table,
+        balance=UserBalance._meta.db_table,
+    )
+    tz = timezone.get_current_timezone()
+    start_at = datetime.combine(start, time.min, tzinfo=tz)
+    params = {
+        "user_id": user_id,
+        "start": start,
+        "end": end,
+        "start_at": start_at,
+        "start_created": start_at - PENDING_PUNISHMENT_TTL,
+        "tz": timezone.get_current_timezone_name(),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [
+            {k: int(v) if k != "day" else v for k, v in zip(_HISTORY_COLUMNS, row)}
+            for row in cursor.fetchall()
+        ]
+
+
+def history_horizon(user_id: int) -> date | None:
+    """First day whose events are all still in the event tables, if the user
+    has archived months (see ``partitions.archive_partitions``).
+
+    Archived months only keep monthly totals, so no daily rows exist before
+    this. Partitions are UTC months, and the first local day after one can
+    still start inside it, hence the extra day.
+    """
+    last = (
+        ArchivedBalance.objects.filter(user_id=user_id)
+        .order_by("-month")
+        .values_list("month", flat=True)
+        .first()
+    )
+    if last is None:
+        return None
+    return date(last.year + last.month // 12, last.month % 12 + 1, 1) + timedelta(days=1)
+
+
+def daily_history(user_id: int, start: date, end: date) -> list[dict]:
+    """Per-day deltas and end-of-day balances for ``start <= day <= end``.
+
+    Days before today can no longer change (deliveries are dated by
+    ``confirmed_at``, takes by ``created_at``, and neither is backdated), so
+    their buckets are cached forever. Only the missing days and today go to
+    the database, in a single query. Days after today, and days before the
+    user's archived months end (``history_horizon``), are not returned.
+    """
+    today = timezone.localdate()
+    end = min(end, today)
+    horizon = history_horizon(user_id)
+    if horizon is not None:
+        start = max(start, horizon)
+    if start > end:
+        return []
+
+    last_closed = min(end, today - timedelta(days=1))
+    closed = [start + timedelta(days=i) for i in range((last_closed - start).days + 1)]
+    try:
+        cached = cache.get_many([_history_key(user_id, d) for d in closed])
+    except Exception:
+        logger.warning("History cache unavailable", exc_info=True)
+        cached = {}
+
+    missing = [d for d in closed if _history_key(user_id, d) not in cached]
+    query_from = missing[0] if missing else (today if end == today else None)
+
+    fresh = []
+    if query_from is not None:
+        fresh = _query_history(user_id, query_from, end)
+        to_cache = {
+            _history_key(user_id, row["day"]): row for row in fresh if row["day"] < today
+        }
+        try:
+            cache.set_many(to_cache, timeout=None)
+        except Exception:
+            logger.warning("Could not store history buckets", exc_info=True)
+
+    by_day = {row["day"]: row for row in cached.values()}
+    by_day.update((row["day"], row) for row in fresh)
+    return [by_day[d] for d in sorted(by_day)]
@@ -0,0 +1,29 @@
+from django.db.models.signals import post_delete, post_save
+
+from kallan.cache import TAG_FIKAPINNAR, TAG_PUNISHMENTS, invalidate_tags_on_commit
+from kallan.versioning import bump_ledger_version_on_commit
+
+from .models import (
+    FikapinneEvent,
+    PunishmentEvent,
+    TakeFikapinneEvent,
+    TakePunishmentEvent,
+)
+
+# ledger model -> response cache tag it invalidates
+LEDGER_MODELS = {
+    PunishmentEvent: TAG_PUNISHMENTS,
+    TakePunishmentEvent: TAG_PUNISHMENTS,
+    FikapinneEvent: TAG_FIKAPINNAR,
+    TakeFikapinneEvent: TAG_FIKAPINNAR,
+}
+
+
+def ledger_changed(sender, **kwargs):
+    bump_ledger_version_on_commit()
+    invalidate_tags_on_commit(LEDGER_MODELS[sender])
+
+
+for model in LEDGER_MODELS:
+    post_save.connect(ledger_changed, sender=model)
+    post_delete.connect(ledger_changed, sender=model)
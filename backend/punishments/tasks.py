@@ -1,9 +1,58 @@
 from celery import shared_task
+from django.db import connection
+from kallan.cache import TAG_PUNISHMENTS, invalidate_tags_on_commit
+from kallan.versioning import bump_ledger_version_on_commit
+
+# Same rows as PunishmentEvent.objects.expired().
+_PURGE_SQL = """
+DELETE FROM {table}
+WHERE confirmer_id IS NULL AND NOT is_direct AND expires_at <= now()
+RETURNING id, target_id
+"""
 
 
 @shared_task
 def expire_punishment_event(event_id: int) -> None:
-    """Delete a pending punishment event if it still hasn't been confirmed."""
+    """Delete a pending punishment event if it still hasn't been confirmed.
+
+    No longer scheduled; kept so ETA tasks already in the queue still resolve.
+    """
     from .models import PunishmentEvent
 
     PunishmentEvent.objects.filter(pk=event_id, confirmer__isnull=True).delete()
+
+
+@shared_task
+def purge_expired_punishment_events() -> int:
+    """Delete every lapsed punishment proposal in one statement and announce it.
+
+    Expired rows are already hidden by ``pending()``, so this only reclaims
+    space and can run on a relaxed schedule.
+    """
+    from . import live
+    from .models import PunishmentEvent
+
+    # Raw SQL: with post_delete receivers connected, QuerySet.delete() would
+    # select the rows again and bump the ledger version once per row.
+    with connection.cursor() as cursor:
+        cursor.execute(_PURGE_SQL.format(table=PunishmentEvent._meta.db_table))
+        expired = cursor.fetchall()
+    if not expired:
+        return 0
+
+    bump_ledger_version_on_commit()
+    invalidate_tags_on_commit(TAG_PUNISHMENTS)
+    live.publish_on_commit(
+        "punishment_expired",
+        ids=[pk for pk, _ in expired],
+        target_ids=sorted({target_id for _, target_id in expired}),
+    )
+    return len(expired)
+
+
+@shared_task
+def ensure_event_partitions() -> int:
+    """Keep monthly event partitions created ahead of time (see ``partitions``)."""
+    from .partitions import ensure_partitions
+
+    return len(ensure_partitions())
@@ -0,0 +1,911 @@
+import asyncio
+import base64
+import csv
+import io
+import json
+import random
+import unittest
+from unittest import mock
+from datetime import timedelta
+
+import fakeredis
+import redis
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import api, export, leaderboards, live, partitions, tasks
+from .models import (
+    ArchivedBalance,
+    PENDING_PUNISHMENT_TTL,
+    DailyBalance,
+    FikapinneEvent,
+    PunishmentEvent,
+    TakeFikapinneEvent,
+    TakePunishmentEvent,
+    UserBalance,
+)
+from .services import (
+    BALANCE_FIELDS,
+    daily_history,
+    get_balance,
+    iter_timeline,
+    rebuild_balances,
+    rebuild_daily_balances,
+    try_take_fikapinnar,
+    try_take_punishments,
+)
+
+User = get_user_model()
+
+# history buckets are cached forever, keyed by user id
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs Postgres EXPLAIN")
+class LedgerQueryPlanTests(TransactionTestCase):
+    """Fail if a hot ledger query stops using the index that was built for it.
+
+    The tables are seeded to a realistic size and analyzed, and the planner
+    is left alone, so dropping or changing one of these indexes makes it fall
+    back to another index or a sequential scan and the test names the plan.
+    """
+
+    N_USERS = 200
+    N_EVENTS = 40_000
+    DAYS = 60
+
+    def setUp(self):
+        rng = random.Random(1234)
+        users = User.objects.bulk_create(
+            [User(username=f"plan{i}", tier="vest") for i in range(self.N_USERS)]
+        )
+        now = timezone.now()
+
+        def ago():
+            return now - timedelta(minutes=rng.randrange(self.DAYS * 24 * 60))
+
+        events = []
+        for _ in range(self.N_EVENTS):
+            target, initiator, confirmer = rng.sample(users, 3)
+            at = ago()
+            # nearly everything is confirmed; proposals lapse within minutes
+            delivered = rng.random() < 0.99
+            events.append(
+                PunishmentEvent(
+                    target=target,
+                    initiator=initiator,
+                    confirmer=confirmer if delivered else None,
+                    amount=rng.randint(1, 10),
+                    confirmed_at=at if delivered else None,
+                    expires_at=None if delivered else at + PENDING_PUNISHMENT_TTL,
+                )
+            )
+        PunishmentEvent.objects.bulk_create(events, batch_size=5000)
+        # created_at is auto_now_add, so spread it out afterwards
+        PunishmentEvent.objects.update(
+            created_at=Coalesce("confirmed_at", F("expires_at") - PENDING_PUNISHMENT_TTL)
+        )
+
+        takes, fika, fika_takes = [], [], []
+        for _ in range(self.N_EVENTS // 2):
+            target, judge = rng.sample(users, 2)
+            takes.append(TakePunishmentEvent(target=target, judge=judge, amount=1))
+            fika.append(FikapinneEvent(target=target, judge=judge))
+            fika_takes.append(TakeFikapinneEvent(target=target, judge=judge, amount=3))
+        TakePunishmentEvent.objects.bulk_create(takes, batch_size=5000)
+        FikapinneEvent.objects.bulk_create(fika, batch_size=5000)
+        TakeFikapinneEvent.objects.bulk_create(fika_takes, batch_size=5000)
+
+        today = timezone.localdate()
+        DailyBalance.objects.bulk_create(
+            [
+                DailyBalance(user=user, day=today - timedelta(days=d), punishments_taken=1)
+                for user in users
+                for d in range(self.DAYS)
+            ],
+            batch_size=5000,
+        )
+
+        self.target_id = users[0].id
+        # outside a transaction, like autovacuum would: fresh statistics, and
+        # a visibility map so covering indexes can answer index-only scans
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE")
+
+    def indexes_used(self, qs) -> set[str]:
+        """Names of the indexes the plan scans, partition indexes by their parent."""
+        plan = json.loads(qs.explain(format="json"))
+        names = set()
+
+        def walk(node):
+            if "Index Name" in node:
+                names.add(node["Index Name"])
+            for child in node.get("Plans", []):
+                walk(child)
+
+        walk(plan[0]["Plan"])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT child.relname, parent.relname
+                FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                WHERE child.relname = ANY(%s)
+                """,
+                [list(names)],
+            )
+            parents = dict(cursor.fetchall())
+        return {parents.get(name, name) for name in names}
+
+    def assertUsesIndex(self, qs, index):
+        self.assertIn(index, self.indexes_used(qs), qs.explain())
+
+    def test_hot_queries_use_their_indexes(self):
+        # one test: the seeding and VACUUM are too slow to repeat per query
+        today = timezone.localdate()
+        pe = PunishmentEvent.objects
+        cases = [
+            ("pe_pending_expires_idx", pe.pending().order_by("-created_at")[:50]),
+            ("pe_pending_expires_idx", pe.expired()),
+            (
+                "pe_created_id_idx",
+                pe.delivered().order_by("-created_at", "-id")[:50],
+            ),
+            (
+                "pe_target_created_id_idx",
+                pe.filter(target_id=self.target_id).order_by("-created_at", "-id")[:50],
+            ),
+            (
+                "pe_delivered_target_idx",
+                pe.delivered()
+                .filter(target_id=self.target_id)
+                .values("target_id")
+                .annotate(s=Sum("amount")),
+            ),
+            (
+                "pte_target_amount_idx",
+                TakePunishmentEvent.objects.filter(target_id=self.target_id)
+                .values("target_id")
+                .annotate(s=Sum("amount")),
+            ),
+            (
+                "tfe_target_amount_idx",
+                TakeFikapinneEvent.objects.filter(target_id=self.target_id)
+                .values("target_id")
+                .annotate(s=Sum("amount")),
+            ),
+        ]
+        for index, qs in cases:
+            with self.subTest(index=index):
+                self.assertUsesIndex(qs, index)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class DailyHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.target, judge = User.objects.bulk_create(
+            [User(username="hist-target", tier="vest"), User(username="hist-judge", tier="vest")]
+        )
+        now = timezone.now()
+        for days_ago, model, kwargs in [
+            (10, PunishmentEvent, {"initiator": judge, "is_direct": True, "amount": 5}),
+            (3, TakePunishmentEvent, {"judge": judge, "amount": 2}),
+            (1, FikapinneEvent, {"judge": judge}),
+            (0, PunishmentEvent, {"initiator": judge, "is_direct": True, "amount": 1}),
+        ]:
+            at = now - timedelta(days=days_ago)
+            if model is PunishmentEvent:
+                kwargs["confirmed_at"] = at
+            event = model.objects.create(target=cls.target, **kwargs)
+            model.objects.filter(pk=event.pk).update(created_at=at)
+        rebuild_balances()
+
+    def setUp(self):
+        cache.clear()
+
+    def history(self):
+        today = timezone.localdate()
+        return [
+            (row["punishment_balance"], row["fikapinne_balance"])
+            for row in daily_history(self.target.id, today - timedelta(days=5), today)
+        ]
+
+    def test_balances_seeded_from_current_totals(self):
+        self.assertEqual(self.history(), [(5, 0)] * 2 + [(3, 0)] * 2 + [(3, 1), (4, 1)])
+
+    def test_warm_history_reads_only_today(self):
+        cold = self.history()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.history(), cold)
+        today = timezone.localdate().isoformat()
+        history_sql = [q["sql"] for q in ctx.captured_queries if "generate_series" in q["sql"]]
+        self.assertEqual(len(history_sql), 1)
+        self.assertIn(f"'{today}'::date", history_sql[0])
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs partitioned tables")
+class EventPartitionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.target, cls.judge = User.objects.bulk_create(
+            [User(username="part-target", tier="vest"), User(username="part-judge", tier="vest")]
+        )
+        now = timezone.now()
+        cls.old = (now - timedelta(days=31 * 30)).replace(day=15)
+        cls.old_month = cls.old.date().replace(day=1)
+
+        for at in (cls.old, now):
+            PunishmentEvent.objects.create(
+                target=cls.target, initiator=cls.judge, is_direct=True,
+                amount=5, confirmed_at=at,
+            )
+            TakePunishmentEvent.objects.create(target=cls.target, judge=cls.judge, amount=2)
+            FikapinneEvent.objects.create(target=cls.target, judge=cls.judge)
+        for model in (PunishmentEvent, TakePunishmentEvent, FikapinneEvent):
+            first = model.objects.order_by("id").first()
+            model.objects.filter(pk=first.pk).update(created_at=cls.old)
+        rebuild_balances()
+
+    def _create_old_partitions(self):
+        with connection.cursor() as cursor:
+            for table in partitions.TABLES:
+                partitions._create_partition(cursor, table, self.old_month)
+
+    def test_ensure_partitions_is_idempotent(self):
+        partitions.ensure_partitions()
+        self.assertEqual(partitions.ensure_partitions(), [])
+        for table in partitions.TABLES:
+            self.assertGreaterEqual(len(partitions.list_partitions(table)), 4)
+
+    def test_new_partition_takes_rows_from_default(self):
+        table = PunishmentEvent._meta.db_table
+        self._create_old_partitions()
+        self.assertIn(self.old_month, partitions.list_partitions(table))
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {table}_default")
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertEqual(PunishmentEvent.objects.count(), 2)
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    def test_archive_keeps_totals(self):
+        self._create_old_partitions()
+        before = get_balance(self.target.id)
+        timeline_before = next(iter_timeline(self.target.id))
+
+        archived = partitions.archive_partitions(keep_months=24)
+
+        self.assertEqual(len(archived), len(partitions.TABLES))
+        self.assertEqual(PunishmentEvent.objects.count(), 1)
+        row = ArchivedBalance.objects.get(user=self.target, month=self.old_month)
+        self.assertEqual(
+            (row.punishments_delivered, row.punishments_taken, row.fikapinnar_given),
+            (5, 2, 1),
+        )
+
+        UserBalance.objects.all().delete()
+        rebuild_balances()
+        after = get_balance(self.target.id)
+        for field in ("punishments_delivered", "punishments_taken", "fikapinnar_given"):
+            self.assertEqual(getattr(after, field), getattr(before, field))
+
+        timeline_after = next(iter_timeline(self.target.id))
+        self.assertEqual(
+            timeline_after["punishment_balance"], timeline_before["punishment_balance"]
+        )
+
+        # archived months have no daily rows; history starts after them
+        self.assertEqual(daily_history(self.target.id, self.old.date(), self.old.date()), [])
+        today = timezone.localdate()
+        last = daily_history(self.target.id, self.old.date(), today)[-1]
+        self.assertEqual(
+            last["punishment_balance"], after.punishments_delivered - after.punishments_taken
+        )
+        self.assertEqual(partitions.archive_partitions(keep_months=24), [])
+
+
+class ExpiredProposalTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.target, cls.initiator = User.objects.bulk_create(
+            [
+                User(username="exp-target", tier="vest"),
+                User(username="exp-initiator", tier="vest", force_password_reset=False),
+            ]
+        )
+        now = timezone.now()
+        cls.live, cls.lapsed = PunishmentEvent.objects.bulk_create(
+            [
+                PunishmentEvent(
+                    target=cls.target, initiator=cls.initiator, amount=1,
+                    expires_at=now + PENDING_PUNISHMENT_TTL,
+                ),
+                PunishmentEvent(
+                    target=cls.target, initiator=cls.initiator, amount=2,
+                    expires_at=now - timedelta(seconds=1),
+                ),
+            ]
+        )
+
+    def test_lapsed_proposal_leaves_reads_before_the_sweep(self):
+        self.assertEqual((self.live.stage, self.lapsed.stage), ("pending", "expired"))
+        self.client.force_login(self.initiator)
+        response = self.client.get("/api/punishments/events?pending=1&confirmed=1")
+        self.assertEqual([e["id"] for e in response.json()], [self.live.id])
+
+        response = self.client.delete(f"/api/punishments/events/{self.lapsed.id}")
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(PunishmentEvent.objects.filter(pk=self.lapsed.pk).exists())
+
+    def test_etag_changes_when_a_proposal_lapses(self):
+        self.client.force_login(self.initiator)
+        path = "/api/punishments/events?pending=1"
+        etag = self.client.get(path)["ETag"]
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # no write announces it, the clock just passes expires_at
+        PunishmentEvent.objects.filter(pk=self.live.pk).update(expires_at=timezone.now())
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+    def test_sweep_deletes_only_lapsed_proposals(self):
+        past = timezone.now() - timedelta(days=1)
+        lapsed_too = PunishmentEvent.objects.create(
+            target=self.initiator, initiator=self.target, amount=1, expires_at=past
+        )
+        nurse = User.objects.create_user("exp-nurse", "pw", tier="vest")
+        confirmed = PunishmentEvent.objects.create(
+            target=self.target, initiator=self.initiator, confirmer=nurse,
+            confirmed_at=past, amount=1, expires_at=past,
+        )
+        direct = PunishmentEvent.objects.create(
+            target=self.target, initiator=self.initiator, is_direct=True, amount=1,
+            expires_at=past,
+        )
+        with (
+            mock.patch.object(live, "publish") as publish,
+            mock.patch.object(tasks, "bump_ledger_version_on_commit") as bump,
+            self.captureOnCommitCallbacks(execute=True),
+            CaptureQueriesContext(connection) as queries,
+        ):
+            self.assertEqual(tasks.purge_expired_punishment_events(), 2)
+
+        self.assertEqual(len(queries), 1)
+        bump.assert_called_once()
+        publish.assert_called_once_with(
+            "punishment_expired",
+            ids=mock.ANY,
+            target_ids=sorted([self.target.id, self.initiator.id]),
+        )
+        self.assertCountEqual(publish.call_args.kwargs["ids"], [self.lapsed.id, lapsed_too.id])
+        self.assertCountEqual(
+            PunishmentEvent.objects.values_list("id", flat=True),
+            [self.live.id, confirmed.id, direct.id],
+        )
+        self.assertEqual(tasks.purge_expired_punishment_events(), 0)
+
+
+class LeaderboardFallbackTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create(
+            [User(username=f"lb{i}", tier="vest") for i in range(4)]
+        )
+        cls.user_ids = [u.id for u in users]
+        judge = users[-1]
+        for amount, target in zip((3, 5, 1), users):
+            PunishmentEvent.objects.create(
+                target=target, initiator=judge, is_direct=True, amount=amount,
+                confirmed_at=timezone.now(),
+            )
+            FikapinneEvent.objects.create(target=target, judge=judge)
+        TakePunishmentEvent.objects.create(target=users[1], judge=judge, amount=4)
+        rebuild_balances()
+        rebuild_daily_balances()
+
+    def boards(self):
+        return {
+            (board, period): (
+                leaderboards.top(board, period, 10),
+                [leaderboards.rank_of(board, period, uid) for uid in self.user_ids],
+            )
+            for board in leaderboards.BOARDS
+            for period in leaderboards.PERIODS
+        }
+
+    def test_ranks_from_the_database_without_redis(self):
+        leaderboards.rebuild()
+        expected = self.boards()
+        self.assertEqual(expected["punishments", "all"][0][0], (self.user_ids[0], 3))
+
+        with (
+            mock.patch.object(leaderboards, "get_redis", side_effect=redis.ConnectionError),
+            self.assertLogs("punishments.leaderboards", "WARNING"),
+        ):
+            self.assertEqual(self.boards(), expected)
+
+
+class BalanceReadModelTests(TestCase):
+    """UserBalance, kept up to date write by write, against the event tables."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.proposer, cls.confirmer, cls.target, cls.nurse = (
+            User.objects.create_user(name, "pw", tier=tier, force_password_reset=False)
+            for name, tier in [
+                ("bal-proposer", "vest"),
+                ("bal-confirmer", "vest"),
+                ("bal-target", "hat"),
+                ("bal-nurse", "vest"),
+            ]
+        )
+        cls.nurse.user_permissions.add(
+            Permission.objects.get(codename="direct_punish"),
+            Permission.objects.get(codename="manage_fikapinnar"),
+        )
+
+    def from_scratch(self, user):
+        def total(qs, field="amount"):
+            return qs.filter(target=user).aggregate(n=Coalesce(Sum(field), 0))["n"]
+
+        return {
+            "punishments_delivered": total(PunishmentEvent.objects.delivered()),
+            "punishments_taken": total(TakePunishmentEvent.objects),
+            "fikapinnar_given": FikapinneEvent.objects.filter(target=user).count(),
+            "fikapinnar_taken": total(TakeFikapinneEvent.objects),
+        }
+
+    def assertBalanced(self, user):
+        balance = get_balance(user.id)
+        self.assertEqual(
+            {f: getattr(balance, f) for f in BALANCE_FIELDS}, self.from_scratch(user)
+        )
+        return balance
+
+    def post(self, user, path, data):
+        self.client.force_login(user)
+        return self.client.post(
+            f"/api/punishments/{path}", data, content_type="application/json"
+        )
+
+    def test_every_write_keeps_the_balance(self):
+        proposal = self.post(self.proposer, "events", {"target_id": self.target.id, "amount": 3})
+        self.assertEqual(proposal.status_code, 201)
+        self.assertEqual(self.assertBalanced(self.target).punishments_delivered, 0)
+
+        response = self.post(self.confirmer, f"events/{proposal.json()['id']}/confirm", {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.assertBalanced(self.target).punishments_delivered, 3)
+
+        withdrawn = self.post(self.proposer, "events", {"target_id": self.target.id, "amount": 2})
+        self.client.force_login(self.proposer)
+        response = self.client.delete(f"/api/punishments/events/{withdrawn.json()['id']}")
+        self.assertEqual(response.status_code, 204)
+        self.assertBalanced(self.target)
+
+        self.post(self.nurse, "events", {"target_id": self.target.id, "amount": 1})
+        self.assertEqual(self.assertBalanced(self.target).punishments_delivered, 4)
+
+        response = self.post(self.nurse, "take", {"target_id": self.target.id, "amount": 3})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.assertBalanced(self.target).punishment_count, 1)
+
+        for _ in range(4):
+            self.post(self.nurse, "fikapinnar/give", {"target_id": self.target.id})
+        response = self.post(
+            self.nurse, "fikapinnar/take", {"target_id": self.target.id, "amount": 3}
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.assertBalanced(self.target).fikapinne_count, 1)
+        self.assertBalanced(self.proposer)
+
+    def test_take_refuses_to_overdraw(self):
+        self.post(self.nurse, "events", {"target_id": self.target.id, "amount": 2})
+        self.post(self.nurse, "fikapinnar/give", {"target_id": self.target.id})
+
+        self.assertFalse(try_take_punishments(self.target.id, 3))
+        self.assertFalse(try_take_fikapinnar(self.target.id, 3))
+        self.assertFalse(try_take_punishments(self.proposer.id, 1))  # no balance row
+        response = self.post(self.nurse, "take", {"target_id": self.target.id, "amount": 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(TakePunishmentEvent.objects.exists())
+        self.assertEqual(self.assertBalanced(self.target).punishment_count, 2)
+
+        self.assertTrue(try_take_punishments(self.target.id, 2))
+        self.assertEqual(get_balance(self.target.id).punishments_taken, 2)
+
+    def test_rebuild_repairs_drift(self):
+        self.post(self.nurse, "events", {"target_id": self.target.id, "amount": 2})
+        UserBalance.objects.filter(user=self.target).update(
+            punishments_delivered=99, fikapinnar_taken=7
+        )
+        UserBalance.objects.filter(user=self.proposer).delete()
+
+        rebuild_balances()
+        self.assertEqual(self.assertBalanced(self.target).punishments_delivered, 2)
+        self.assertBalanced(self.proposer)
+
+
+class EventPageCursorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.target, cls.initiator, cls.confirmer = User.objects.bulk_create(
+            [
+                User(username=f"page-{name}", tier="vest", force_password_reset=False)
+                for name in ("target", "initiator", "confirmer")
+            ]
+        )
+        now = timezone.now()
+        PunishmentEvent.objects.bulk_create(
+            [
+                PunishmentEvent(
+                    target=cls.target, initiator=cls.initiator, confirmer=cls.confirmer,
+                    confirmed_at=now, amount=1,
+                )
+                for _ in range(7)
+            ]
+        )
+        # a tie on created_at across page boundaries, then one older row
+        PunishmentEvent.objects.update(created_at=now)
+        cls.oldest = PunishmentEvent.objects.order_by("id").first()
+        PunishmentEvent.objects.filter(pk=cls.oldest.pk).update(
+            created_at=now - timedelta(hours=1)
+        )
+
+    def page(self, cursor=None):
+        params = {"confirmed": 1, "limit": 3}
+        if cursor is not None:
+            params["cursor"] = cursor
+        return self.client.get("/api/punishments/events/page", params)
+
+    def test_pages_through_ties_without_gaps(self):
+        self.client.force_login(self.target)
+        seen, cursor, pages = [], None, 0
+        while True:
+            body = self.page(cursor).json()
+            seen += [e["id"] for e in body["items"]]
+            pages += 1
+            cursor = body["next_cursor"]
+            if cursor is None:
+                break
+
+        ids = PunishmentEvent.objects.exclude(pk=self.oldest.pk).values_list("id", flat=True)
+        self.assertEqual(seen, sorted(ids, reverse=True) + [self.oldest.id])
+        self.assertEqual(pages, 3)
+
+    def test_last_page_has_no_cursor(self):
+        self.client.force_login(self.target)
+        response = self.client.get("/api/punishments/events/page", {"confirmed": 1, "limit": 7})
+        self.assertEqual(len(response.json()["items"]), 7)
+        self.assertIsNone(response.json()["next_cursor"])
+
+    def test_malformed_cursor_is_a_client_error(self):
+        def encode(raw):
+            return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+        self.client.force_login(self.target)
+        for cursor in [
+            "!!!",
+            "é",
+            encode(b"no separator"),
+            encode(b"yesterday|1"),
+            encode(b"2026-01-01T00:00:00+00:00|x"),
+            encode(b"2026-01-01T00:00:00+00:00|99999999999999999999"),
+            encode(b"\xff\xfe|1"),
+        ]:
+            with self.subTest(cursor=cursor):
+                response = self.page(cursor)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("INVALID_CURSOR", response.content.decode())
+
+
+class BulkCreateEventsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.nurse, *cls.users = (
+            User.objects.create_user(f"bulk-{i}", "pw", tier="vest", force_password_reset=False)
+            for i in range(8)
+        )
+        cls.nurse.user_permissions.add(Permission.objects.get(codename="direct_punish"))
+
+    def setUp(self):
+        patcher = mock.patch.object(api, "send_push_to_users_task")
+        self.push = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def bulk(self, target_ids, amount=2):
+        return self.client.post(
+            "/api/punishments/events/bulk",
+            {"target_ids": target_ids, "amount": amount, "reason": "fika"},
+            content_type="application/json",
+        )
+
+    def test_duplicates_punished_once_and_everyone_notified_once(self):
+        a, b, *others = self.users
+        self.client.force_login(self.nurse)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.bulk([a.id, b.id, a.id])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([e["target"]["id"] for e in response.json()], [a.id, b.id])
+        self.assertEqual(PunishmentEvent.objects.count(), 2)
+        self.assertEqual(get_balance(a.id).punishments_delivered, 2)
+
+        (targets, _, kind), (rest, _, _) = (c.args for c in self.push.delay.call_args_list)
+        self.assertEqual(kind, "punishment_confirmed")
+        self.assertEqual(targets, [a.id, b.id])
+        self.assertCountEqual(rest, [u.id for u in others])
+
+    def test_unknown_target_inserts_nothing(self):
+        self.client.force_login(self.nurse)
+        response = self.bulk([self.users[0].id, 999_999])
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(PunishmentEvent.objects.exists())
+
+    def test_caller_among_targets(self):
+        self.client.force_login(self.users[0])
+        response = self.bulk([self.users[1].id, self.users[0].id])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PunishmentEvent.objects.exists())
+
+    def test_queries_do_not_grow_with_targets(self):
+        self.client.force_login(self.nurse)
+        counts = []
+        for targets in (self.users[:2], self.users[2:]):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.bulk([u.id for u in targets])
+            self.assertEqual(response.status_code, 201)
+            counts.append(len(queries))
+        # session, user, targets, 2 x permissions, insert, 4 x balances,
+        # everyone else, and the savepoint around the writes
+        self.assertEqual(counts, [13, 13])
+
+
+class UserTimelineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.target, cls.initiator, cls.judge = (
+            User.objects.create_user(name, "pw", tier=tier, force_password_reset=False)
+            for name, tier in [
+                ("tl-target", "hat"), ("tl-initiator", "vest"), ("tl-judge", "vest")
+            ]
+        )
+        base = timezone.now() - timedelta(days=1)
+
+        def at(hours):
+            return base + timedelta(hours=hours)
+
+        cls.punishment = PunishmentEvent.objects.create(
+            target=cls.target, initiator=cls.initiator, confirmer=cls.judge,
+            confirmed_at=at(1), amount=3, reason="sen",
+        )
+        PunishmentEvent.objects.create(  # still pending: not on the timeline
+            target=cls.target, initiator=cls.initiator, amount=5,
+            expires_at=timezone.now() + PENDING_PUNISHMENT_TTL,
+        )
+        fika = [
+            FikapinneEvent.objects.create(target=cls.target, judge=cls.judge) for _ in range(3)
+        ]
+        take = TakePunishmentEvent.objects.create(target=cls.target, judge=cls.judge, amount=1)
+        # two fikapinnar at the same instant, and a take tied with the third
+        for event, hours in [(fika[0], 2), (fika[1], 2), (fika[2], 3), (take, 3)]:
+            type(event).objects.filter(pk=event.pk).update(created_at=at(hours))
+
+        cls.expected = [
+            (("punishment_take", take.id), (2, 3)),
+            (("fikapinne", fika[2].id), (3, 3)),
+            (("fikapinne", fika[1].id), (3, 2)),
+            (("fikapinne", fika[0].id), (3, 1)),
+            (("punishment", cls.punishment.id), (3, 0)),
+        ]
+
+    def get(self, **params):
+        response = self.client.get(f"/api/users/{self.target.id}/timeline", params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_newest_first_with_running_balances(self):
+        self.client.force_login(self.judge)
+        body = self.get()
+        self.assertEqual(
+            [
+                ((i["kind"], i["id"]), (i["punishment_balance"], i["fikapinne_balance"]))
+                for i in body["items"]
+            ],
+            self.expected,
+        )
+        self.assertIsNone(body["next_cursor"])
+        self.assertEqual(body["items"][-1]["actor"]["username"], "tl-initiator")
+
+    def test_pages_through_ties(self):
+        self.client.force_login(self.judge)
+        seen, cursor = [], None
+        for _ in range(3):
+            body = self.get(limit=2, **({"cursor": cursor} if cursor else {}))
+            seen += [(i["kind"], i["id"]) for i in body["items"]]
+            cursor = body["next_cursor"]
+        self.assertIsNone(cursor)
+        self.assertEqual(seen, [key for key, _ in self.expected])
+
+    def test_dates_encoded_like_other_endpoints(self):
+        self.client.force_login(self.judge)
+        body = self.get()
+        events = self.client.get("/api/punishments/events", {"confirmed": 1}).json()
+        confirmed_at = next(e["confirmed_at"] for e in events if e["id"] == self.punishment.id)
+        self.assertEqual(body["items"][-1]["at"], confirmed_at)
+
+    def test_malformed_cursor_is_a_client_error(self):
+        self.client.force_login(self.judge)
+        bad_kind = base64.urlsafe_b64encode(b"2026-01-01T00:00:00+00:00|nope|1").decode()
+        for cursor in ["!!!", bad_kind]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(
+                    f"/api/users/{self.target.id}/timeline", {"cursor": cursor}
+                )
+                self.assertEqual(response.status_code, 400)
+
+
+class LiveUpdateTests(TestCase):
+    def test_published_only_after_commit(self):
+        client = mock.Mock()
+        with mock.patch.object(live, "get_redis", return_value=client):
+            with self.captureOnCommitCallbacks() as callbacks:
+                live.publish_on_commit("punishment_taken", ids=[1], target_ids=[2])
+            client.publish.assert_not_called()
+            for callback in callbacks:
+                callback()
+        client.publish.assert_called_once_with(
+            live.LEDGER_CHANNEL,
+            json.dumps({"type": "punishment_taken", "ids": [1], "target_ids": [2]}),
+        )
+
+    def test_rolled_back_write_publishes_nothing(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            try:
+                with transaction.atomic():
+                    live.publish_on_commit("punishment_created", ids=[1])
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(callbacks, [])
+
+    def test_sse_stream_relays_events_and_heartbeats(self):
+        server = fakeredis.FakeServer()
+
+        async def read():
+            stream = live.sse_stream()
+
+            async def frame():
+                return await asyncio.wait_for(anext(stream), 5)
+
+            frames = [await frame()]  # subscribed once this is out
+            live.publish("punishment_created", ids=[7])
+            frames.append(await frame())
+            with mock.patch.object(live, "HEARTBEAT_SECONDS", 0.01):
+                frames.append(await frame())
+            await stream.aclose()
+            return frames
+
+        with (
+            mock.patch.object(
+                live.aioredis.Redis, "from_url",
+                side_effect=lambda url: fakeredis.aioredis.FakeRedis(server=server),
+            ),
+            mock.patch.object(live, "get_redis", return_value=fakeredis.FakeRedis(server=server)),
+        ):
+            frames = async_to_sync(read)()
+
+        self.assertEqual(
+            frames,
+            [
+                "retry: 3000\n\n",
+                'event: punishment_created\ndata: {"type": "punishment_created", "ids": [7]}\n\n',
+                ": keepalive\n\n",
+            ],
+        )
+
+
+class LedgerSerializationTests(TestCase):
+    """The column-only fast paths against the model and the ledger tables."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.target, cls.initiator, cls.confirmer = User.objects.bulk_create(
+            [
+                User(username="ser-target", tier="hat", avatar="users/1/avatar/a.png"),
+                User(username="ser-initiator", tier="vest"),
+                User(username="ser-confirmer", tier=""),
+            ]
+        )
+        now = timezone.now()
+        cls.events = PunishmentEvent.objects.bulk_create(
+            [
+                PunishmentEvent(
+                    target=cls.target, initiator=cls.initiator, amount=1, reason="late",
+                    expires_at=now + PENDING_PUNISHMENT_TTL,
+                ),
+                PunishmentEvent(
+                    target=cls.target, initiator=cls.initiator, confirmer=cls.confirmer,
+                    confirmed_at=now, amount=2,
+                ),
+                PunishmentEvent(
+                    target=cls.target, initiator=cls.initiator, amount=3,
+                    expires_at=now - timedelta(seconds=1),
+                ),
+                PunishmentEvent(
+                    target=cls.target, initiator=cls.confirmer, amount=4, is_direct=True,
+                ),
+            ]
+        )
+        TakePunishmentEvent.objects.create(target=cls.target, judge=cls.confirmer, amount=2)
+        FikapinneEvent.objects.create(target=cls.target, judge=cls.confirmer)
+        TakeFikapinneEvent.objects.create(target=cls.target, judge=cls.confirmer, amount=3)
+
+    def test_fast_rows_match_the_schema_output(self):
+        qs = PunishmentEvent.objects.order_by("id")
+        fast = api._event_rows(qs)
+        slow = [api._event_out(e) for e in qs.select_related("target", "initiator", "confirmer")]
+
+        self.assertEqual(
+            [e["stage"] for e in fast], ["pending", "confirmed", "expired", "confirmed"]
+        )
+        self.assertEqual(fast, slow)
+        self.assertEqual(
+            [api.PunishmentEventOut.model_validate(e).model_dump() for e in fast],
+            [api.PunishmentEventOut.model_validate(e).model_dump() for e in slow],
+        )
+        self.assertEqual(async_to_sync(api._aevent_rows)(qs), fast)
+
+    def test_export_rows_match_the_ledger(self):
+        rows = list(export.iter_rows())
+        self.assertEqual(
+            [(r["kind"], r["id"]) for r in rows],
+            [("punishment", e.id) for e in self.events]
+            + [
+                (kind, model.objects.get().id)
+                for kind, model in [
+                    ("punishment_take", TakePunishmentEvent),
+                    ("fikapinne", FikapinneEvent),
+                    ("fikapinne_take", TakeFikapinneEvent),
+                ]
+            ],
+        )
+        for row, e in zip(rows, PunishmentEvent.objects.order_by("id")):
+            self.assertEqual(
+                (row["amount"], row["stage"], row["actor"], row["confirmer"], row["reason"]),
+                (e.amount, e.stage, e.initiator.username,
+                 e.confirmer and e.confirmer.username, e.reason),
+            )
+        self.assertEqual([r["amount"] for r in rows[4:]], [2, 1, 3])
+
+        def decoded(record):
+            out = {k: v if v != "" else None for k, v in record.items()}
+            for k in ("created_at", "confirmed_at"):
+                if out[k] is not None:
+                    # DjangoJSONEncoder keeps milliseconds only
+                    out[k] = parse_datetime(out[k]).replace(microsecond=0)
+            for k in ("id", "amount"):
+                out[k] = int(out[k])
+            return out
+
+        expected = [
+            {**r, **{k: r[k] and r[k].replace(microsecond=0)
+                     for k in ("created_at", "confirmed_at")}, "reason": r["reason"] or None}
+            for r in rows
+        ]
+        ndjson = [json.loads(line) for line in export.iter_export("ndjson")]
+        self.assertEqual([decoded(r) for r in ndjson], expected)
+
+        reader = csv.DictReader(io.StringIO("".join(export.iter_export("csv"))))
+        self.assertEqual(tuple(reader.fieldnames), export.COLUMNS)
+        self.assertEqual([decoded(r) for r in reader], expected)
@@ -1,9 +1,11 @@
 from django.conf import settings
 from django.utils import timezone
+from kallan.idempotency import idempotent
 from ninja import Schema
 from ninja.router import Router
 
 from .models import NotificationPreferences, WebPushSubscription
+from .services import GONE_STATUSES
 
 router = Router(tags=["push"])
 
@@ -24,18 +26,29 @@ def vapid_public_key(request):
 
 
 @router.post("/subscribe")
+@idempotent
 def subscribe(request, payload: SubscriptionIn):
-    user = request.user
-    WebPushSubscription.objects.update_or_create(
-        endpoint=payload.endpoint,
-        defaults={
-            "user": user,
-            "p256dh": payload.keys.p256dh,
-            "auth": payload.keys.auth,
-            "last_seen_at": timezone.now(),
-            "user_agent": request.META.get("HTTP_USER_AGENT", ""),
-        },
+    fields = {
+        "user": request.user,
+        "p256dh": payload.keys.p256dh,
+        "auth": payload.keys.auth,
+        "last_seen_at": timezone.now(),
+        "user_agent": request.META.get("HTTP_USER_AGENT", ""),
+    }
+    sub, created = WebPushSubscription.objects.get_or_create(
+        endpoint=payload.endpoint, defaults=fields
     )
+    if created:
+        return {"ok": True}
+
+    # Browsers check their subscription in every session. That alone must not
+    # revive an endpoint that deactivated itself by failing; new keys, or an
+    # endpoint the push service had declared gone, start its health over.
+    if (sub.p256dh, sub.auth) != (payload.keys.p256dh, payload.keys.auth) or (
+        not sub.is_active and sub.last_status_code in GONE_STATUSES
+    ):
+        fields.update(is_active=True, consecutive_failures=0)
+    WebPushSubscription.objects.filter(pk=sub.pk).update(**fields)
     return {"ok": True}
 
 
@@ -44,6 +57,7 @@ class UnsubscribeIn(Schema):
 
 
 @router.post("/unsubscribe")
+@idempotent
 def unsubscribe(request, payload: UnsubscribeIn):
     WebPushSubscription.objects.filter(
         endpoint=payload.endpoint, user=request.user
@@ -58,6 +72,7 @@ class NotificationPrefsOut(Schema):
     punishment_taken: bool
     fikapinne_given: bool
     fikapinne_taken: bool
+    digest: bool
 
 
 class NotificationPrefsIn(Schema):
@@ -67,6 +82,7 @@ class NotificationPrefsIn(Schema):
     punishment_taken: bool
     fikapinne_given: bool
     fikapinne_taken: bool
+    digest: bool | None = None  # omitted: unchanged
 
 
 @router.get("/notification-prefs", response=NotificationPrefsOut)
@@ -76,9 +92,12 @@ def get_notification_prefs(request):
 
 
 @router.put("/notification-prefs", response=NotificationPrefsOut)
+@idempotent
 def update_notification_prefs(request, payload: NotificationPrefsIn):
     prefs = NotificationPreferences.for_user(request.user)
     for field in NotificationPrefsIn.model_fields:
-        setattr(prefs, field, getattr(payload, field))
+        value = getattr(payload, field)
+        if value is not None:
+            setattr(prefs, field, value)
     prefs.save()
     return prefs
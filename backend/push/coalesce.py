@@ -0,0 +1,237 @@
+"""Coalescing of bursty notifications.
+
+Pushes of the same type to the same user within a short window are merged:
+the first one goes out right away and opens the window, anything else that
+arrives before it closes is buffered in Redis and sent as a single summary
+("5 nya straff-förslag") when the window ends. Windows are configured per
+type in ``settings.PUSH_COALESCE_WINDOWS`` (seconds, 0 = never coalesce).
+
+Users who turned on ``NotificationPreferences.digest`` get nothing
+immediately; all their notifications are collected for
+``settings.PUSH_DIGEST_WINDOW`` seconds and delivered as one digest.
+
+Each window key holds a token of its own and lives ``WINDOW_GRACE`` seconds
+longer than the flush countdown. A flush only drains the buffer while the
+key still holds its token, so a late flush cannot close (or send) the next
+window's buffer.
+
+If Redis is unavailable everything is sent immediately, as before.
+"""
+
+import json
+import logging
+import uuid
+
+import redis
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from kallan.redis_client import get_redis
+
+from .models import NotificationPreferences
+from .services import fan_out, send_push_to_users
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+# Summary line for n pushes of a type: (n == 1, n > 1).
+SUMMARIES = {
+    "punishment_proposed": ("1 nytt straff-förslag", "{n} nya straff-förslag"),
+    "punishment_confirmed": ("1 nytt straff", "{n} nya straff"),
+    "punishment_cancelled": ("1 straff ångrat", "{n} straff ångrade"),
+    "punishment_taken": ("Straff strukna 1 gång", "Straff strukna {n} gånger"),
+    "fikapinne_given": ("1 ny fikapinne", "{n} nya fikapinnar"),
+    "fikapinne_taken": ("Fikapinnar borttagna 1 gång", "Fikapinnar borttagna {n} gånger"),
+}
+_FALLBACK = ("1 ny notis", "{n} nya notiser")
+
+# Bodies of the merged pushes quoted in a summary before it says "…".
+_MAX_LINES = 3
+
+# Seconds a window key outlives its flush countdown, so a flush that runs a
+# little late still finds its own window open.
+WINDOW_GRACE = 30
+
+# Drain the buffer and close the window, unless the window key now belongs
+# to a newer window (then the buffer is that window's to send). A window key
+# that has already expired means no newer window opened, so drain anyway.
+_DRAIN = """
+local current = redis.call('GET', KEYS[2])
+if ARGV[1] ~= '' and current and current ~= ARGV[1] then
+    return false
+end
+local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+return entries
+"""
+
+
+def _window(notification_type: str) -> int:
+    return int(getattr(settings, "PUSH_COALESCE_WINDOWS", {}).get(notification_type, 0))
+
+
+def _buffer_key(notification_type: str, user_id: int) -> str:
+    return f"push:buf:{notification_type}:{user_id}"
+
+
+def _window_key(notification_type: str, user_id: int) -> str:
+    return f"push:win:{notification_type}:{user_id}"
+
+
+def _digest_key(user_id: int) -> str:
+    return f"push:digest:{user_id}"
+
+
+def _digest_window_key(user_id: int) -> str:
+    return f"push:digest-win:{user_id}"
+
+
+def _users(user_ids) -> list:
+    return list(User.objects.filter(pk__in=user_ids))
+
+
+def dispatch(user_ids, payload: dict, notification_type: str | None = None) -> int:
+    """Send now, buffer, or add to a digest, per user.
+
+    Returns pushes sent now; 0 for a broadcast big enough to be handed to
+    chunk tasks (``services.fan_out``).
+    """
+    from .tasks import flush_coalesced_task, flush_digest_task
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    if notification_type is None:
+        return fan_out(user_ids, payload)
+
+    disabled, digest = set(), set()
+    for prefs in NotificationPreferences.objects.filter(user_id__in=user_ids):
+        if not prefs.is_enabled(notification_type):
+            disabled.add(prefs.user_id)
+        elif prefs.digest:
+            digest.add(prefs.user_id)
+    eligible = [uid for uid in user_ids if uid not in disabled]
+
+    window = _window(notification_type)
+    digest_window = int(getattr(settings, "PUSH_DIGEST_WINDOW", 0))
+    if not digest_window:
+        digest = set()
+    if not window and not digest:
+        return fan_out(eligible, payload)
+
+    entry = json.dumps({"type": notification_type, **payload})
+    tokens = {uid: uuid.uuid4().hex for uid in eligible}
+    now, opened, digests_opened = [], [], []
+    try:
+        client = get_redis()
+        pipe = client.pipeline()
+        for uid in eligible:
+            if uid in digest:
+                pipe.set(
+                    _digest_window_key(uid), tokens[uid], nx=True,
+                    ex=digest_window + WINDOW_GRACE,
+                )
+            elif window:
+                pipe.set(
+                    _window_key(notification_type, uid), tokens[uid], nx=True,
+                    ex=window + WINDOW_GRACE,
+                )
+        claimed = iter(pipe.execute())
+
+        pipe = client.pipeline()
+        for uid in eligible:
+            if uid in digest:
+                if next(claimed):
+                    digests_opened.append(uid)
+                pipe.rpush(_digest_key(uid), entry)
+                pipe.expire(_digest_key(uid), digest_window * 2 + WINDOW_GRACE)
+            elif not window:
+                now.append(uid)
+            elif next(claimed):
+                now.append(uid)
+                opened.append(uid)
+            else:
+                pipe.rpush(_buffer_key(notification_type, uid), entry)
+                pipe.expire(_buffer_key(notification_type, uid), window * 2 + WINDOW_GRACE)
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning("Push coalescing unavailable, sending now", exc_info=True)
+        return fan_out(eligible, payload)
+
+    if opened:
+        flush_coalesced_task.apply_async(
+            (notification_type, opened, [tokens[uid] for uid in opened]), countdown=window
+        )
+    if digests_opened:
+        flush_digest_task.apply_async(
+            (digests_opened, [tokens[uid] for uid in digests_opened]), countdown=digest_window
+        )
+
+    return fan_out(now, payload) if now else 0
+
+
+def _drain(key: str, window_key: str, token: str | None) -> list[dict]:
+    # Close the window together with the drain (one script), so anything
+    # arriving afterwards opens a new window instead of waiting in an
+    # orphaned buffer. No token: a flush queued before windows had tokens.
+    client = get_redis()
+    entries = client.register_script(_DRAIN)(keys=[key, window_key], args=[token or ""])
+    return [json.loads(e) for e in entries or []]
+
+
+def _summary_line(notification_type: str, n: int) -> str:
+    one, many = SUMMARIES.get(notification_type, _FALLBACK)
+    return one if n == 1 else many.format(n=n)
+
+
+def _summary(title: str, lines: list[str], urls: set[str]) -> dict:
+    body = "\n".join(lines[:_MAX_LINES])
+    if len(lines) > _MAX_LINES:
+        body += "\n…"
+    return {"title": title, "body": body, "url": urls.pop() if len(urls) == 1 else "/"}
+
+
+def summarize(notification_type: str, entries: list[dict]) -> dict:
+    """One push standing in for several of the same type."""
+    if len(entries) == 1:
+        return {k: v for k, v in entries[0].items() if k != "type"}
+    title = _summary_line(notification_type, len(entries))
+    lines = [e.get("body") or e.get("title", "") for e in reversed(entries)]
+    return _summary(title, lines, {e.get("url", "/") for e in entries})
+
+
+def summarize_digest(entries: list[dict]) -> dict:
+    """One push standing in for everything a digest user missed."""
+    counts: dict[str, int] = {}
+    for e in entries:
+        counts[e["type"]] = counts.get(e["type"], 0) + 1
+    if len(entries) == 1:
+        return summarize(entries[0]["type"], entries)
+    lines = [_summary_line(t, n) for t, n in counts.items()]
+    return _summary("Sammanfattning", lines, {e.get("url", "/") for e in entries})
+
+
+def flush_coalesced(notification_type: str, user_ids, tokens=None) -> int:
+    """Send what was buffered while each user's window was open.
+
+    ``tokens`` are the windows' tokens, in the order of ``user_ids``.
+    """
+    sent = 0
+    for uid, token in zip(user_ids, tokens or [None] * len(user_ids)):
+        entries = _drain(
+            _buffer_key(notification_type, uid), _window_key(notification_type, uid), token
+        )
+        if entries:
+            sent += send_push_to_users(
+                _users([uid]), summarize(notification_type, entries), notification_type
+            )
+    return sent
+
+
+def flush_digest(user_ids, tokens=None) -> int:
+    sent = 0
+    for uid, token in zip(user_ids, tokens or [None] * len(user_ids)):
+        entries = _drain(_digest_key(uid), _digest_window_key(uid), token)
+        if entries:
+            sent += send_push_to_users(_users([uid]), summarize_digest(entries))
+    return sent
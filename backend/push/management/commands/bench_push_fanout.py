@@ -0,0 +1,152 @@
+import base64
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from py_vapid import Vapid
+from pywebpush import webpush
+
+from push import services
+from push.models import WebPushSubscription
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+class _PushService(BaseHTTPRequestHandler):
+    """Accepts every push after a fixed delay, like a far-away push service."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+    rtt = 0.0
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.rtt)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare pushing one payload to N subscriptions one at a time with a "
+        "new connection each (as before) against push.services.deliver, "
+        "against a local fake push service that answers after --rtt ms, and "
+        "the CPU spent on VAPID signatures with and without the header cache. "
+        "The subscriptions are never saved and have negative ids, so the "
+        "health updates after each fan-out touch no rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscriptions", type=int, nargs="+", default=[10, 50, 200])
+        parser.add_argument("--rtt", type=float, default=100.0, help="milliseconds")
+
+    def handle(self, *args, subscriptions, rtt, **options):
+        _PushService.rtt = rtt / 1000
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _PushService)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        origin = f"http://127.0.0.1:{server.server_address[1]}"
+
+        if not settings.VAPID_PRIVATE_KEY:
+            vapid = Vapid()
+            vapid.generate_keys()
+            settings.VAPID_PRIVATE_KEY = _b64(
+                vapid.private_key.private_bytes(
+                    serialization.Encoding.DER,
+                    serialization.PrivateFormat.PKCS8,
+                    serialization.NoEncryption(),
+                )
+            )
+
+        payload = {"title": "Bench", "body": "x" * 200}
+        self.stdout.write(
+            f"RTT {rtt:.0f} ms, PUSH_CONCURRENCY={settings.PUSH_CONCURRENCY}"
+        )
+        self.stdout.write(
+            f"{'subs':>5} {'serial':>9} {'conns':>6} {'deliver':>9} {'conns':>6} {'speedup':>8}"
+        )
+        try:
+            for n in subscriptions:
+                subs = [self._subscription(i, origin) for i in range(n)]
+                serial, serial_conns = self._time(lambda: self._serial(subs, payload))
+                concurrent, conns = self._time(lambda: services.deliver(subs, payload))
+                self.stdout.write(
+                    f"{n:>5} {serial * 1000:>7.0f}ms {serial_conns:>6} "
+                    f"{concurrent * 1000:>7.0f}ms {conns:>6} {serial / concurrent:>7.1f}x"
+                )
+
+            self.stdout.write("\nCPU per fan-out")
+            self.stdout.write(
+                f"{'subs':>5} {'sign each':>10} {'cached':>9} {'saved':>9} {'deliver':>9}"
+            )
+            for n in subscriptions:
+                subs = [self._subscription(i, origin) for i in range(n)]
+                sign_each = self._cpu(lambda: self._sign_each(subs))
+                cached = self._cpu(lambda: [services.vapid_headers(s.endpoint) for s in subs])
+                deliver = self._cpu(lambda: services.deliver(subs, payload))
+                self.stdout.write(
+                    f"{n:>5} {sign_each * 1000:>8.1f}ms {cached * 1000:>7.2f}ms "
+                    f"{(sign_each - cached) * 1000:>7.1f}ms {deliver * 1000:>7.0f}ms"
+                )
+        finally:
+            server.shutdown()
+
+    def _subscription(self, i, origin) -> WebPushSubscription:
+        key = ec.generate_private_key(ec.SECP256R1())
+        public = key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        )
+        return WebPushSubscription(
+            id=-(i + 1),
+            endpoint=f"{origin}/push/{i}",
+            p256dh=_b64(public),
+            auth=_b64(os.urandom(16)),
+        )
+
+    def _serial(self, subs, payload):
+        for sub in subs:
+            webpush(
+                subscription_info=sub.as_webpush_dict(),
+                data=json.dumps(payload),
+                vapid_private_key=settings.VAPID_PRIVATE_KEY,
+                vapid_claims={"sub": settings.VAPID_SUBJECT},
+            )
+
+    def _sign_each(self, subs):
+        # what webpush() does per call when given the key and claims
+        for sub in subs:
+            Vapid.from_string(private_key=settings.VAPID_PRIVATE_KEY).sign(
+                {
+                    "sub": settings.VAPID_SUBJECT,
+                    "aud": services._origin(sub.endpoint),
+                    "exp": int(time.time()) + services.VAPID_TTL,
+                }
+            )
+
+    def _cpu(self, fn) -> float:
+        """CPU seconds of the whole process (server threads included)."""
+        start = time.process_time()
+        fn()
+        return time.process_time() - start
+
+    def _time(self, fn) -> tuple[float, int]:
+        before = _PushService.connections
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start, _PushService.connections - before
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push', '0002_notificationpreferences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationpreferences',
+            name='digest',
+            field=models.BooleanField(default=False),
+        ),
+    ]
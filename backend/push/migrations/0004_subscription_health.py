@@ -0,0 +1,39 @@
+from django.db import migrations, models
+from django.db.models.functions import Now
+
+
+def start_stale_window(apps, schema_editor):
+    # last_seen_at used to be set once at subscribe; count staleness from now
+    WebPushSubscription = apps.get_model("push", "WebPushSubscription")
+    WebPushSubscription.objects.update(last_seen_at=Now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push', '0003_notificationpreferences_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webpushsubscription',
+            name='consecutive_failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='webpushsubscription',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='webpushsubscription',
+            name='last_status_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='webpushsubscription',
+            name='last_success_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(start_stale_window, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
 
 User = get_user_model()
 
 
+def _stale_before():
+    return timezone.now() - timedelta(days=settings.PUSH_SUBSCRIPTION_STALE_DAYS)
+
+
+class WebPushSubscriptionQuerySet(models.QuerySet):
+    def deliverable(self):
+        """Active subscriptions whose browser checked in recently enough."""
+        return self.filter(is_active=True, last_seen_at__gte=_stale_before())
+
+    def inactive(self):
+        return self.filter(is_active=False)
+
+    def stale(self):
+        """Subscriptions whose browser hasn't checked in for too long."""
+        return self.filter(last_seen_at__lt=_stale_before())
+
+
 class WebPushSubscription(models.Model):
     user = models.ForeignKey(
         User,
@@ -19,6 +40,18 @@ class WebPushSubscription(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     last_seen_at = models.DateTimeField(auto_now=True)
 
+    # Delivery health, updated in bulk after each fan-out (push.services).
+    # Gone (404/410) or too many rejections in a row deactivates a
+    # subscription until the browser subscribes again with new keys (or,
+    # once gone, at all).
+    is_active = models.BooleanField(default=True)
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    last_success_at = models.DateTimeField(null=True, blank=True)
+    # None until the first push, or if the push service couldn't be reached
+    last_status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    objects = WebPushSubscriptionQuerySet.as_manager()
+
     def as_webpush_dict(self):
         return {
             "endpoint": self.endpoint,
@@ -41,6 +74,9 @@ class NotificationPreferences(models.Model):
     fikapinne_given = models.BooleanField(default=True)
     fikapinne_taken = models.BooleanField(default=True)
 
+    # Collect everything into a periodic summary instead of pushing right away
+    digest = models.BooleanField(default=False)
+
     @classmethod
     def for_user(cls, user) -> "NotificationPreferences":
         prefs, _ = cls.objects.get_or_create(user=user)
@@ -1,10 +1,268 @@
+"""Delivery of web pushes.
+
+A fan-out sends one payload to many subscriptions at once. ``deliver`` does
+the HTTP requests on up to ``settings.PUSH_CONCURRENCY`` threads and reuses
+one keep-alive session per push service origin (FCM, Mozilla, Apple, ...),
+so a fan-out takes about one round trip to the slowest service instead of
+one per subscription, and TLS handshakes are paid once per process rather
+than once per push.
+
+The VAPID JWT a push service wants depends only on its origin (the ``aud``
+claim) and an expiry, so ``vapid_headers`` signs one per origin and reuses
+it across pushes and tasks until shortly before it expires, instead of an
+ECDSA signature per push.
+
+The worker threads only do HTTP. The outcomes are written back afterwards
+with a few bulk UPDATEs (``_record_health``): a success resets a
+subscription's failure count, gone (404/410) or
+``settings.PUSH_MAX_CONSECUTIVE_FAILURES`` rejections in a row deactivate
+it, and fan-outs only go to ``WebPushSubscription.objects.deliverable()``.
+Only the subscription's own faults (other 4xx) count as rejections; an
+unreachable or overloaded push service (no response, 5xx, 429), or a
+mistake on our side, is recorded but never held against it.
+``prune_subscriptions`` deletes the gone and the stale ones. A subscription
+deactivated for rejections is kept for as long as its browser checks in, so
+a check-in can't recreate it with a clean record.
+
+A broadcast to more than ``settings.PUSH_FANOUT_CHUNK_SIZE`` users is not
+delivered by the task that asked for it: ``fan_out`` splits it into chunks
+delivered by a Celery chord, so it spreads over every worker process and
+node, and the chord's callback adds up what got delivered.
+"""
+
+import functools
 import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import urlsplit
 
+import requests
 from django.conf import settings
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from py_vapid import Vapid, Vapid01
 from pywebpush import WebPushException, webpush
+from requests.adapters import HTTPAdapter
 
 from .models import NotificationPreferences, WebPushSubscription
 
+logger = logging.getLogger(__name__)
+
+# Push services answer these for subscriptions that will never work again.
+GONE_STATUSES = (404, 410)
+# Push service is throttling us: try again later, the subscription is fine.
+TOO_MANY_REQUESTS = 429
+
+# Lifetime of a signed VAPID JWT (push services accept up to 24 h), and how
+# long before its expiry it is replaced by a fresh one.
+VAPID_TTL = 12 * 60 * 60
+VAPID_RENEW_BEFORE = 10 * 60
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+# (origin, subject, key) -> (exp, headers)
+_vapid_cache: dict[tuple, tuple[int, dict]] = {}
+_vapid_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class PushResult:
+    subscription_id: int
+    status: int | None  # HTTP status, None if the push service wasn't reached
+    error: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return self.status is not None and self.status < 400
+
+    @property
+    def gone(self) -> bool:
+        return self.status in GONE_STATUSES
+
+    @property
+    def transient(self) -> bool:
+        """Failed for reasons outside the subscription (push service or us)."""
+        return self.status is None or self.status >= 500 or self.status == TOO_MANY_REQUESTS
+
+
+def _origin(endpoint: str) -> str:
+    parts = urlsplit(endpoint)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _session(endpoint: str) -> requests.Session:
+    """The process's keep-alive session for the endpoint's push service."""
+    origin = _origin(endpoint)
+    with _sessions_lock:
+        session = _sessions.get(origin)
+        if session is None:
+            session = requests.Session()
+            # room for every thread of a fan-out to keep a connection open
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.PUSH_CONCURRENCY)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[origin] = session
+    return session
+
+
+@functools.lru_cache(maxsize=4)
+def _load_vapid_key(private_key: str) -> Vapid01:
+    # the forms pywebpush accepts: a key file, or the key itself
+    if os.path.isfile(private_key):
+        return Vapid.from_file(private_key_file=private_key)
+    return Vapid.from_string(private_key=private_key)
+
+
+def vapid_headers(endpoint: str) -> dict:
+    """Signed VAPID headers for the endpoint's push service, cached per origin."""
+    key = settings.VAPID_PRIVATE_KEY
+    if not key:
+        raise WebPushException("VAPID_PRIVATE_KEY is not set")
+    origin = _origin(endpoint)
+    cache_key = (origin, settings.VAPID_SUBJECT, key)
+    now = int(time.time())
+    with _vapid_lock:
+        cached = _vapid_cache.get(cache_key)
+    if cached is not None and cached[0] - VAPID_RENEW_BEFORE > now:
+        return cached[1]
+
+    vapid = key if isinstance(key, Vapid01) else _load_vapid_key(key)
+    exp = now + VAPID_TTL
+    headers = vapid.sign({"sub": settings.VAPID_SUBJECT, "aud": origin, "exp": exp})
+    with _vapid_lock:
+        _vapid_cache[cache_key] = (exp, headers)
+    return headers
+
+
+def _send(sub: WebPushSubscription, data: str) -> PushResult:
+    try:
+        response = webpush(
+            subscription_info=sub.as_webpush_dict(),
+            data=data,
+            headers=vapid_headers(sub.endpoint),
+            timeout=settings.PUSH_TIMEOUT,
+            requests_session=_session(sub.endpoint),
+        )
+    except WebPushException as e:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        return PushResult(sub.id, status, str(e))
+    except requests.RequestException as e:
+        return PushResult(sub.id, None, str(e))
+    except Exception as e:
+        # e.g. keys the browser sent that don't decode; one bad row must not
+        # abort the rest of the fan-out (or its chord)
+        logger.exception("Could not push to subscription %s", sub.id)
+        return PushResult(sub.id, None, repr(e))
+    return PushResult(sub.id, response.status_code)
+
+
+def deliver(subs, payload: dict) -> list[PushResult]:
+    """Push ``payload`` to every subscription; one result per subscription, in order."""
+    subs = list(subs)
+    if not subs:
+        return []
+    data = json.dumps(payload)
+    workers = max(1, min(settings.PUSH_CONCURRENCY, len(subs)))
+    if workers == 1:
+        results = [_send(sub, data) for sub in subs]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webpush") as pool:
+            results = list(pool.map(_send, subs, [data] * len(subs)))
+
+    _record_health(results)
+    for sub, result in zip(subs, results):
+        if not result.ok and not result.gone:
+            logger.warning(
+                "Push to %s failed (%s): %s", _origin(sub.endpoint), result.status, result.error
+            )
+    return results
+
+
+def _record_health(results: list[PushResult]) -> None:
+    """Write a fan-out's outcomes back, one UPDATE per (outcome, status)."""
+    groups = defaultdict(list)
+    for r in results:
+        outcome = (
+            "ok" if r.ok else "gone" if r.gone else "transient" if r.transient else "rejected"
+        )
+        groups[outcome, r.status].append(r.subscription_id)
+
+    now = timezone.now()
+    failures = F("consecutive_failures") + 1
+    for (outcome, status), ids in groups.items():
+        subs = WebPushSubscription.objects.filter(id__in=ids)
+        if outcome == "ok":
+            subs.update(consecutive_failures=0, last_success_at=now, last_status_code=status)
+        elif outcome == "gone":
+            deactivated = subs.update(
+                is_active=False, consecutive_failures=failures, last_status_code=status
+            )
+            logger.info("Deactivated %d gone push subscriptions", deactivated)
+        elif outcome == "transient":
+            subs.update(last_status_code=status)
+        else:
+            subs.update(
+                consecutive_failures=failures,
+                last_status_code=status,
+                # the old count: this failure is the limit-th in a row
+                is_active=Case(
+                    When(
+                        consecutive_failures__gte=settings.PUSH_MAX_CONSECUTIVE_FAILURES - 1,
+                        then=Value(False),
+                    ),
+                    default=F("is_active"),
+                ),
+            )
+
+
+def prune_subscriptions() -> int:
+    """Delete gone and stale subscriptions; returns how many."""
+    subs = WebPushSubscription.objects
+    gone = subs.inactive().filter(last_status_code__in=GONE_STATUSES)
+    deleted, _ = (gone | subs.stale()).delete()
+    return deleted
+
+
+def tally(results: list[PushResult]) -> dict[str, int]:
+    delivered = sum(r.ok for r in results)
+    gone = sum(r.gone for r in results)
+    return {"delivered": delivered, "gone": gone, "failed": len(results) - delivered - gone}
+
+
+def deliver_to_users(user_ids, payload: dict) -> list[PushResult]:
+    """Push to every deliverable subscription of the users, preferences aside."""
+    subs = WebPushSubscription.objects.deliverable().filter(user_id__in=list(user_ids))
+    return deliver(subs, payload)
+
+
+def fan_out(user_ids, payload: dict) -> int:
+    """Push to users already cleared by their preferences.
+
+    Up to ``PUSH_FANOUT_CHUNK_SIZE`` users are delivered right here; a bigger
+    broadcast is queued as a chord of chunk tasks instead. Returns the pushes
+    delivered here, 0 if queued (the chord's callback logs those).
+    """
+    from celery import chord
+
+    from .tasks import deliver_push_chunk_task, push_fanout_summary_task
+
+    user_ids = list(user_ids)
+    size = settings.PUSH_FANOUT_CHUNK_SIZE
+    if len(user_ids) <= size:
+        return tally(deliver_to_users(user_ids, payload))["delivered"]
+
+    chunks = [user_ids[i : i + size] for i in range(0, len(user_ids), size)]
+    chord(deliver_push_chunk_task.s(chunk, payload) for chunk in chunks)(
+        push_fanout_summary_task.s()
+    )
+    return 0
+
 
 def send_push_to_user(user, payload: dict, notification_type: str | None = None) -> int:
     # Check per-type preference before doing any work
@@ -13,32 +271,8 @@ def send_push_to_user(user, payload: dict, notification_type: str | None = None)
         if not prefs.is_enabled(notification_type):
             return 0
 
-    ok = 0
-    subs = WebPushSubscription.objects.filter(user=user)
-
-    for sub in subs:
-        subscription_info = {
-            "endpoint": sub.endpoint,
-            "keys": {"p256dh": sub.p256dh, "auth": sub.auth},
-        }
-
-        try:
-            webpush(
-                subscription_info=subscription_info,
-                data=json.dumps(payload),
-                vapid_private_key=settings.VAPID_PRIVATE_KEY,
-                vapid_claims={"sub": settings.VAPID_SUBJECT},
-            )
-            ok += 1
-        except WebPushException as e:
-            status = getattr(getattr(e, "response", None), "status_code", None)
-            if status in (404, 410):
-                sub.delete()
-            else:
-                print("PUSH Failed")
-                print(e)
-
-    return ok
+    results = deliver(WebPushSubscription.objects.deliverable().filter(user=user), payload)
+    return sum(r.ok for r in results)
 
 
 def send_push_to_users(
@@ -47,7 +281,8 @@ def send_push_to_users(
     """Send a push notification to multiple users, respecting per-user preferences.
 
     More efficient than calling send_push_to_user in a loop when sending to many users,
-    because it batches the subscription query and preference checks.
+    because it batches the subscription query and preference checks and delivers to
+    all subscriptions concurrently.
     """
 
     user_ids = [u.pk for u in users]
@@ -55,8 +290,6 @@ def send_push_to_users(
     # Load all prefs for these users in one query (only if we care about type)
     disabled_ids: set[int] = set()
     if notification_type is not None:
-        from django.db.models import Q
-
         prefs_qs = NotificationPreferences.objects.filter(user_id__in=user_ids)
         for prefs in prefs_qs:
             if not prefs.is_enabled(notification_type):
@@ -64,28 +297,5 @@ def send_push_to_users(
 
     # Load all subscriptions for eligible users in one query
     eligible_ids = [uid for uid in user_ids if uid not in disabled_ids]
-    subs = WebPushSubscription.objects.filter(user_id__in=eligible_ids)
-
-    ok = 0
-    for sub in subs:
-        subscription_info = {
-            "endpoint": sub.endpoint,
-            "keys": {"p256dh": sub.p256dh, "auth": sub.auth},
-        }
-        try:
-            webpush(
-                subscription_info=subscription_info,
-                data=json.dumps(payload),
-                vapid_private_key=settings.VAPID_PRIVATE_KEY,
-                vapid_claims={"sub": settings.VAPID_SUBJECT},
-            )
-            ok += 1
-        except WebPushException as e:
-            status = getattr(getattr(e, "response", None), "status_code", None)
-            if status in (404, 410):
-                sub.delete()
-            else:
-                print("PUSH Failed")
-                print(e)
-
-    return ok
+    results = deliver_to_users(eligible_ids, payload)
+    return sum(r.ok for r in results)
@@ -1,27 +1,66 @@
+import logging
+
 from celery import shared_task
 
+logger = logging.getLogger(__name__)
+
 
 @shared_task
 def send_push_to_user_task(user_id: int, payload: dict, notification_type: str | None = None) -> int:
-    from django.contrib.auth import get_user_model
-    from .services import send_push_to_user
+    from .coalesce import dispatch
 
-    User = get_user_model()
-    try:
-        user = User.objects.get(pk=user_id)
-    except User.DoesNotExist:
-        return 0
-    return send_push_to_user(user, payload, notification_type)
+    return dispatch([user_id], payload, notification_type)
 
 
 @shared_task
 def send_push_to_users_task(user_ids: list[int], payload: dict, notification_type: str | None = None) -> int:
-    from django.contrib.auth import get_user_model
-    from .services import send_push_to_users
+    from .coalesce import dispatch
 
     if not user_ids:
         return 0
 
-    User = get_user_model()
-    users = list(User.objects.filter(pk__in=user_ids))
-    return send_push_to_users(users, payload, notification_type)
+    return dispatch(user_ids, payload, notification_type)
+
+
+@shared_task
+def deliver_push_chunk_task(user_ids: list[int], payload: dict) -> dict[str, int]:
+    """One chunk of a broadcast (see ``services.fan_out``)."""
+    from .services import deliver_to_users, tally
+
+    return tally(deliver_to_users(user_ids, payload))
+
+
+@shared_task
+def push_fanout_summary_task(chunk_counts: list[dict[str, int]]) -> dict[str, int]:
+    totals = {"delivered": 0, "gone": 0, "failed": 0}
+    for counts in chunk_counts:
+        for key in totals:
+            totals[key] += counts.get(key, 0)
+    logger.info(
+        "Broadcast in %d chunks: %d delivered, %d gone, %d failed",
+        len(chunk_counts), totals["delivered"], totals["gone"], totals["failed"],
+    )
+    return totals
+
+
+@shared_task
+def flush_coalesced_task(
+    notification_type: str, user_ids: list[int], tokens: list[str] | None = None
+) -> int:
+    from .coalesce import flush_coalesced
+
+    return flush_coalesced(notification_type, user_ids, tokens)
+
+
+@shared_task
+def flush_digest_task(user_ids: list[int], tokens: list[str] | None = None) -> int:
+    from .coalesce import flush_digest
+
+    return flush_digest(user_ids, tokens)
+
+
+@shared_task
+def prune_push_subscriptions() -> int:
+    from .services import prune_subscriptions
+
+    return prune_subscriptions()
@@ -1,3 +1,333 @@
-from django.test import TestCase
+import base64
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import requests
+from cryptography.hazmat.primitives import serialization
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from kallan.celery import app as celery_app
+from kallan.redis_client import get_redis
+from py_vapid import Vapid
+from pywebpush import WebPushException
+
+from . import coalesce, services, tasks
+from .models import NotificationPreferences, WebPushSubscription
+
+User = get_user_model()
+
+
+def _vapid_private_key() -> str:
+    """A fresh key in the form VAPID_PRIVATE_KEY takes: base64url DER."""
+    vapid = Vapid()
+    vapid.generate_keys()
+    der = vapid.private_key.private_bytes(
+        serialization.Encoding.DER,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    return base64.urlsafe_b64encode(der).decode().rstrip("=")
+
+
+VAPID_KEY = _vapid_private_key()
+
+
+def _response(status):
+    response = requests.Response()
+    response.status_code = status
+    return response
+
+
+@override_settings(PUSH_CONCURRENCY=4, VAPID_PRIVATE_KEY=VAPID_KEY)
+class DeliveryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", "pw")
+        cls.bob = User.objects.create_user("bob", "pw", force_password_reset=False)
+        for user, name in [
+            (cls.alice, "ok"),
+            (cls.alice, "gone"),
+            (cls.bob, "error"),
+            (cls.bob, "unreachable"),
+        ]:
+            WebPushSubscription.objects.create(
+                user=user, endpoint=f"https://push.example/{name}", p256dh="k", auth="a"
+            )
+
+    def fake_webpush(self, subscription_info, requests_session, headers, **kwargs):
+        self.sessions.append(requests_session)
+        self.assertTrue(headers["Authorization"].startswith("vapid "))
+        name = subscription_info["endpoint"].rsplit("/", 1)[1]
+        if name == "gone":
+            raise WebPushException("gone", response=_response(410))
+        if name == "error":
+            raise WebPushException("server error", response=_response(500))
+        if name == "unavailable":
+            raise WebPushException("unavailable", response=_response(503))
+        if name == "rejected":
+            raise WebPushException("forbidden", response=_response(403))
+        if name == "unreachable":
+            raise requests.ConnectionError("refused")
+        return _response(201)
+
+    def setUp(self):
+        self.sessions = []
+        patcher = mock.patch.object(services, "webpush", side_effect=self.fake_webpush)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_per_subscription(self):
+        subs = list(WebPushSubscription.objects.order_by("id"))
+        with self.assertLogs("push.services", "WARNING") as logs:
+            results = services.deliver(subs, {"title": "t"})
+
+        self.assertEqual([r.subscription_id for r in results], [s.id for s in subs])
+        self.assertEqual([r.status for r in results], [201, 410, 500, None])
+        self.assertEqual([r.ok for r in results], [True, False, False, False])
+        self.assertEqual(len(logs.records), 2)
+        # one keep-alive session for the push service's origin
+        self.assertEqual(len(set(map(id, self.sessions))), 1)
+
+    def health(self):
+        return {
+            s.endpoint.rsplit("/", 1)[1]: (
+                s.is_active, s.consecutive_failures, s.last_status_code, s.last_success_at is not None
+            )
+            for s in WebPushSubscription.objects.all()
+        }
+
+    def test_health_recorded_in_bulk(self):
+        subs = list(WebPushSubscription.objects.all())
+        with self.assertLogs("push.services", "WARNING"), self.assertNumQueries(4):
+            services.deliver(subs, {"title": "t"})
+        self.assertEqual(
+            self.health(),
+            {
+                "ok": (True, 0, 201, True),
+                "gone": (False, 1, 410, False),
+                "error": (True, 0, 500, False),
+                "unreachable": (True, 0, None, False),
+            },
+        )
+
+    @override_settings(PUSH_MAX_CONSECUTIVE_FAILURES=3)
+    def test_deactivated_after_repeated_rejections(self):
+        rejected = WebPushSubscription.objects.create(
+            user=self.bob, endpoint="https://push.example/rejected", p256dh="k", auth="a"
+        )
+        for expected_active in (True, True, False):
+            with self.assertLogs("push.services", "WARNING"):
+                services.deliver([rejected], {})
+            rejected.refresh_from_db()
+            self.assertEqual(rejected.is_active, expected_active)
+        self.assertEqual((rejected.consecutive_failures, rejected.last_status_code), (3, 403))
+
+        # a success in between starts the count over
+        ok = WebPushSubscription.objects.get(endpoint="https://push.example/ok")
+        ok.consecutive_failures = 2
+        ok.save()
+        services.deliver([ok], {})
+        ok.refresh_from_db()
+        self.assertEqual((ok.is_active, ok.consecutive_failures), (True, 0))
+
+    @override_settings(PUSH_MAX_CONSECUTIVE_FAILURES=3)
+    def test_outages_do_not_deactivate(self):
+        unavailable = WebPushSubscription.objects.create(
+            user=self.bob, endpoint="https://push.example/unavailable", p256dh="k", auth="a"
+        )
+        unreachable = WebPushSubscription.objects.get(endpoint__endswith="/unreachable")
+        for _ in range(5):
+            with self.assertLogs("push.services", "WARNING"):
+                services.deliver([unavailable, unreachable], {})
+        self.assertEqual(
+            {k: v for k, v in self.health().items() if k in ("unavailable", "unreachable")},
+            {"unavailable": (True, 0, 503, False), "unreachable": (True, 0, None, False)},
+        )
+
+    @override_settings(VAPID_PRIVATE_KEY="")
+    def test_missing_vapid_key_does_not_deactivate(self):
+        ok = WebPushSubscription.objects.get(endpoint__endswith="/ok")
+        for _ in range(6):
+            with self.assertLogs("push.services", "WARNING"):
+                services.deliver([ok], {})
+        ok.refresh_from_db()
+        self.assertEqual((ok.is_active, ok.consecutive_failures), (True, 0))
+
+    @override_settings(PUSH_SUBSCRIPTION_STALE_DAYS=30)
+    def test_inactive_and_stale_are_skipped(self):
+        WebPushSubscription.objects.filter(endpoint__endswith="/gone").update(is_active=False)
+        WebPushSubscription.objects.filter(endpoint__endswith="/error").update(
+            last_seen_at=timezone.now() - timedelta(days=31)
+        )
+        with self.assertLogs("push.services", "WARNING"):
+            self.assertEqual(services.send_push_to_users([self.alice, self.bob], {}), 1)
+        self.assertEqual(len(self.sessions), 2)  # ok and unreachable
+
+    @override_settings(PUSH_SUBSCRIPTION_STALE_DAYS=30)
+    def test_prune_and_resubscribe(self):
+        WebPushSubscription.objects.filter(endpoint__endswith="/gone").update(
+            is_active=False, last_status_code=410
+        )
+        WebPushSubscription.objects.filter(endpoint__endswith="/unreachable").update(
+            last_seen_at=timezone.now() - timedelta(days=31)
+        )
+        # deactivated for rejections, but its browser still checks in
+        WebPushSubscription.objects.filter(endpoint__endswith="/ok").update(
+            is_active=False, consecutive_failures=5, last_status_code=403
+        )
+        self.assertEqual(services.prune_subscriptions(), 2)
+        self.assertEqual(sorted(self.health()), ["error", "ok"])
+
+        WebPushSubscription.objects.filter(endpoint__endswith="/error").update(
+            is_active=False, consecutive_failures=5
+        )
+        self.client.force_login(self.bob)
+        response = self.client.post(
+            "/api/push/subscribe",
+            {"endpoint": "https://push.example/error", "keys": {"p256dh": "k2", "auth": "a2"}},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.health()["error"][:2], (True, 0))
+
+    def test_check_in_keeps_failing_endpoint_down(self):
+        WebPushSubscription.objects.filter(endpoint__endswith="/error").update(
+            is_active=False, consecutive_failures=5, last_status_code=500,
+            last_seen_at=timezone.now() - timedelta(days=3),
+        )
+        WebPushSubscription.objects.filter(endpoint__endswith="/gone").update(
+            is_active=False, consecutive_failures=1, last_status_code=410
+        )
+        self.client.force_login(self.bob)
+        for name in ("error", "gone"):
+            response = self.client.post(
+                "/api/push/subscribe",
+                {"endpoint": f"https://push.example/{name}", "keys": {"p256dh": "k", "auth": "a"}},
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+
+        health = self.health()
+        self.assertEqual(health["error"][:2], (False, 5))
+        self.assertEqual(health["gone"][:2], (True, 0))
+        error = WebPushSubscription.objects.get(endpoint__endswith="/error")
+        self.assertGreater(error.last_seen_at, timezone.now() - timedelta(minutes=1))
+
+    def test_session_per_origin(self):
+        fcm = services._session("https://fcm.googleapis.com/fcm/send/a")
+        self.assertIs(services._session("https://fcm.googleapis.com/fcm/send/b"), fcm)
+        self.assertIsNot(services._session("https://updates.push.services.mozilla.com/x"), fcm)
+
+    def test_send_to_users_skips_disabled(self):
+        prefs = NotificationPreferences.for_user(self.bob)
+        prefs.fikapinne_given = False
+        prefs.save()
+
+        with self.assertLogs("push.services", "WARNING"):
+            self.assertEqual(
+                services.send_push_to_users([self.alice, self.bob], {}, "punishment_proposed"), 1
+            )
+        self.assertEqual(
+            services.send_push_to_users([self.alice, self.bob], {}, "fikapinne_given"), 1
+        )
+        self.assertEqual(len(self.sessions), 5)
+
+    @override_settings(PUSH_FANOUT_CHUNK_SIZE=1)
+    def test_broadcast_in_chunks(self):
+        chunk_task = tasks.deliver_push_chunk_task
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        with (
+            mock.patch.object(chunk_task, "run", wraps=chunk_task.run) as chunk,
+            self.assertLogs("push.tasks", "INFO") as logs,
+            self.assertLogs("push.services", "WARNING"),
+        ):
+            sent = tasks.send_push_to_users_task([self.alice.id, self.bob.id], {"title": "t"})
+
+        self.assertEqual(sent, 0)  # delivered by the chunk tasks
+        self.assertEqual(
+            sorted(c.args[0] for c in chunk.call_args_list), [[self.alice.id], [self.bob.id]]
+        )
+        self.assertEqual(len(self.sessions), 4)
+        self.assertIn("2 chunks: 1 delivered, 1 gone, 2 failed", logs.output[-1])
+
+    def test_small_broadcast_inline(self):
+        with mock.patch("celery.chord") as chord, self.assertLogs("push.services", "WARNING"):
+            sent = tasks.send_push_to_users_task([self.alice.id, self.bob.id], {"title": "t"})
+        self.assertEqual(sent, 1)
+        chord.assert_not_called()
+
+
+@override_settings(VAPID_PRIVATE_KEY=VAPID_KEY, VAPID_SUBJECT="mailto:admin@example.com")
+class VapidHeaderTests(SimpleTestCase):
+    def setUp(self):
+        services._vapid_cache.clear()
+
+    def test_signed_once_per_origin(self):
+        with mock.patch.object(Vapid, "sign", autospec=True, side_effect=Vapid.sign) as sign:
+            fcm = services.vapid_headers("https://fcm.googleapis.com/fcm/send/a")
+            self.assertIs(services.vapid_headers("https://fcm.googleapis.com/fcm/send/b"), fcm)
+            mozilla = services.vapid_headers("https://updates.push.services.mozilla.com/x")
+        self.assertEqual(sign.call_count, 2)
+        self.assertNotEqual(mozilla["Authorization"], fcm["Authorization"])
+        self.assertEqual(sign.call_args_list[0].args[1]["aud"], "https://fcm.googleapis.com")
+
+    def test_renewed_before_expiry(self):
+        endpoint = "https://fcm.googleapis.com/fcm/send/a"
+        now = 1_700_000_000
+        with mock.patch.object(services.time, "time", return_value=now):
+            first = services.vapid_headers(endpoint)
+        renew_at = now + services.VAPID_TTL - services.VAPID_RENEW_BEFORE
+        with mock.patch.object(services.time, "time", return_value=renew_at - 1):
+            self.assertIs(services.vapid_headers(endpoint), first)
+        with mock.patch.object(services.time, "time", return_value=renew_at):
+            self.assertIsNot(services.vapid_headers(endpoint), first)
+
+    @override_settings(VAPID_PRIVATE_KEY="")
+    def test_missing_key(self):
+        with self.assertRaises(WebPushException):
+            services.vapid_headers("https://fcm.googleapis.com/fcm/send/a")
+
+
+@override_settings(PUSH_COALESCE_WINDOWS={"fikapinne_given": 60})
+class CoalesceWindowTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", "pw")
+
+    def setUp(self):
+        get_redis().flushdb()
+        patchers = [
+            mock.patch.object(coalesce, "fan_out", return_value=1),
+            mock.patch.object(coalesce, "send_push_to_users", return_value=1),
+            mock.patch.object(tasks.flush_coalesced_task, "apply_async"),
+        ]
+        self.fan_out, self.send, self.schedule = (p.start() for p in patchers)
+        for p in patchers:
+            self.addCleanup(p.stop)
+
+    def push(self, body):
+        coalesce.dispatch([self.alice.id], {"title": "t", "body": body}, "fikapinne_given")
+
+    def test_window_outlives_its_countdown(self):
+        self.push("first")
+        (args,), kwargs = self.schedule.call_args
+        self.assertEqual(kwargs["countdown"], 60)
+        ttl = get_redis().ttl(coalesce._window_key("fikapinne_given", self.alice.id))
+        self.assertGreater(ttl, 60)
+
+    def test_late_flush_leaves_the_next_window_alone(self):
+        self.push("first")
+        (args,), _ = self.schedule.call_args
+        get_redis().delete(coalesce._window_key("fikapinne_given", self.alice.id))
+        self.push("second")  # the old window is gone: opens a new one
+        (next_args,), _ = self.schedule.call_args
+        self.push("third")
+
+        self.assertEqual(coalesce.flush_coalesced(*args), 0)
+        self.send.assert_not_called()
+        self.assertEqual(coalesce.flush_coalesced(*next_args), 1)
+        (_, payload, _), _ = self.send.call_args
+        self.assertEqual(payload["body"], "third")
+        self.assertFalse(get_redis().exists(coalesce._window_key("fikapinne_given", self.alice.id)))
@@ -1,7 +1,10 @@
+import base64
+from datetime import datetime
+
 from django.contrib.auth import authenticate, get_user_model, update_session_auth_hash
 from django.contrib.auth import login as django_login
 from django.contrib.auth import logout as django_logout
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from ninja import File, Router, Schema
@@ -9,11 +12,14 @@ from ninja.errors import HttpError
 from ninja.files import UploadedFile
 from ninja.security import SessionAuth
 
-from django.db.models import Count, Sum
-
-from punishments.models import FikapinneEvent, PunishmentEvent, TakeFikapinneEvent, TakePunishmentEvent
+from kallan.async_db import async_when_asgi, gather_db, streaming_content
+from kallan.cache import TAG_FIKAPINNAR, TAG_PUNISHMENTS, TAG_USERS, cached_response
+from kallan.idempotency import idempotent
+from kallan.renderers import render_json
+from kallan.versioning import etag_by_ledger_version
+from punishments.services import TIMELINE_KINDS, get_balances, iter_timeline
 from users.schemas import MeOut, UserMiniOut, UserWithStatsOut
-from users.utils import user_to_mini
+from users.utils import user_to_mini, users_with_perm
 
 User = get_user_model()
 
@@ -66,7 +72,16 @@ def set_password(request, payload: SetPasswordIn):
     return {"ok": True}
 
 
+async def _async_me(request):
+    u = request.auth
+    data = user_to_mini(request, u, with_permissions=False)
+    data["permissions"] = list(await u.aget_all_permissions())
+    data["force_password_reset"] = u.force_password_reset
+    return data
+
+
 @router.get("/me", auth=session_auth, response=MeOut)
+@async_when_asgi(_async_me)
 def me(request):
     u = request.auth
     data = user_to_mini(request, u)
@@ -75,6 +90,7 @@ def me(request):
 
 
 @router.post("/me/avatar", response=MeOut)
+@idempotent
 def set_avatar(request, avatar: UploadedFile = File(...)):
     user = request.auth
 
@@ -102,13 +118,7 @@ def set_avatar(request, avatar: UploadedFile = File(...)):
     return data
 
 
-@router.get("", response=list[UserWithStatsOut])
-def list_users(
-    request,
-    q: str | None = None,
-    exclude_me: bool = True,
-    limit: int = 50,
-):
+def _users_query(request, q: str | None, exclude_me: bool, limit: int):
     me = request.auth
 
     if limit < 1 or limit > 50:
@@ -124,52 +134,129 @@ def list_users(
         if q:
             qs = qs.filter(username__icontains=q)
 
-    users_list = list(qs.order_by("username")[:limit])
-    if not users_list:
-        return []
-
-    user_ids = [u.id for u in users_list]
+    return qs.order_by("username")[:limit]
 
-    delivered = dict(
-        PunishmentEvent.objects.delivered().filter(target_id__in=user_ids)
-        .values("target_id")
-        .annotate(total=Sum("amount"))
-        .values_list("target_id", "total")
-    )
-    taken_punishments = dict(
-        TakePunishmentEvent.objects.filter(target_id__in=user_ids)
-        .values("target_id")
-        .annotate(total=Sum("amount"))
-        .values_list("target_id", "total")
-    )
-    given_fika = dict(
-        FikapinneEvent.objects.filter(target_id__in=user_ids)
-        .values("target_id")
-        .annotate(total=Count("id"))
-        .values_list("target_id", "total")
-    )
-    taken_fika = dict(
-        TakeFikapinneEvent.objects.filter(target_id__in=user_ids)
-        .values("target_id")
-        .annotate(total=Sum("amount"))
-        .values_list("target_id", "total")
-    )
 
+def _users_with_stats(request, users_list, balances, bongskoterskor) -> list[dict]:
     results = []
     for u in users_list:
-        data = user_to_mini(request, u)
-        d = int(delivered.get(u.id, 0) or 0)
-        t = int(taken_punishments.get(u.id, 0) or 0)
-        data["punishment_count"] = max(0, d - t)
-        gf = int(given_fika.get(u.id, 0) or 0)
-        tf = int(taken_fika.get(u.id, 0) or 0)
-        data["fikapinne_count"] = max(0, gf - tf)
-        data["is_bongskoterska"] = "punishments.direct_punish" in data.get("permissions", [])
+        data = user_to_mini(request, u, with_permissions=False)
+        balance = balances[u.id]
+        data["punishment_count"] = balance.punishment_count
+        data["fikapinne_count"] = balance.fikapinne_count
+        data["is_bongskoterska"] = u.id in bongskoterskor
         results.append(data)
     return results
 
 
+async def _async_list_users(
+    request,
+    q: str | None = None,
+    exclude_me: bool = True,
+    limit: int = 50,
+):
+    users_list = [u async for u in _users_query(request, q, exclude_me, limit)]
+    if not users_list:
+        return []
+
+    ids = [u.id for u in users_list]
+    balances, bongskoterskor = await gather_db(
+        (get_balances, ids),
+        (users_with_perm, ids, "punishments.direct_punish"),
+    )
+    return _users_with_stats(request, users_list, balances, bongskoterskor)
+
+
+@router.get("", response=list[UserWithStatsOut])
+@etag_by_ledger_version
+@cached_response(TAG_USERS, TAG_PUNISHMENTS, TAG_FIKAPINNAR)
+@async_when_asgi(_async_list_users)
+def list_users(
+    request,
+    q: str | None = None,
+    exclude_me: bool = True,
+    limit: int = 50,
+):
+    users_list = list(_users_query(request, q, exclude_me, limit))
+    if not users_list:
+        return []
+
+    ids = [u.id for u in users_list]
+    balances = get_balances(ids)
+    bongskoterskor = users_with_perm(ids, "punishments.direct_punish")
+    return _users_with_stats(request, users_list, balances, bongskoterskor)
+
+
 @router.get("/{user_id}", response=UserMiniOut)
+@cached_response(TAG_USERS)
 def get_user(request, user_id: int):
     u = get_object_or_404(User, id=user_id)
-    return user_to_mini(request, u)
+    return user_to_mini(request, u, with_permissions=False)
+
+
+def _encode_timeline_cursor(row: dict) -> str:
+    raw = f"{row['at'].isoformat()}|{row['kind']}|{row['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_timeline_cursor(cursor: str) -> tuple[datetime, str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        at, kind, row_id = raw.split("|")
+        at, row_id = datetime.fromisoformat(at), int(row_id)
+        if kind not in TIMELINE_KINDS or not 0 < row_id < 2**63:
+            raise ValueError(raw)
+        return at, kind, row_id
+    except (ValueError, UnicodeDecodeError):
+        raise HttpError(400, "INVALID_CURSOR")
+
+
+def _timeline_item(row: dict) -> dict:
+    return {
+        "kind": row["kind"],
+        "id": row["id"],
+        "at": row["at"],
+        "punishment_delta": row["punishment_delta"],
+        "fikapinne_delta": row["fikapinne_delta"],
+        "punishment_balance": row["punishment_balance"],
+        "fikapinne_balance": row["fikapinne_balance"],
+        "reason": row["reason"],
+        "actor": {"id": row["actor_id"], "username": row["actor_username"]},
+    }
+
+
+def _stream_timeline(rows, limit: int):
+    # rows holds up to limit + 1 entries; the extra one only signals another page
+    yield b'{"items":['
+    last = None
+    has_more = False
+    for i, row in enumerate(rows):
+        if i == limit:
+            has_more = True
+            break
+        if last is not None:
+            yield b","
+        yield render_json(_timeline_item(row))
+        last = row
+    next_cursor = _encode_timeline_cursor(last) if has_more else None
+    yield b'],"next_cursor":' + render_json(next_cursor) + b"}"
+
+
+@router.get("/{user_id}/timeline")
+def user_timeline(request, user_id: int, limit: int = 50, cursor: str | None = None):
+    """Delivered punishments, takes and fikapinnar for one user, newest first.
+
+    Every item carries the running punishment and fikapinne balance after it.
+    Responds with ``{"items": [...], "next_cursor": ...}``, streamed as rows
+    come back from the database.
+    """
+    if limit < 1 or limit > 200:
+        raise HttpError(400, "INVALID_LIMIT")
+
+    before = _decode_timeline_cursor(cursor) if cursor else None
+    get_object_or_404(User, id=user_id)
+
+    rows = iter_timeline(user_id, before=before, limit=limit + 1)
+    return StreamingHttpResponse(
+        streaming_content(_stream_timeline(rows, limit)), content_type="application/json"
+    )
@@ -0,0 +1,41 @@
+from django.contrib.auth.models import Group
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from kallan.cache import TAG_USERS, invalidate_tags_on_commit
+from kallan.versioning import bump_ledger_version_on_commit
+
+from .models import User
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, update_fields=None, **kwargs):
+    # logins only touch last_login, which no read endpoint exposes
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return
+    bump_ledger_version_on_commit()
+    invalidate_tags_on_commit(TAG_USERS)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, **kwargs):
+    bump_ledger_version_on_commit()
+    invalidate_tags_on_commit(TAG_USERS)
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def user_permissions_changed(sender, action, **kwargs):
+    # who holds a permission (users_with_perm) also changes with a group's
+    # permissions and with group membership
+    if action.startswith("post_"):
+        bump_ledger_version_on_commit()
+        invalidate_tags_on_commit(TAG_USERS)
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, **kwargs):
+    # its membership and permission rows go without m2m_changed
+    bump_ledger_version_on_commit()
+    invalidate_tags_on_commit(TAG_USERS)
@@ -1,16 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+
 from .schemas import UserMiniOut
 
+User = get_user_model()
+
 
-def user_to_mini(request, user) -> dict:
+def user_to_mini(request, user, with_permissions: bool = True) -> dict:
     avatar_url = (
         request.build_absolute_uri(user.avatar.url)
         if getattr(user, "avatar", None)
         else None
     )
-    return {
+    data = {
         "id": user.id,
         "username": user.username,
         "avatar_url": avatar_url,
         "tier": user.tier,
-        "permissions": list(user.get_all_permissions()),
     }
+    if with_permissions:
+        data["permissions"] = list(user.get_all_permissions())
+    return data
+
+
+def users_with_perm(user_ids, perm: str) -> set[int]:
+    """Ids among ``user_ids`` that have ``perm``, in one query.
+
+    Same answer as ``user.has_perm(perm)`` with the model backend: active
+    users holding it directly, through a group, or as superusers.
+    """
+    app_label, codename = perm.split(".", 1)
+    granted = Q(
+        user_permissions__content_type__app_label=app_label,
+        user_permissions__codename=codename,
+    ) | Q(
+        groups__permissions__content_type__app_label=app_label,
+        groups__permissions__codename=codename,
+    )
+    return set(
+        User.objects.filter(Q(is_superuser=True) | granted, id__in=user_ids, is_active=True)
+        .values_list("id", flat=True)
+        .distinct()
+    )
@@ -0,0 +1,40 @@
+const STREAM_URL = "/api/punishments/stream";
+
+export type LedgerEventType =
+  | "punishment_created"
+  | "punishment_confirmed"
+  | "punishment_deleted"
+  | "punishment_expired"
+  | "punishment_taken"
+  | "fikapinne_given"
+  | "fikapinne_taken";
+
+export type LedgerEvent = {
+  type: LedgerEventType;
+  ids?: number[];
+  target_ids?: number[];
+};
+
+const EVENT_TYPES: LedgerEventType[] = [
+  "punishment_created",
+  "punishment_confirmed",
+  "punishment_deleted",
+  "punishment_expired",
+  "punishment_taken",
+  "fikapinne_given",
+  "fikapinne_taken",
+];
+
+// Opens the SSE ledger feed; returns a function that closes it.
+export function subscribeLedger(onEvent: (e: LedgerEvent) => void): () => void {
+  const source = new EventSource(STREAM_URL, { withCredentials: true });
+
+  const handler = (msg: MessageEvent) => {
+    try {
+      onEvent(JSON.parse(msg.data));
+    } catch {}
+  };
+  for (const type of EVENT_TYPES) source.addEventListener(type, handler);
+
+  return () => source.close();
+}
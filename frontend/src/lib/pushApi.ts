@@ -12,6 +12,7 @@ export type NotificationPrefs = {
   punishment_taken: boolean;
   fikapinne_given: boolean;
   fikapinne_taken: boolean;
+  digest: boolean;
 };
 
 function getCookie(name: string) {
@@ -19,6 +19,7 @@ const DEFAULT_PREFS: NotificationPrefs = {
   punishment_taken: true,
   fikapinne_given: true,
   fikapinne_taken: true,
+  digest: false,
 };
 
 export const usePushStore = defineStore("push", () => {
@@ -82,6 +83,21 @@ export const usePushStore = defineStore("push", () => {
     }
   }
 
+  // Re-send the browser's subscription once per session so the server knows
+  // it is still in use. The server only resets its delivery health if the
+  // keys changed or the push service had reported the endpoint gone.
+  let checkedIn = false;
+  async function checkIn() {
+    if (!supported || checkedIn || Notification.permission !== "granted") return;
+    checkedIn = true;
+    try {
+      const sub = await getBrowserSubscription();
+      if (sub) await apiSubscribe(sub);
+    } catch {
+      // non-fatal, try again next session
+    }
+  }
+
   async function loadNotifPrefs() {
     if (prefsBusy.value) return;
     prefsBusy.value = true;
@@ -173,6 +189,7 @@ export const usePushStore = defineStore("push", () => {
     prefsBusy,
     prefsLoaded,
     refreshState,
+    checkIn,
     loadNotifPrefs,
     updateNotifPref,
     enable,